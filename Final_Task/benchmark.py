@@ -0,0 +1,290 @@
+"""
+Benchmarks of the inverted index building blocks
+"""
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from argparse import ArgumentParser
+from itertools import accumulate
+from typing import Dict, List, Optional
+
+from final_task import (DEFAULT_CACHE_SIZE, ByteLRUCache, Dataset, InvertedIndex, TermFilter, Tokenizer,
+                        build_inverted_index, load_documents)
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+DEFAULT_PATH_TO_DATASET = "wikipedia_sample"
+DEFAULT_DOCUMENTS = 10000
+DEFAULT_VOCABULARY = 50000
+DEFAULT_DOCUMENT_LENGTH = 200
+DEFAULT_QUERIES = 1000
+DEFAULT_QUERY_LENGTH = 2
+DEFAULT_ZIPF_EXPONENT = 1.0
+DEFAULT_SEED = 42
+
+
+def split_terms(content: str, term_filter: TermFilter) -> list:
+    """
+    Tokenization of the previous versions: split, deduplicate with dict.fromkeys, then filter.
+    """
+    terms = re.split(r"\W+", content)
+    filtered_terms = list(dict.fromkeys(terms))
+    return list(term_filter(filtered_terms))
+
+
+def benchmark_tokenizer(dataset: str, repeat: int) -> None:
+    """
+    Prints the best time of tokenizing all documents of the dataset with every tokenization path.
+    :param dataset: path to file with documents
+    :param repeat: number of runs of every path
+    :return: None
+    """
+    documents = list(load_documents(dataset).values())
+    tokenizer = Tokenizer()
+    term_filter = tokenizer.term_filter
+    candidates = {
+        'split + dict.fromkeys + filter': lambda: [split_terms(content, term_filter) for content in documents],
+        'Tokenizer.terms': lambda: [tokenizer.terms(content) for content in documents],
+        'set(Tokenizer.tokens)': lambda: [set(tokenizer.tokens(content)) for content in documents],
+    }
+    for name, candidate in candidates.items():
+        best = min(timeit.repeat(candidate, number=1, repeat=repeat))
+        print(f'{name:32} {best:.3f}s {len(documents) / best:,.0f} docs/s')
+
+
+class ZipfSampler:
+    """
+    Sampler of words w0, w1, ... whose frequencies follow Zipf's law: the word of rank r is drawn
+    with probability proportional to 1 / (r + 1) ** exponent.
+    """
+    def __init__(self, vocabulary: int, exponent: float, seed: int):
+        self.words = [f'w{rank}' for rank in range(vocabulary)]
+        self.cumulative_weights = list(accumulate(1 / (rank + 1) ** exponent for rank in range(vocabulary)))
+        self.random = random.Random(seed)
+
+    def sample(self, count: int) -> List[str]:
+        return self.random.choices(self.words, cum_weights=self.cumulative_weights, k=count)
+
+
+def generate_corpus(filepath: str, documents: int, document_length: int, sampler: ZipfSampler) -> None:
+    """
+    Writes a dataset of documents of Zipf distributed words in the format of the build subcommand.
+    :param filepath: path to write the dataset to
+    :param documents: number of documents
+    :param document_length: number of words of every document
+    :param sampler: ZipfSampler of words
+    :return: None
+    """
+    with open(filepath, 'w', encoding='utf-8') as dataset:
+        for doc_id in range(1, documents + 1):
+            dataset.write(f"{doc_id}\t{' '.join(sampler.sample(document_length))}\n")
+
+
+def generate_queries(queries: int, query_length: int, sampler: ZipfSampler) -> List[List[str]]:
+    """
+    Returns a query log of Zipf distributed words, so popular words are queried more often.
+    """
+    return [sampler.sample(query_length) for _ in range(queries)]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """
+    Returns the nearest-rank percentile of the ascending values, None if there are no values.
+    """
+    if not sorted_values:
+        return None
+    position = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[position]
+
+
+def peak_rss() -> Optional[int]:
+    """
+    Returns the peak resident set size of the process in bytes, None where it is unavailable.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def git_revision() -> Optional[str]:
+    """
+    Returns the commit of the working tree, None outside of a git repository.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def timed(results: Dict[str, dict], name: str, function, *args):
+    """
+    Runs the function, records its wall time and the peak RSS after it under the name.
+    """
+    start = time.perf_counter()
+    value = function(*args)
+    results[name] = {'seconds': time.perf_counter() - start, 'peak_rss_bytes': peak_rss()}
+    return value
+
+
+def latency_report(latencies: List[float]) -> dict:
+    """
+    Returns the total, p50, p99 and max of the latencies of queries with the peak RSS after them.
+    """
+    latencies = sorted(latencies)
+    return {
+        'seconds': sum(latencies),
+        'p50_seconds': percentile(latencies, 0.5),
+        'p99_seconds': percentile(latencies, 0.99),
+        'max_seconds': latencies[-1] if latencies else None,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def benchmark_index(documents: int, vocabulary: int, document_length: int, queries: int, query_length: int,
+                    exponent: float, seed: int, cache_size: int = DEFAULT_CACHE_SIZE) -> dict:
+    """
+    Generates a corpus and a query log, then measures loading of the memory-mapped Dataset,
+    build_inverted_index, dump, load and the latency of every query of the log.
+    Cold latencies are measured with the cache emptied before every query, so they are comparable
+    with the versions without the cache, warm latencies by running the log once more after an untimed run
+    which fills the cache.
+    :param cache_size: bytes of the cache of the loaded index, 0 disables the cache
+    :return: dict with the parameters, the environment and the measurements, ready for json
+    """
+    sampler = ZipfSampler(vocabulary, exponent, seed)
+    report = {
+        'parameters': {'documents': documents, 'vocabulary': vocabulary, 'document_length': document_length,
+                       'queries': queries, 'query_length': query_length, 'zipf_exponent': exponent, 'seed': seed,
+                       'cache_size': cache_size},
+        'environment': {'commit': git_revision(), 'python': platform.python_version(),
+                        'platform': platform.platform()},
+    }
+    phases = report['phases'] = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as directory:
+        dataset = os.path.join(directory, 'dataset')
+        index = os.path.join(directory, 'inverted.index')
+        generate_corpus(dataset, documents, document_length, sampler)
+        query_log = generate_queries(queries, query_length, sampler)
+
+        loaded_documents = timed(phases, 'load_documents', Dataset, dataset)
+        inverted_index = timed(phases, 'build_inverted_index', build_inverted_index, loaded_documents)
+        phases['build_inverted_index']['documents_per_second'] = (
+            documents / phases['build_inverted_index']['seconds'])
+        del loaded_documents
+        timed(phases, 'dump', inverted_index.dump, index)
+        del inverted_index
+        inverted_index = timed(phases, 'load', InvertedIndex.load, index)
+        inverted_index.cache = ByteLRUCache(cache_size)
+        report['index_bytes'] = os.path.getsize(index)
+        report['dataset_bytes'] = os.path.getsize(dataset)
+
+        cold_latencies = []
+        for query in query_log:
+            inverted_index.cache.clear()
+            start = time.perf_counter()
+            inverted_index.query(query)
+            cold_latencies.append(time.perf_counter() - start)
+        phases['query'] = latency_report(cold_latencies)
+        for query in query_log:
+            inverted_index.query(query)
+        warm_latencies = []
+        for query in query_log:
+            start = time.perf_counter()
+            inverted_index.query(query)
+            warm_latencies.append(time.perf_counter() - start)
+        phases['query_warm'] = latency_report(warm_latencies)
+    report['cache'] = inverted_index.cache.stats()
+    report['peak_rss_bytes'] = peak_rss()
+    return report
+
+
+def callback_tokenizer(arguments) -> None:
+    benchmark_tokenizer(arguments.dataset, arguments.repeat)
+
+
+def callback_index(arguments) -> None:
+    report = benchmark_index(arguments.documents, arguments.vocabulary, arguments.document_length,
+                             arguments.queries, arguments.query_length, arguments.zipf_exponent, arguments.seed,
+                             arguments.cache_size)
+    text = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf-8') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+
+
+def main():
+    """
+    Starter of the benchmarks.
+    """
+    parser = ArgumentParser(description="Benchmarks of the inverted index building blocks")
+    subparser = parser.add_subparsers(dest='command', required=True)
+
+    tokenizer_parser = subparser.add_parser('tokenizer', help='compare the tokenization paths on a dataset')
+    tokenizer_parser.add_argument(
+        '-d', '--dataset',
+        default=DEFAULT_PATH_TO_DATASET,
+        help='path to file with documents. The default: %(default)s',
+    )
+    tokenizer_parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='number of runs of every benchmark. The default: %(default)s',
+    )
+    tokenizer_parser.set_defaults(callback=callback_tokenizer)
+
+    index_parser = subparser.add_parser(
+        'index',
+        help='measure build, dump, load and query of a synthetic Zipfian corpus, print the report as json',
+    )
+    for name, default, help_text in (
+            ('--documents', DEFAULT_DOCUMENTS, 'number of documents of the corpus'),
+            ('--vocabulary', DEFAULT_VOCABULARY, 'number of distinct words of the corpus'),
+            ('--document-length', DEFAULT_DOCUMENT_LENGTH, 'number of words of every document'),
+            ('--queries', DEFAULT_QUERIES, 'number of queries of the query log'),
+            ('--query-length', DEFAULT_QUERY_LENGTH, 'number of words of every query'),
+            ('--seed', DEFAULT_SEED, 'seed of the corpus and the query log'),
+    ):
+        index_parser.add_argument(name, type=int, default=default, help=help_text + '. The default: %(default)s')
+    index_parser.add_argument(
+        '--zipf-exponent',
+        type=float,
+        default=DEFAULT_ZIPF_EXPONENT,
+        help='exponent of the distribution of words. The default: %(default)s',
+    )
+    index_parser.add_argument(
+        '--cache-size',
+        type=lambda megabytes: int(float(megabytes) * 1024 * 1024),
+        default=DEFAULT_CACHE_SIZE,
+        help=f'megabytes of the cache of the loaded index, 0 disables the cache. '
+             f'The default: {DEFAULT_CACHE_SIZE // (1024 * 1024)}',
+    )
+    index_parser.add_argument(
+        '-o', '--output',
+        default=None,
+        help='path to write the json report to instead of stdout',
+    )
+    index_parser.set_defaults(callback=callback_index)
+
+    arguments = parser.parse_args()
+    arguments.callback(arguments)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,84 @@
 """
 Module for preparing inverted indexes based on uploaded documents
 """
+import asyncio
+import heapq
 import json
+import math
+import mmap
+import os
+import queue
+import shutil
+import struct
 import sys
 import re
-from typing import Dict, List
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
+from itertools import accumulate, groupby, islice, repeat
+from operator import itemgetter
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Pattern, Sequence, Set, Tuple
 from argparse import ArgumentParser, FileType, ArgumentTypeError
 from io import TextIOWrapper
 
 
 DEFAULT_PATH_TO_STORE_INVERTED_INDEX = "inverted.index"
 PATH_TO_STOP_WORDS = "stop_words_en.txt"
+DEFAULT_SERVE_HOST = "127.0.0.1"
+DEFAULT_SERVE_PORT = 8765
+
+SEGMENT_MAGIC = b"INVIDX\x00\x01"
+DOCUMENT_STORE_MAGIC = b"INVDOC\x00\x01"
+SHARD_MANIFEST_MAGIC = b"INVSHD\x00\x01"
+DOCUMENT_STORE_SUFFIX = ".docs"
+DEFAULT_DOCUMENT_BLOCK_SIZE = 64 * 1024
+DOCUMENT_COMPRESSION_LEVEL = 6
+DEFAULT_SNIPPET_WIDTH = 160
+OUTPUT_CHUNK_SIZE = 4096
+SEGMENT_SECTION = struct.Struct('<4sQQ')
+SEGMENT_FOOTER = struct.Struct('<QI8s')
+OFFSET = struct.Struct('<Q')
+TERM_BLOCK_SIZE = 16
+TERM_PATTERN = re.compile(r'(\w*)\*(\w*)|(\w+)~([12]?)')
+JSON_POSTINGS_PATTERN = re.compile(rb'"((?:[^"\\]|\\.)*)"\s*:\s*\[([^\]]*)\]')
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+# rough footprint of a posting list entry and of a new term with its empty posting list
+POSTING_MEMORY_ESTIMATE = 12
+TERM_MEMORY_ESTIMATE = 200
+FREQUENCY_MEMORY_ESTIMATE = 80
+POSITIONS_MEMORY_ESTIMATE = 160
+DEFAULT_SKIP_INTERVAL = 64
+# documents tokenized by a worker of the pipelined build at once and batches waiting between its stages
+PIPELINE_BATCH_SIZE = 256
+PIPELINE_QUEUE_SIZE = 8
+# chunks of 65536 document identifiers with more documents than the limit are kept as bitmaps
+ROARING_CHUNK_BITS = 16
+ROARING_ARRAY_LIMIT = 4096
+ROARING_BITMAP_BYTES = (1 << ROARING_CHUNK_BITS) // 8
+DEFAULT_MAX_DELTA_SEGMENTS = 8
+DEFAULT_TOP_K = 10
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+# rough footprint of a cache entry and of every document identifier of a cached list
+CACHE_ENTRY_MEMORY_ESTIMATE = 200
+CACHED_POSTING_MEMORY_ESTIMATE = 36
+# upper bounds in seconds of the buckets of latency histograms
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+BM25_K1 = 1.2
+BM25_B = 0.75
+TOKEN_PATTERN = re.compile(r"\w+")
+FIELDS = ('title', 'body')
+TITLE_SOURCES = ('sentence', 'column')
+FIRST_SENTENCE_PATTERN = re.compile(r'.*?[.!?](?=\s|$)', re.S)
+QUERY_TOKEN_PATTERN = re.compile(r'\(|\)|"[^"]*"?|[^\s()"]+')
 
 class EncodedFileType(FileType):
     """
@@ -36,133 +104,3782 @@ class EncodedFileType(FileType):
             message = "can't open '%(filename)s': %(error)s"
             raise ArgumentTypeError(message % args)
 
-    def print_encoder(self):
+    def print_encoder(self):
+        """
+        Printer of encoder.
+        """
+        print(self._encoding)
+
+
+def encode_postings(doc_ids: Iterable[int]) -> bytes:
+    """
+    Encodes an ascending list of document identifiers as gaps packed into variable-byte integers.
+    Every byte keeps 7 bits of the gap, the high bit marks that the gap continues in the next byte.
+    :param doc_ids: ascending document identifiers
+    :return: bytes
+    """
+    encoded = bytearray()
+    previous = 0
+    for doc_id in doc_ids:
+        gap = doc_id - previous
+        previous = doc_id
+        while gap >= 0x80:
+            encoded.append(gap & 0x7F | 0x80)
+            gap >>= 7
+        encoded.append(gap)
+    return bytes(encoded)
+
+
+def decode_postings(encoded: Iterable[int]) -> List[int]:
+    """
+    Decodes document identifiers packed by encode_postings.
+    :param encoded: bytes-like object with variable-byte gaps
+    :return: List[int]
+    """
+    doc_ids = []
+    doc_id = gap = shift = 0
+    for byte in encoded:
+        gap |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            doc_id += gap
+            doc_ids.append(doc_id)
+            gap = shift = 0
+    return doc_ids
+
+
+def encode_varints(values: Iterable[int]) -> bytes:
+    """
+    Packs non-negative integers into variable-byte integers, e.g. term frequencies or document lengths.
+    :param values: non-negative integers
+    :return: bytes
+    """
+    encoded = bytearray()
+    for value in values:
+        while value >= 0x80:
+            encoded.append(value & 0x7F | 0x80)
+            value >>= 7
+        encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_varints(encoded: Iterable[int]) -> List[int]:
+    """
+    Decodes integers packed by encode_varints.
+    :param encoded: bytes-like object with variable-byte integers
+    :return: List[int]
+    """
+    values = []
+    value = shift = 0
+    for byte in encoded:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def encode_positions(position_lists: Iterable[List[int]]) -> bytes:
+    """
+    Encodes positions of a term in a sequence of documents: the number of positions in the document
+    followed by the ascending positions packed as gaps.
+    :param position_lists: ascending positions of the term in every document
+    :return: bytes
+    """
+    encoded = bytearray()
+    for positions in position_lists:
+        encoded += encode_varints([len(positions)])
+        encoded += encode_postings(positions)
+    return bytes(encoded)
+
+
+def decode_positions(encoded: Iterable[int]) -> List[List[int]]:
+    """
+    Decodes positions packed by encode_positions.
+    :param encoded: bytes-like object with encoded positions
+    :return: List[List[int]]
+    """
+    values = decode_varints(encoded)
+    position_lists = []
+    index = 0
+    while index < len(values):
+        count = values[index]
+        position_lists.append(list(accumulate(values[index + 1:index + 1 + count])))
+        index += 1 + count
+    return position_lists
+
+
+def encode_front_coded(terms: Iterable[bytes]) -> bytes:
+    """
+    Encodes a block of ascending terms: every term is stored as the length of the prefix it shares with
+    the previous term, the length of the rest of the term and the rest, the first term is stored whole.
+    :param terms: ascending utf-8 encoded terms
+    :return: bytes
+    """
+    encoded = bytearray()
+    previous = b''
+    for term in terms:
+        shared = 0
+        limit = min(len(term), len(previous))
+        while shared < limit and term[shared] == previous[shared]:
+            shared += 1
+        encoded += encode_varints((shared, len(term) - shared))
+        encoded += term[shared:]
+        previous = term
+    return bytes(encoded)
+
+
+def decode_front_coded(encoded: bytes, limit: int = None) -> List[bytes]:
+    """
+    Decodes terms packed by encode_front_coded.
+    :param encoded: bytes-like object with the block of terms
+    :param limit: if set, decodes at most this many terms
+    :return: List[bytes]
+    """
+    terms = []
+    previous = b''
+    position = 0
+    while position < len(encoded) and (limit is None or len(terms) < limit):
+        lengths = []
+        while len(lengths) < 2:
+            value = shift = 0
+            while True:
+                byte = encoded[position]
+                position += 1
+                value |= (byte & 0x7F) << shift
+                if not byte & 0x80:
+                    break
+                shift += 7
+            lengths.append(value)
+        shared, rest = lengths
+        previous = previous[:shared] + bytes(encoded[position:position + rest])
+        position += rest
+        terms.append(previous)
+    return terms
+
+
+def _offsets_to_bytes(offsets: array) -> bytes:
+    """
+    Serializes an array of unsigned 64-bit offsets in little-endian byte order.
+    """
+    if sys.byteorder != 'little':
+        offsets = array(offsets.typecode, offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
+
+
+def _offsets_from_buffer(buffer, typecode: str = 'Q') -> Sequence[int]:
+    """
+    Returns a read-only sequence of unsigned 64-bit, or other typecode, little-endian integers over the buffer
+    without copying it on little-endian machines.
+    """
+    if sys.byteorder != 'little':
+        offsets = array(typecode, bytes(buffer))
+        offsets.byteswap()
+        return offsets
+    return memoryview(buffer).cast(typecode)
+
+
+def _write_table_of_contents(file, sections: List[Tuple[bytes, int, int]], magic: bytes) -> None:
+    """
+    Writes the table of contents of the sections and the footer pointing to it.
+    """
+    toc_offset = file.tell()
+    for section in sections:
+        file.write(SEGMENT_SECTION.pack(*section))
+    file.write(SEGMENT_FOOTER.pack(toc_offset, len(sections), magic))
+
+
+def _read_table_of_contents(buffer, magic: bytes, filepath: str) -> Dict[bytes, Tuple[int, int]]:
+    """
+    Returns offsets and lengths of the sections by their tags.
+    """
+    toc_offset, count, found_magic = SEGMENT_FOOTER.unpack_from(buffer, len(buffer) - SEGMENT_FOOTER.size)
+    if found_magic != magic:
+        raise ValueError(f"{filepath} is not a {magic[:6].decode('ascii')} file")
+    sections = {}
+    for number in range(count):
+        tag, offset, length = SEGMENT_SECTION.unpack_from(buffer, toc_offset + number * SEGMENT_SECTION.size)
+        sections[tag] = (offset, length)
+    return sections
+
+
+class _SpooledSection:
+    """
+    Section with data of every term, spooled to a temporary file until the segment is closed.
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.offsets = array('Q', [0])
+
+    def append(self, data: bytes) -> None:
+        self.file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+
+    def copy_to(self, file) -> None:
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, file)
+        self.file.close()
+
+
+class SegmentWriter:
+    """
+    Writer of the binary index segment.
+    The segment consists of the postings section (delta and varint encoded document identifiers),
+    the sorted term dictionary front coded in blocks of TERM_BLOCK_SIZE terms, the offsets tables of both
+    and the table of contents at the end of the file. Posting lists of dense terms are written
+    as RoaringPostings instead, the numbers of these terms are kept in the ROAR section.
+    Terms must be added in ascending order of their utf-8 representation, posting lists are streamed
+    to disk right away, so only the term dictionary is kept in memory.
+    Segments written with frequencies also keep term frequencies aligned with the posting lists
+    and the lengths of documents, which ranked retrieval needs, with the largest frequency of every term
+    and the total length of documents, so ranked queries do not scan them. Segments written with positions
+    keep positions of terms in documents, which phrase queries need. Metadata of the index, such as how
+    the documents of a field index were split into fields, is kept as json in the META section.
+    """
+    def __init__(self, filepath: str, with_frequencies: bool = False, with_positions: bool = False):
+        self._file = open(filepath, 'wb')
+        self._file.write(SEGMENT_MAGIC)
+        self._terms = bytearray()
+        self._term_block_offsets = array('Q', [0])
+        self._term_block = []
+        self._postings_offsets = array('Q', [0])
+        self._roaring = []
+        self._last_term = None
+        self._frequencies = _SpooledSection() if with_frequencies else None
+        self._positions = _SpooledSection() if with_positions else None
+        self._doc_lengths = {}
+        self._max_frequencies = array('I') if with_frequencies else None
+        self._metadata = {}
+
+    def add(self, term: str, doc_ids: Iterable[int], frequencies: Iterable[int] = None,
+            positions: Iterable[List[int]] = None) -> None:
+        """
+        Appends the posting list of the term to the segment.
+        :param term: term greater than all previously added terms
+        :param doc_ids: ascending document identifiers
+        :param frequencies: frequencies of the term aligned with doc_ids, required by segments with frequencies
+        :param positions: positions of the term aligned with doc_ids, required by segments with positions
+        :return: None
+        """
+        encoded_term = term.encode('utf-8')
+        if self._last_term is not None and encoded_term <= self._last_term:
+            raise ValueError(f"terms must be added in ascending order, got {term!r} after "
+                             f"{self._last_term.decode('utf-8')!r}")
+        self._last_term = encoded_term
+        doc_ids = doc_ids if isinstance(doc_ids, list) else list(doc_ids)
+        if is_dense(doc_ids):
+            self._roaring.append(len(self._postings_offsets) - 1)
+            postings = RoaringPostings.from_sorted(doc_ids).to_bytes()
+        else:
+            postings = encode_postings(doc_ids)
+        self._file.write(postings)
+        self._term_block.append(encoded_term)
+        if len(self._term_block) == TERM_BLOCK_SIZE:
+            self._flush_terms()
+        self._postings_offsets.append(self._postings_offsets[-1] + len(postings))
+        if self._frequencies is not None:
+            if frequencies is None:
+                raise ValueError(f"frequencies of {term!r} are required by the segment with frequencies")
+            frequencies = frequencies if isinstance(frequencies, list) else list(frequencies)
+            self._frequencies.append(encode_varints(frequencies))
+            self._max_frequencies.append(max(frequencies))
+        if self._positions is not None:
+            if positions is None:
+                raise ValueError(f"positions of {term!r} are required by the segment with positions")
+            self._positions.append(encode_positions(positions))
+
+    def set_document_lengths(self, doc_lengths: Mapping) -> None:
+        """
+        Sets the number of terms of every document, written by segments with frequencies.
+        :param doc_lengths: mapping of documents to their lengths
+        :return: None
+        """
+        self._doc_lengths = doc_lengths
+
+    def set_metadata(self, metadata: Dict[str, str]) -> None:
+        """
+        Sets the metadata of the index written with the segment.
+        :param metadata: dict of json serializable values
+        :return: None
+        """
+        self._metadata = metadata
+
+    def _flush_terms(self) -> None:
+        if self._term_block:
+            self._terms += encode_front_coded(self._term_block)
+            self._term_block_offsets.append(len(self._terms))
+            self._term_block = []
+
+    def close(self) -> None:
+        """
+        Writes the term dictionary, the offsets tables and the table of contents.
+        :return: None
+        """
+        self._flush_terms()
+        sections = [(b'POST', len(SEGMENT_MAGIC), self._postings_offsets[-1])]
+        blobs = [(b'TFCD', bytes(self._terms)),
+                 (b'TFBO', _offsets_to_bytes(self._term_block_offsets)),
+                 (b'TFBS', encode_varints([TERM_BLOCK_SIZE])),
+                 (b'POFF', _offsets_to_bytes(self._postings_offsets))]
+        if self._roaring:
+            blobs.append((b'ROAR', encode_postings(self._roaring)))
+        for tag, offsets_tag, spooled in ((b'FREQ', b'FOFF', self._frequencies), (b'POSN', b'PSOF', self._positions)):
+            if spooled is not None:
+                sections.append((tag, self._file.tell(), spooled.offsets[-1]))
+                spooled.copy_to(self._file)
+                blobs.append((offsets_tag, _offsets_to_bytes(spooled.offsets)))
+        if self._frequencies is not None:
+            doc_ids = array('Q', sorted(self._doc_lengths))
+            lengths = array('I', (self._doc_lengths[doc_id] for doc_id in doc_ids))
+            blobs += [(b'MXTF', _offsets_to_bytes(self._max_frequencies)),
+                      (b'DLID', _offsets_to_bytes(doc_ids)),
+                      (b'DLNS', _offsets_to_bytes(lengths)),
+                      (b'DTOT', encode_varints([sum(lengths)]))]
+        if self._metadata:
+            blobs.append((b'META', json.dumps(self._metadata, sort_keys=True).encode('utf-8')))
+        for tag, data in blobs:
+            sections.append((tag, self._file.tell(), len(data)))
+            self._file.write(data)
+        _write_table_of_contents(self._file, sections, SEGMENT_MAGIC)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            for spooled in (self._frequencies, self._positions):
+                if spooled is not None:
+                    spooled.file.close()
+
+
+class SegmentReader(Mapping):
+    """
+    Read-only mapping of terms to posting lists backed by the memory-mapped binary segment.
+    Only the table of contents is parsed on opening, terms are found by binary search over the first terms
+    of the blocks of the front coded dictionary followed by a scan of a single block, and only the posting
+    lists a query touches are decoded. Segments of the previous versions with a plain dictionary are read too.
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        with open(filepath, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._sections = _read_table_of_contents(self._mmap, SEGMENT_MAGIC, filepath)
+        self._postings = self._sections[b'POST'][0]
+        self._postings_offsets = self._sections[b'POFF'][0]
+        self._count = self._sections[b'POFF'][1] // OFFSET.size - 1
+        self._roaring = frozenset(decode_postings(self._section(b'ROAR'))) if b'ROAR' in self._sections else frozenset()
+        self._front_coded = b'TFCD' in self._sections
+        if self._front_coded:
+            self._terms = self._sections[b'TFCD'][0]
+            self._term_block_offsets = self._sections[b'TFBO'][0]
+            self._block_size = decode_varints(self._section(b'TFBS'))[0]
+            self._blocks = self._sections[b'TFBO'][1] // OFFSET.size - 1
+            self._last_block = (-1, [])
+        else:
+            self._terms = self._sections[b'TERM'][0]
+            self._term_offsets = self._sections[b'TOFF'][0]
+        self.has_frequencies = b'FREQ' in self._sections
+        self.has_positions = b'POSN' in self._sections
+        self._max_frequencies = self._table(b'MXTF', 'I') if b'MXTF' in self._sections else None
+        self.metadata = json.loads(self._section(b'META')) if b'META' in self._sections else {}
+
+    def _offsets(self, table: int, position: int):
+        start = OFFSET.unpack_from(self._mmap, table + position * OFFSET.size)[0]
+        end = OFFSET.unpack_from(self._mmap, table + (position + 1) * OFFSET.size)[0]
+        return start, end
+
+    def _term_block_data(self, block: int) -> bytes:
+        start, end = self._offsets(self._term_block_offsets, block)
+        return self._mmap[self._terms + start:self._terms + end]
+
+    def _term_block(self, block: int) -> List[bytes]:
+        last_block, terms = self._last_block
+        if last_block != block:
+            terms = decode_front_coded(self._term_block_data(block))
+            self._last_block = (block, terms)
+        return terms
+
+    def _term(self, position: int) -> bytes:
+        if self._front_coded:
+            block, offset = divmod(position, self._block_size)
+            return self._term_block(block)[offset]
+        start, end = self._offsets(self._term_offsets, position)
+        return self._mmap[self._terms + start:self._terms + end]
+
+    def _find(self, term: str) -> int:
+        """
+        Returns the position of the term in the dictionary or -1 if the term is absent.
+        """
+        encoded_term = term.encode('utf-8')
+        if self._front_coded:
+            return self._find_front_coded(encoded_term)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < encoded_term:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._count and self._term(low) == encoded_term:
+            return low
+        return -1
+
+    def _find_front_coded(self, encoded_term: bytes) -> int:
+        # the last block whose first term is not greater than the term
+        low, high = 0, self._blocks
+        while low < high:
+            middle = (low + high) // 2
+            if decode_front_coded(self._term_block_data(middle), 1)[0] <= encoded_term:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return -1
+        terms = self._term_block(low - 1)
+        offset = bisect_left(terms, encoded_term)
+        if offset < len(terms) and terms[offset] == encoded_term:
+            return (low - 1) * self._block_size + offset
+        return -1
+
+    def _decode(self, position: int):
+        start, end = self._offsets(self._postings_offsets, position)
+        if position in self._roaring:
+            return RoaringPostings.from_bytes(self._mmap[self._postings + start:self._postings + end])
+        return decode_postings(self._mmap[self._postings + start:self._postings + end])
+
+    def _section(self, tag: bytes) -> bytes:
+        offset, length = self._sections[tag]
+        return self._mmap[offset:offset + length]
+
+    def _table(self, tag: bytes, typecode: str = 'Q') -> Sequence[int]:
+        offset, length = self._sections[tag]
+        return _offsets_from_buffer(memoryview(self._mmap)[offset:offset + length], typecode)
+
+    def _term_data(self, tag: bytes, offsets_tag: bytes, position: int) -> bytes:
+        start, end = self._offsets(self._sections[offsets_tag][0], position)
+        offset = self._sections[tag][0]
+        return self._mmap[offset + start:offset + end]
+
+    def _decode_frequencies(self, position: int) -> List[int]:
+        return decode_varints(self._term_data(b'FREQ', b'FOFF', position))
+
+    def _decode_positions(self, position: int) -> List[List[int]]:
+        return decode_positions(self._term_data(b'POSN', b'PSOF', position))
+
+    def frequencies(self, term: str) -> Optional[Dict[int, int]]:
+        """
+        Returns frequencies of the term by document identifiers or None if the term is absent.
+        """
+        position = self._find(term)
+        if position < 0:
+            return None
+        return dict(zip(self._decode(position), self._decode_frequencies(position)))
+
+    def positions(self, term: str) -> Optional[Dict[int, List[int]]]:
+        """
+        Returns positions of the term by document identifiers or None if the term is absent.
+        """
+        position = self._find(term)
+        if position < 0:
+            return None
+        return dict(zip(self._decode(position), self._decode_positions(position)))
+
+    def max_frequency(self, term: str) -> int:
+        """
+        Returns the largest frequency of the term in a document, 0 if the term is absent.
+        Segments of the previous versions without the MXTF section decode the frequencies of the term.
+        """
+        position = self._find(term)
+        if position < 0:
+            return 0
+        if self._max_frequencies is None:
+            return max(self._decode_frequencies(position))
+        return self._max_frequencies[position]
+
+    def document_lengths(self) -> 'DocumentLengths':
+        """
+        Returns the number of terms of every document, empty for segments without frequencies.
+        Lengths are looked up in the tables of the memory-mapped segment, segments of the previous versions
+        are decoded.
+        """
+        if not self.has_frequencies:
+            return DocumentLengths()
+        if b'DLID' not in self._sections:
+            return DocumentLengths(dict(zip(decode_postings(self._section(b'DDOC')),
+                                            decode_varints(self._section(b'DLEN')))))
+        return DocumentLengths.from_tables(self._table(b'DLID'), self._table(b'DLNS', 'I'),
+                                           decode_varints(self._section(b'DTOT'))[0])
+
+    def entries(self) -> Iterator[Tuple[str, List[int], Optional[List[int]], Optional[List[List[int]]]]]:
+        """
+        Yields terms with their posting lists, the aligned frequencies and positions in the order of the dictionary.
+        Frequencies and positions are None if the segment does not keep them.
+        """
+        for position in range(self._count):
+            yield (self._term(position).decode('utf-8'), self._decode(position),
+                   self._decode_frequencies(position) if self.has_frequencies else None,
+                   self._decode_positions(position) if self.has_positions else None)
+
+    def __getitem__(self, term: str) -> List[int]:
+        position = self._find(term)
+        if position < 0:
+            raise KeyError(term)
+        return self._decode(position)
+
+    def __contains__(self, term) -> bool:
+        return isinstance(term, str) and self._find(term) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        for position in range(self._count):
+            yield self._term(position).decode('utf-8')
+
+    def __len__(self) -> int:
+        return self._count
+
+    def items(self):
+        for position in range(self._count):
+            yield self._term(position).decode('utf-8'), self._decode(position)
+
+
+class JsonPostings(Mapping):
+    """
+    Read-only mapping of terms to posting lists backed by the memory-mapped index dumped as json
+    by the previous versions. Opening scans the file once for the terms and the byte spans of their
+    posting lists without building the lists, a posting list is parsed and sorted when it is looked up.
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        with open(filepath, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._spans = {}
+        for match in JSON_POSTINGS_PATTERN.finditer(self._mmap):
+            key = match.group(1)
+            term = json.loads(b'"' + key + b'"') if b'\\' in key else key.decode('utf-8')
+            self._spans[term] = match.span(2)
+
+    def __getitem__(self, term: str) -> List[int]:
+        start, end = self._spans[term]
+        return sorted(json.loads(b'[' + self._mmap[start:end] + b']'))
+
+    def __contains__(self, term) -> bool:
+        return term in self._spans
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._spans)
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+
+class DocumentStoreWriter:
+    """
+    Writer of the document store kept next to the index for returning documents and snippets of query hits.
+    Documents are appended to blocks of about block_size bytes, every block is compressed with zlib.
+    The store ends with the offsets of the blocks and the table of document identifiers with
+    the positions of documents, sorted by document identifiers, so documents may be added in any order.
+    A document added again with the same identifier replaces the previous one, as the last line does in Dataset.
+    """
+    def __init__(self, filepath: str, block_size: int = DEFAULT_DOCUMENT_BLOCK_SIZE):
+        self._file = open(filepath, 'wb')
+        self._file.write(DOCUMENT_STORE_MAGIC)
+        self._block_size = block_size
+        self._block = bytearray()
+        self._position = 0
+        self._block_offsets = array('Q', [0])
+        self._block_starts = array('Q', [0])
+        self._doc_ids = array('Q')
+        self._starts = array('Q')
+        self._lengths = array('Q')
+
+    def add(self, doc_id: int, content: str) -> None:
+        """
+        Appends the document to the store.
+        :param doc_id: identifier of the document
+        :param content: text of the document
+        :return: None
+        """
+        data = content.encode('utf-8')
+        self._doc_ids.append(doc_id)
+        self._starts.append(self._position)
+        self._lengths.append(len(data))
+        self._block += data
+        self._position += len(data)
+        if len(self._block) >= self._block_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if not self._block:
+            return
+        compressed = zlib.compress(bytes(self._block), DOCUMENT_COMPRESSION_LEVEL)
+        self._file.write(compressed)
+        self._block_offsets.append(self._block_offsets[-1] + len(compressed))
+        self._block_starts.append(self._position)
+        self._block = bytearray()
+
+    def close(self) -> None:
+        """
+        Writes the last block, the tables of blocks and documents and the table of contents.
+        :return: None
+        """
+        self._flush()
+        doc_ids = self._doc_ids
+        # the sort is stable, so of the documents added with the same identifier the last one is kept
+        order = sorted(range(len(doc_ids)), key=doc_ids.__getitem__)
+        order = [position for number, position in enumerate(order)
+                 if number + 1 == len(order) or doc_ids[order[number + 1]] != doc_ids[position]]
+        sections = [(b'BLKS', len(DOCUMENT_STORE_MAGIC), self._block_offsets[-1])]
+        tables = [(b'BOFF', self._block_offsets), (b'BSTA', self._block_starts)]
+        for tag, table in ((b'DIDS', self._doc_ids), (b'DPOS', self._starts), (b'DLEN', self._lengths)):
+            tables.append((tag, array('Q', (table[position] for position in order))))
+        for tag, table in tables:
+            data = _offsets_to_bytes(table)
+            sections.append((tag, self._file.tell(), len(data)))
+            self._file.write(data)
+        _write_table_of_contents(self._file, sections, DOCUMENT_STORE_MAGIC)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+
+
+class DocumentStore(Mapping):
+    """
+    Read-only mapping of document identifiers to documents backed by the memory-mapped document store.
+    A document is found by binary search over the table of identifiers and read with a single
+    decompression of its block, the last decompressed block is kept for hits close to each other.
+    """
+    def __init__(self, filepath: str):
+        with open(filepath, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._sections = _read_table_of_contents(self._mmap, DOCUMENT_STORE_MAGIC, filepath)
+        self._blocks = self._sections[b'BLKS'][0]
+        self._block_offsets = self._table(b'BOFF')
+        self._block_starts = self._table(b'BSTA')
+        self._doc_ids = self._table(b'DIDS')
+        self._starts = self._table(b'DPOS')
+        self._lengths = self._table(b'DLEN')
+        self._last_block = (-1, b'')
+
+    def _table(self, tag: bytes) -> Sequence[int]:
+        offset, length = self._sections[tag]
+        return _offsets_from_buffer(memoryview(self._mmap)[offset:offset + length])
+
+    def _block(self, number: int) -> bytes:
+        last_number, data = self._last_block
+        if last_number != number:
+            start = self._blocks + self._block_offsets[number]
+            data = zlib.decompress(self._mmap[start:self._blocks + self._block_offsets[number + 1]])
+            self._last_block = (number, data)
+        return data
+
+    def __getitem__(self, doc_id: int) -> str:
+        position = bisect_left(self._doc_ids, doc_id)
+        if position == len(self._doc_ids) or self._doc_ids[position] != doc_id:
+            raise KeyError(doc_id)
+        start, length = self._starts[position], self._lengths[position]
+        if not length:
+            return ''
+        number = bisect_right(self._block_starts, start) - 1
+        offset = start - self._block_starts[number]
+        return self._block(number)[offset:offset + length].decode('utf-8')
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._doc_ids)
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+    def snippet(self, doc_id: int, words: Iterable[str], width: int = DEFAULT_SNIPPET_WIDTH) -> Optional[str]:
+        """
+        Returns the part of the document around the first occurrence of any of the words.
+        :param doc_id: identifier of the document
+        :param words: words of the query
+        :param width: number of characters of the snippet
+        :return: the snippet, None if the document is not in the store
+        """
+        content = self.get(doc_id)
+        if content is None:
+            return None
+        wanted = {word.lower() for word in words}
+        center = next((match.start() for match in TOKEN_PATTERN.finditer(content)
+                       if match.group().lower() in wanted), 0)
+        start = max(0, min(center - width // 2, len(content) - width))
+        end = min(len(content), start + width)
+        return ('...' if start else '') + content[start:end] + ('...' if end < len(content) else '')
+
+
+def document_store_path(index: str) -> str:
+    """
+    Returns the path of the document store written next to the index.
+    """
+    return index + DOCUMENT_STORE_SUFFIX
+
+
+def _stored_documents(documents: Iterable[Tuple[int, memoryview]],
+                      writer: DocumentStoreWriter) -> Iterator[Tuple[int, memoryview]]:
+    """
+    Adds the documents of Dataset to the store as they pass to the index builder.
+    """
+    for doc_id, content in documents:
+        writer.add(doc_id, str(content, 'utf-8'))
+        yield doc_id, content
+
+
+class PostingCursor:
+    """
+    Forward-only cursor over an ascending posting list.
+    Seeks use galloping search: the step doubles until it passes the target,
+    then the target is located with binary search inside the last step.
+    """
+    __slots__ = ('_postings', '_position')
+
+    def __init__(self, postings):
+        self._postings = postings
+        self._position = 0
+
+    def seek(self, target: int) -> Optional[int]:
+        """
+        Moves to the first document identifier which is not less than the target.
+        :param target: document identifier
+        :return: found document identifier or None if the posting list is exhausted
+        """
+        postings = self._postings
+        position = self._position
+        size = len(postings)
+        if position >= size:
+            return None
+        if postings[position] >= target:
+            return postings[position]
+        low, step = position, 1
+        while position + step < size and postings[position + step] < target:
+            low = position + step
+            step *= 2
+        self._position = position = bisect_left(postings, target, low + 1, min(position + step + 1, size))
+        return postings[position] if position < size else None
+
+
+class CompressedPostings:
+    """
+    Compact posting list: gaps between document identifiers packed into variable-byte integers.
+    Every skip_interval-th document identifier is kept in the skip table together with the offset of
+    the following entry, so a block of the list can be decoded without decoding the preceding blocks.
+    Lists shorter than a block have no skip table.
+    """
+    __slots__ = ('data', 'skip_ids', 'skip_offsets', 'skip_interval', '_length')
+
+    def __init__(self, doc_ids: Iterable[int], skip_interval: int = DEFAULT_SKIP_INTERVAL):
+        encoded = bytearray()
+        skip_ids = array('Q')
+        skip_offsets = array('I')
+        previous = length = 0
+        for doc_id in doc_ids:
+            gap = doc_id - previous
+            previous = doc_id
+            while gap >= 0x80:
+                encoded.append(gap & 0x7F | 0x80)
+                gap >>= 7
+            encoded.append(gap)
+            if length % skip_interval == 0:
+                skip_ids.append(doc_id)
+                skip_offsets.append(len(encoded))
+            length += 1
+        self.data = bytes(encoded)
+        self.skip_interval = skip_interval
+        self._length = length
+        if length > skip_interval:
+            self.skip_ids, self.skip_offsets = skip_ids, skip_offsets
+        else:
+            self.skip_ids = self.skip_offsets = None
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(decode_postings(self.data))
+
+    def blocks(self) -> int:
+        """
+        Returns the number of blocks in the list.
+        """
+        return len(self.skip_ids) if self.skip_ids is not None else int(self._length > 0)
+
+    def block(self, number: int) -> List[int]:
+        """
+        Decodes the document identifiers of a single block.
+        :param number: number of the block
+        :return: List[int]
+        """
+        if self.skip_ids is None:
+            return decode_postings(self.data)
+        doc_id = self.skip_ids[number]
+        doc_ids = [doc_id]
+        remaining = min(self.skip_interval, self._length - number * self.skip_interval) - 1
+        data = self.data
+        offset = self.skip_offsets[number]
+        gap = shift = 0
+        while remaining:
+            byte = data[offset]
+            offset += 1
+            gap |= (byte & 0x7F) << shift
+            if byte & 0x80:
+                shift += 7
+            else:
+                doc_id += gap
+                doc_ids.append(doc_id)
+                gap = shift = 0
+                remaining -= 1
+        return doc_ids
+
+    def cursor(self) -> 'CompressedCursor':
+        """
+        Returns a cursor which decodes only the blocks it seeks into.
+        """
+        return CompressedCursor(self)
+
+
+class CompressedCursor:
+    """
+    Forward-only cursor over CompressedPostings.
+    The block of the target is found by binary search over the skip table and decoded on its own.
+    """
+    __slots__ = ('_postings', '_block', '_doc_ids', '_position')
+
+    def __init__(self, postings: CompressedPostings):
+        self._postings = postings
+        self._block = -1
+        self._doc_ids = None
+        self._position = 0
+
+    def seek(self, target: int) -> Optional[int]:
+        """
+        Moves to the first document identifier which is not less than the target.
+        :param target: document identifier
+        :return: found document identifier or None if the posting list is exhausted
+        """
+        doc_ids = self._doc_ids
+        if doc_ids and doc_ids[-1] >= target:
+            if doc_ids[self._position] < target:
+                self._position = bisect_left(doc_ids, target, self._position)
+            return doc_ids[self._position]
+        postings = self._postings
+        blocks = postings.blocks()
+        if postings.skip_ids is None:
+            block = self._block + 1
+        else:
+            block = max(bisect_right(postings.skip_ids, target) - 1, self._block + 1)
+        while block < blocks:
+            doc_ids = postings.block(block)
+            position = bisect_left(doc_ids, target)
+            if position < len(doc_ids):
+                self._block, self._doc_ids, self._position = block, doc_ids, position
+                return doc_ids[position]
+            block += 1
+        self._block, self._doc_ids = blocks, None
+        return None
+
+
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+
+
+def _chunk_bounds(doc_ids) -> Iterator[Tuple[int, int, int]]:
+    """
+    Yields the high bits of every chunk of the ascending document identifiers with the bounds of the chunk.
+    """
+    start = 0
+    while start < len(doc_ids):
+        key = doc_ids[start] >> ROARING_CHUNK_BITS
+        end = bisect_left(doc_ids, (key + 1) << ROARING_CHUNK_BITS, start)
+        yield key, start, end
+        start = end
+
+
+def is_dense(doc_ids) -> bool:
+    """
+    Tells whether the ascending document identifiers have a chunk dense enough to be kept as a bitmap.
+    """
+    return len(doc_ids) > ROARING_ARRAY_LIMIT and any(
+        end - start > ROARING_ARRAY_LIMIT for _, start, end in _chunk_bounds(doc_ids))
+
+
+def _bitmap_bits(bitmap: int) -> Iterator[int]:
+    """
+    Yields the positions of the set bits of the chunk bitmap in ascending order.
+    """
+    for offset, byte in enumerate(bitmap.to_bytes(ROARING_BITMAP_BYTES, 'little')):
+        if byte:
+            base = offset << 3
+            for bit in _BYTE_BITS[byte]:
+                yield base + bit
+
+
+class RoaringPostings:
+    """
+    Posting list of a dense term in the layout of Roaring bitmaps: document identifiers are split into chunks
+    by their high 16 bits, a chunk keeps the low 16 bits either in a sorted array('H') or, when it has more
+    than ROARING_ARRAY_LIMIT documents, in a bitmap of 65536 bits held in an integer, so the intersection
+    of two bitmaps is a single AND over machine words.
+    """
+    __slots__ = ('keys', 'chunks', '_length')
+
+    def __init__(self, keys: List[int], chunks: list):
+        self.keys = keys
+        self.chunks = chunks
+        self._length = sum(len(chunk) if isinstance(chunk, array) else bin(chunk).count('1') for chunk in chunks)
+
+    @classmethod
+    def from_sorted(cls, doc_ids) -> 'RoaringPostings':
+        """
+        Builds the posting list of ascending document identifiers.
+        """
+        doc_ids = doc_ids if isinstance(doc_ids, list) else list(doc_ids)
+        keys, chunks = [], []
+        for key, start, end in _chunk_bounds(doc_ids):
+            lows = array('H', (doc_id & 0xFFFF for doc_id in doc_ids[start:end]))
+            keys.append(key)
+            chunks.append(cls._bitmap(lows) if len(lows) > ROARING_ARRAY_LIMIT else lows)
+        return cls(keys, chunks)
+
+    @staticmethod
+    def _bitmap(lows: Iterable[int]) -> int:
+        bits = bytearray(ROARING_BITMAP_BYTES)
+        for low in lows:
+            bits[low >> 3] |= 1 << (low & 7)
+        return int.from_bytes(bits, 'little')
+
+    @staticmethod
+    def _optimize(chunk: int):
+        """
+        Returns the bitmap chunk of an intersection as an array if it became sparse.
+        """
+        if bin(chunk).count('1') > ROARING_ARRAY_LIMIT:
+            return chunk
+        return array('H', _bitmap_bits(chunk))
+
+    @staticmethod
+    def _and_chunks(first, second):
+        if isinstance(first, int) and isinstance(second, int):
+            return RoaringPostings._optimize(first & second)
+        if isinstance(first, int):
+            first, second = second, first
+        if isinstance(second, int):
+            return array('H', (low for low in first if second >> low & 1))
+        return array('H', sorted(set(first).intersection(second)))
+
+    @classmethod
+    def intersection(cls, posting_lists: List['RoaringPostings']) -> 'RoaringPostings':
+        """
+        Intersects the posting lists chunk by chunk, only chunks with the same high bits in every list are compared.
+        """
+        shortest, *others = sorted(posting_lists, key=len)
+        keys, chunks = [], []
+        for key, chunk in zip(shortest.keys, shortest.chunks):
+            for other in others:
+                position = bisect_left(other.keys, key)
+                if position == len(other.keys) or other.keys[position] != key:
+                    break
+                chunk = cls._and_chunks(chunk, other.chunks[position])
+                if not (len(chunk) if isinstance(chunk, array) else chunk):
+                    break
+            else:
+                keys.append(key)
+                chunks.append(chunk)
+        return cls(keys, chunks)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __iter__(self) -> Iterator[int]:
+        for key, chunk in zip(self.keys, self.chunks):
+            base = key << ROARING_CHUNK_BITS
+            for low in chunk if isinstance(chunk, array) else _bitmap_bits(chunk):
+                yield base + low
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Returns the size of the chunks in bytes.
+        """
+        return sum(len(chunk) * 2 if isinstance(chunk, array) else ROARING_BITMAP_BYTES for chunk in self.chunks)
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the posting list: the number of chunks, then for every chunk its high bits and
+        the number of documents followed by the array of low bits or the bitmap.
+        """
+        encoded = bytearray(encode_varints([len(self.keys)]))
+        for key, chunk in zip(self.keys, self.chunks):
+            if isinstance(chunk, array):
+                encoded += encode_varints([key, len(chunk)])
+                if sys.byteorder != 'little':
+                    chunk = array('H', chunk)
+                    chunk.byteswap()
+                encoded += chunk.tobytes()
+            else:
+                encoded += encode_varints([key, bin(chunk).count('1')])
+                encoded += chunk.to_bytes(ROARING_BITMAP_BYTES, 'little')
+        return bytes(encoded)
+
+    @classmethod
+    def from_bytes(cls, encoded: bytes) -> 'RoaringPostings':
+        """
+        Deserializes the posting list written by to_bytes.
+        """
+        position = 0
+
+        def read_varint() -> int:
+            nonlocal position
+            value = shift = 0
+            while True:
+                byte = encoded[position]
+                position += 1
+                value |= (byte & 0x7F) << shift
+                if not byte & 0x80:
+                    return value
+                shift += 7
+
+        keys, chunks = [], []
+        for _ in range(read_varint()):
+            keys.append(read_varint())
+            cardinality = read_varint()
+            if cardinality > ROARING_ARRAY_LIMIT:
+                chunks.append(int.from_bytes(encoded[position:position + ROARING_BITMAP_BYTES], 'little'))
+                position += ROARING_BITMAP_BYTES
+            else:
+                chunk = array('H', bytes(encoded[position:position + cardinality * 2]))
+                if sys.byteorder != 'little':
+                    chunk.byteswap()
+                chunks.append(chunk)
+                position += cardinality * 2
+        return cls(keys, chunks)
+
+    def cursor(self) -> 'RoaringCursor':
+        """
+        Returns a cursor which skips chunks by their high bits.
+        """
+        return RoaringCursor(self)
+
+
+class RoaringCursor:
+    """
+    Forward-only cursor over RoaringPostings.
+    """
+    __slots__ = ('_postings', '_chunk')
+
+    def __init__(self, postings: RoaringPostings):
+        self._postings = postings
+        self._chunk = 0
+
+    def seek(self, target: int) -> Optional[int]:
+        """
+        Moves to the first document identifier which is greater than or equal to target.
+        :param target: document identifier to look for
+        :return: the found document identifier or None if the list is exhausted
+        """
+        keys, chunks = self._postings.keys, self._postings.chunks
+        key = target >> ROARING_CHUNK_BITS
+        self._chunk = bisect_left(keys, key, self._chunk)
+        while self._chunk < len(keys):
+            chunk_key = keys[self._chunk]
+            low = target & 0xFFFF if chunk_key == key else 0
+            chunk = chunks[self._chunk]
+            if isinstance(chunk, array):
+                position = bisect_left(chunk, low)
+                if position < len(chunk):
+                    return (chunk_key << ROARING_CHUNK_BITS) + chunk[position]
+            else:
+                rest = chunk >> low
+                if rest:
+                    return (chunk_key << ROARING_CHUNK_BITS) + low + (rest & -rest).bit_length() - 1
+            self._chunk += 1
+        return None
+
+
+def make_cursor(postings) -> PostingCursor:
+    """
+    Returns a cursor over the posting list, containers with their own cursor provide it themselves.
+    """
+    if hasattr(postings, 'cursor'):
+        return postings.cursor()
+    return PostingCursor(postings)
+
+
+def iter_cursor(cursor) -> Iterator[int]:
+    """
+    Lazily yields every document identifier the cursor can seek to in ascending order.
+    """
+    doc_id = cursor.seek(0)
+    while doc_id is not None:
+        yield doc_id
+        doc_id = cursor.seek(doc_id + 1)
+
+
+def iter_intersection(posting_lists: List) -> Iterator[int]:
+    """
+    Lazily intersects ascending posting lists.
+    Lists are ordered by length, every document of the shortest list is looked up in the longer lists
+    with galloping cursors, so the work is proportional to the shortest list times the logarithm of the others.
+    RoaringPostings of dense terms are intersected with each other chunk by chunk first.
+    :param posting_lists: ascending posting lists
+    :return: Iterator[int] over common document identifiers in ascending order
+    """
+    if not posting_lists:
+        return
+    bitmaps = [postings for postings in posting_lists if isinstance(postings, RoaringPostings)]
+    if len(bitmaps) > 1:
+        posting_lists = [RoaringPostings.intersection(bitmaps),
+                         *(postings for postings in posting_lists if not isinstance(postings, RoaringPostings))]
+    shortest, *others = sorted(posting_lists, key=len)
+    cursors = [make_cursor(postings) for postings in others]
+    for doc_id in shortest:
+        for cursor in cursors:
+            found = cursor.seek(doc_id)
+            if found is None:
+                return
+            if found != doc_id:
+                break
+        else:
+            yield doc_id
+
+
+def _is_term_pattern(word: str) -> bool:
+    """
+    Checks whether the word is a supported pattern: prefix*, *suffix, prefix*suffix, word~ or word~2.
+    """
+    match = TERM_PATTERN.fullmatch(word)
+    return match is not None and match.group(0) != '*'
+
+
+class TermDictionary:
+    """
+    Sorted terms of a segment for prefix, suffix and fuzzy lookups, built on the first lookup of the segment.
+    Terms of binary segments are already sorted, other terms are sorted once. Suffix lookups use
+    the sorted reversed terms, which are built on the first suffix lookup.
+    """
+    def __init__(self, words_ids):
+        if isinstance(words_ids, SegmentReader):
+            self.terms = list(words_ids)
+        else:
+            self.terms = sorted(words_ids)
+        self._reversed_terms = None
+
+    @staticmethod
+    def _starting_with(terms, prefix: str) -> Iterator[str]:
+        position = bisect_left(terms, prefix)
+        while position < len(terms):
+            term = terms[position]
+            if not term.startswith(prefix):
+                break
+            yield term
+            position += 1
+
+    def prefix(self, prefix: str) -> Iterator[str]:
+        """
+        Yields the terms starting with the prefix in ascending order.
+        """
+        return self._starting_with(self.terms, prefix)
+
+    def suffix(self, suffix: str) -> Iterator[str]:
+        """
+        Yields the terms ending with the suffix.
+        """
+        if self._reversed_terms is None:
+            self._reversed_terms = sorted(term[::-1] for term in self.terms)
+        for reversed_term in self._starting_with(self._reversed_terms, suffix[::-1]):
+            yield reversed_term[::-1]
+
+    def fuzzy(self, word: str, max_distance: int = 1) -> Iterator[str]:
+        """
+        Yields the terms within the Levenshtein distance from the word in ascending order.
+        The terms are walked like a trie: rows of the distance table are shared by terms with a common prefix,
+        and once every cell of a row exceeds the distance, all terms with the prefix of the row are skipped.
+        """
+        terms = self.terms
+        rows = [list(range(len(word) + 1))]
+        previous = ''
+        position = 0
+        while position < len(terms):
+            term = terms[position]
+            shared = 0
+            limit = min(len(term), len(previous), len(rows) - 1)
+            while shared < limit and term[shared] == previous[shared]:
+                shared += 1
+            del rows[shared + 1:]
+            pruned = None
+            for length in range(shared, len(term)):
+                above = rows[-1]
+                row = [above[0] + 1]
+                for column, character in enumerate(word, 1):
+                    row.append(min(row[column - 1] + 1, above[column] + 1,
+                                   above[column - 1] + (character != term[length])))
+                rows.append(row)
+                if min(row) > max_distance:
+                    pruned = term[:length + 1]
+                    break
+            previous = term
+            if pruned is None:
+                if rows[-1][-1] <= max_distance:
+                    yield term
+                position += 1
+            elif ord(pruned[-1]) < sys.maxunicode:
+                position = max(position + 1, bisect_left(terms, pruned[:-1] + chr(ord(pruned[-1]) + 1)))
+            else:
+                position += 1
+
+
+class Tombstones:
+    """
+    Sparse set of deleted document identifiers, it takes memory by the number of deleted documents
+    whatever the largest identifier is.
+    """
+    __slots__ = ('_doc_ids',)
+
+    def __init__(self, doc_ids: Iterable[int] = ()):
+        self._doc_ids = set(doc_ids)
+
+    def add(self, doc_id: int) -> None:
+        """
+        Marks the document identifier as deleted.
+        """
+        self._doc_ids.add(doc_id)
+
+    def __contains__(self, doc_id: int) -> bool:
+        return doc_id in self._doc_ids
+
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+
+
+class Segment:
+    """
+    Posting lists with frequencies and positions of the terms by documents, together with
+    the tombstones of the documents deleted later. The main posting lists of the index
+    and every batch of documents added after the build are segments. Documents of a segment are known
+    for the batches of added documents, deletions of other documents are not recorded in their tombstones.
+    """
+    __slots__ = ('words_ids', 'frequencies', 'positions', 'deleted', 'documents')
+
+    def __init__(self, words_ids, frequencies=None, positions=None, deleted: Tombstones = None,
+                 documents: FrozenSet[int] = None):
+        self.words_ids = words_ids
+        self.frequencies = frequencies if frequencies is not None else {}
+        self.positions = positions if positions is not None else {}
+        self.deleted = deleted if deleted is not None else Tombstones()
+        self.documents = documents
+
+
+class SegmentPayloads(Mapping):
+    """
+    Read-only mapping of terms to their frequencies or positions by document identifiers backed by SegmentReader.
+    """
+    def __init__(self, reader: SegmentReader, lookup: Callable[[str], Optional[dict]]):
+        self._reader = reader
+        self._lookup = lookup
+
+    def __getitem__(self, term: str) -> dict:
+        payloads = self._lookup(term)
+        if payloads is None:
+            raise KeyError(term)
+        return payloads
+
+    def __contains__(self, term) -> bool:
+        return term in self._reader
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._reader)
+
+    def __len__(self) -> int:
+        return len(self._reader)
+
+
+class DocumentLengths(MutableMapping):
+    """
+    Lengths of documents with their running total, so ranked queries average them without a scan.
+    Lengths read from a segment stay in its memory-mapped tables of ascending identifiers and are found by
+    binary search, lengths set later are kept in a dict and deleted documents of the tables in a set.
+    """
+    def __init__(self, lengths: Dict[int, int] = None):
+        self._doc_ids: Sequence[int] = ()
+        self._lengths: Sequence[int] = ()
+        self._changed: Dict[int, int] = dict(lengths) if lengths else {}
+        self._removed: Set[int] = set()
+        self._count = len(self._changed)
+        self.total = sum(self._changed.values())
+
+    @classmethod
+    def from_tables(cls, doc_ids: Sequence[int], lengths: Sequence[int], total: int) -> 'DocumentLengths':
+        """
+        Returns the lengths over the aligned tables of ascending identifiers and lengths with their known total.
+        """
+        document_lengths = cls()
+        document_lengths._doc_ids = doc_ids
+        document_lengths._lengths = lengths
+        document_lengths._count = len(doc_ids)
+        document_lengths.total = total
+        return document_lengths
+
+    def _stored(self, doc_id: int) -> Optional[int]:
+        if not self._doc_ids or doc_id in self._removed:
+            return None
+        position = bisect_left(self._doc_ids, doc_id)
+        if position < len(self._doc_ids) and self._doc_ids[position] == doc_id:
+            return self._lengths[position]
+        return None
+
+    def average(self) -> float:
+        """
+        Returns the average length of documents, 0.0 if there are none.
+        """
+        return self.total / self._count if self._count else 0.0
+
+    def __getitem__(self, doc_id: int) -> int:
+        length = self._changed.get(doc_id)
+        if length is None:
+            length = self._stored(doc_id)
+            if length is None:
+                raise KeyError(doc_id)
+        return length
+
+    def __setitem__(self, doc_id: int, length: int) -> None:
+        previous = self._changed.get(doc_id)
+        if previous is None:
+            previous = self._stored(doc_id)
+        if previous is None:
+            self._count += 1
+        else:
+            self.total -= previous
+        self.total += length
+        self._changed[doc_id] = length
+
+    def __delitem__(self, doc_id: int) -> None:
+        length = self._changed.pop(doc_id, None)
+        stored = self._stored(doc_id)
+        if stored is not None:
+            self._removed.add(doc_id)
+            length = stored if length is None else length
+        if length is None:
+            raise KeyError(doc_id)
+        self._count -= 1
+        self.total -= length
+
+    def __iter__(self) -> Iterator[int]:
+        for doc_id in self._doc_ids:
+            if doc_id not in self._removed and doc_id not in self._changed:
+                yield doc_id
+        yield from self._changed
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class Vocabulary(Mapping):
+    """
+    Interned terms of an index under construction. Every new term gets the next dense integer id,
+    posting lists, frequencies and positions are kept in lists indexed by term ids, so a token is hashed
+    once to find all of them. The vocabulary is a read-only mapping of terms to posting lists.
+    """
+    def __init__(self, with_frequencies: bool = False, with_positions: bool = False):
+        self.ids: Dict[str, int] = {}
+        self.terms: List[str] = []
+        self.postings: List[List[int]] = []
+        self.frequency_lists: Optional[List[Dict[int, int]]] = [] if with_frequencies else None
+        self.position_lists: Optional[List[Dict[int, List[int]]]] = [] if with_positions else None
+        self.frequencies = TermColumn(self, self.frequency_lists) if with_frequencies else None
+        self.positions = TermColumn(self, self.position_lists) if with_positions else None
+
+    def add(self, term: str) -> int:
+        """
+        Returns the id of the term, a new term gets the next id and empty posting list and payloads.
+        """
+        term_id = self.ids.get(term)
+        if term_id is None:
+            term_id = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+            self.postings.append([])
+            if self.frequency_lists is not None:
+                self.frequency_lists.append({})
+            if self.position_lists is not None:
+                self.position_lists.append({})
+        return term_id
+
+    def term_id(self, term: str) -> Optional[int]:
+        """
+        Returns the id of the term, None if the term is not in the vocabulary.
+        """
+        return self.ids.get(term)
+
+    def __getitem__(self, term: str) -> List[int]:
+        return self.postings[self.ids[term]]
+
+    def get(self, term: str, default=None):
+        term_id = self.ids.get(term)
+        return default if term_id is None else self.postings[term_id]
+
+    def __contains__(self, term) -> bool:
+        return term in self.ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.terms)
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+
+class TermColumn(Mapping):
+    """
+    Read-only mapping of terms to their frequencies or positions by document identifiers
+    backed by a list indexed by the term ids of the vocabulary.
+    """
+    def __init__(self, vocabulary: Vocabulary, values: list):
+        self._ids = vocabulary.ids
+        self._terms = vocabulary.terms
+        self._values = values
+
+    def __getitem__(self, term: str) -> dict:
+        return self._values[self._ids[term]]
+
+    def get(self, term: str, default=None):
+        term_id = self._ids.get(term)
+        return default if term_id is None else self._values[term_id]
+
+    def __contains__(self, term) -> bool:
+        return term in self._ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._terms)
+
+    def __len__(self) -> int:
+        return len(self._terms)
+
+
+class Metrics:
+    """
+    Opt-in instrumentation of the build and the queries: seconds spent in stages, counters and
+    histograms of latencies. Instrumented code checks the module-level _metrics, which is None
+    until enable_metrics is called, so disabled instrumentation costs a global lookup per document or query.
+    Stages may contain other stages, e.g. build contains tokenize and index.
+    """
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.stages: Dict[str, float] = {}
+        self.counters: Counter = Counter()
+        self.gauges: Dict[str, float] = {}
+        # counts of observations by bucket, the last one is for the observations above all buckets
+        self.histograms: Dict[str, List[int]] = {}
+        self.histogram_sums: Dict[str, float] = {}
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, stage: str):
+        """
+        Adds the time spent in the with block to the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def count(self, name: str, value: int = 1) -> None:
+        self.counters[name] += value
+
+    def observe(self, name: str, value: float) -> None:
+        """
+        Adds the value, e.g. the latency of a query in seconds, to the histogram.
+        """
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = [0] * (len(self.buckets) + 1)
+            self.histogram_sums[name] = 0.0
+        histogram[bisect_left(self.buckets, value)] += 1
+        self.histogram_sums[name] += value
+
+    def record_cache(self, stats: Dict[str, int]) -> None:
+        """
+        Keeps the counters of ByteLRUCache.stats and the hit rate as gauges.
+        """
+        for name, value in stats.items():
+            self.gauges[f'cache_{name}'] = value
+        lookups = stats['hits'] + stats['misses']
+        self.gauges['cache_hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+
+    def rates(self) -> Dict[str, float]:
+        """
+        Returns documents and tokens per second of the build and queries per second.
+        """
+        rates = {}
+        for counter, stage, rate in (('documents', 'build', 'documents_per_second'),
+                                     ('tokens', 'build', 'tokens_per_second'),
+                                     ('queries', 'query', 'queries_per_second')):
+            if self.counters.get(counter) and self.stages.get(stage):
+                rates[rate] = self.counters[counter] / self.stages[stage]
+        return rates
+
+    def to_dict(self) -> dict:
+        """
+        Returns the metrics ready for json, histograms have cumulative counts by upper bounds of the buckets.
+        """
+        histograms = {}
+        for name, histogram in self.histograms.items():
+            cumulative = list(accumulate(histogram))
+            histograms[name] = {'buckets': dict(zip([*map(str, self.buckets), '+Inf'], cumulative)),
+                                'count': cumulative[-1], 'sum': self.histogram_sums[name]}
+        return {'stages_seconds': dict(self.stages), 'counters': dict(self.counters), 'rates': self.rates(),
+                'gauges': dict(self.gauges), 'histograms': histograms}
+
+    def to_prometheus(self, prefix: str = 'inverted_index') -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        if self.stages:
+            lines.append(f'# TYPE {prefix}_stage_seconds_total counter')
+            lines.extend(f'{prefix}_stage_seconds_total{{stage="{stage}"}} {seconds}'
+                         for stage, seconds in self.stages.items())
+        for name, value in self.counters.items():
+            lines += [f'# TYPE {prefix}_{name}_total counter', f'{prefix}_{name}_total {value}']
+        for name, value in {**self.rates(), **self.gauges}.items():
+            lines += [f'# TYPE {prefix}_{name} gauge', f'{prefix}_{name} {value}']
+        for name, histogram in self.histograms.items():
+            lines.append(f'# TYPE {prefix}_{name} histogram')
+            for bound, count in zip([*map(str, self.buckets), '+Inf'], accumulate(histogram)):
+                lines.append(f'{prefix}_{name}_bucket{{le="{bound}"}} {count}')
+            lines += [f'{prefix}_{name}_sum {self.histogram_sums[name]}', f'{prefix}_{name}_count {sum(histogram)}']
+        return '\n'.join(lines) + '\n'
+
+
+_metrics: Optional[Metrics] = None
+
+
+def enable_metrics() -> Metrics:
+    """
+    Starts collecting metrics of this process into a new Metrics, which is returned.
+    Worker processes of parallel builds and queries do not report to it.
+    """
+    global _metrics
+    _metrics = Metrics()
+    return _metrics
+
+
+def disable_metrics() -> None:
+    global _metrics
+    _metrics = None
+
+
+def _stage(stage: str):
+    """
+    Returns the timer of the stage if metrics are enabled, a context manager doing nothing otherwise.
+    """
+    return _metrics.timer(stage) if _metrics is not None else nullcontext()
+
+
+class ByteLRUCache:
+    """
+    Least recently used cache bounded by the estimated size of the values in bytes.
+    Values are stored with the generation of the cache they were computed in: clear starts a new generation,
+    so values computed from the index before an update and stored after it are dropped.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value, None if the key is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int, generation: int) -> None:
+        """
+        Caches the value and evicts the least recently used values beyond the size limit.
+        :param key: key of the value
+        :param value: value
+        :param size: estimated size of the value in bytes
+        :param generation: generation of the cache read before the value was computed
+        :return: None
+        """
+        with self._lock:
+            if generation != self.generation or size > self.max_bytes:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= previous[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Drops every value and starts a new generation.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.generation += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the counters of hits, misses and evictions with the number and the size of cached values.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._size}
+
+
+def _cached_size(doc_ids) -> int:
+    if isinstance(doc_ids, RoaringPostings):
+        return CACHE_ENTRY_MEMORY_ESTIMATE + doc_ids.nbytes
+    return CACHE_ENTRY_MEMORY_ESTIMATE + len(doc_ids) * CACHED_POSTING_MEMORY_ESTIMATE
+
+
+class InvertedIndex:
+    """
+    The inverted index is a dictionary where the keys are the terms and the values are the lists of document
+    identifiers. Posting lists are kept in ascending order of document identifiers.
+    Indexes built with frequencies also keep frequencies of terms by documents and lengths of documents
+    for ranked retrieval, indexes built with positions keep positions of terms in documents for phrase queries.
+    Documents added or deleted after the build are kept in small delta segments and tombstones
+    until merge compacts them into the main posting lists.
+    Decoded posting lists and answers of queries are kept in a cache of cache_size bytes.
+    """
+    max_delta_segments = DEFAULT_MAX_DELTA_SEGMENTS
+    cache_size = DEFAULT_CACHE_SIZE
+
+    def __init__(self, words_ids: Dict[str, List[int]] = None, frequencies: Dict[str, Dict[int, int]] = None,
+                 doc_lengths: Mapping = None, positions: Dict[str, Dict[int, List[int]]] = None):
+        self.words_ids = words_ids if words_ids is not None else dict()
+        self.with_frequencies = frequencies is not None
+        self.frequencies = frequencies if frequencies is not None else {}
+        self.doc_lengths = doc_lengths if isinstance(doc_lengths, DocumentLengths) else DocumentLengths(doc_lengths)
+        self.with_positions = positions is not None
+        self.positions = positions if positions is not None else {}
+        self.deleted = Tombstones()
+        self.segments: Tuple[Segment, ...] = ()
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._pending_deletes = None
+        self.cache = ByteLRUCache(self.cache_size)
+        self._term_dictionaries = {}
+        self.fields: Dict[str, InvertedIndex] = {}
+        self.metadata: Dict[str, str] = {}
+
+    def _snapshot(self) -> Tuple[Segment, ...]:
+        """
+        Returns the main posting lists followed by the delta segments.
+        """
+        with self._lock:
+            return (Segment(self.words_ids, self.frequencies, self.positions, self.deleted), *self.segments)
+
+    @staticmethod
+    def _live_postings(word: str, layers: Tuple[Segment, ...]) -> List[int]:
+        """
+        Returns the posting list of the word merged across the segments without the deleted documents.
+        """
+        posting_lists = []
+        for layer in layers:
+            postings = layer.words_ids.get(word)
+            if postings and layer.deleted:
+                postings = [doc_id for doc_id in postings if doc_id not in layer.deleted]
+            if postings:
+                posting_lists.append(postings)
+        if len(posting_lists) == 1:
+            return posting_lists[0]
+        return list(heapq.merge(*posting_lists))
+
+    @staticmethod
+    def _live_payloads(word: str, layers: Tuple[Segment, ...], payload: str) -> dict:
+        """
+        Returns frequencies or positions of the word by documents merged across the segments, later segments win.
+        """
+        if len(layers) == 1:
+            return getattr(layers[0], payload).get(word, {})
+        merged = {}
+        for layer in layers:
+            merged.update(getattr(layer, payload).get(word, ()))
+        return merged
+
+    def _iter_live_postings(self, layers: Tuple[Segment, ...]) -> Iterator[Tuple[str, List[int]]]:
+        """
+        Yields the live posting lists of all words in ascending order of their utf-8 representation.
+        """
+        if len(layers) == 1 and not layers[0].deleted:
+            words_ids = layers[0].words_ids
+            for word in sorted(words_ids, key=lambda term: term.encode('utf-8')):
+                yield word, sorted(words_ids[word])
+            return
+        words = set(layers[0].words_ids).union(*(layer.words_ids for layer in layers[1:]))
+        for word in sorted(words, key=lambda term: term.encode('utf-8')):
+            postings = self._live_postings(word, layers)
+            if postings:
+                yield word, postings
+
+    def postings(self, word: str):
+        """
+        Returns the ascending posting list of the word, an empty list if the word is not in the index.
+        """
+        generation = self.cache.generation
+        return self._postings(word, self._snapshot(), generation)
+
+    def _postings(self, word: str, layers: Tuple[Segment, ...], generation: int = None):
+        """
+        Returns the live posting list of the word, lists which have to be decoded or merged are cached.
+        Words with * or ~ are patterns, their posting list is the union of the posting lists of the matching terms.
+        Words which are not valid patterns, e.g. * alone or word~3, are literal terms and match nothing.
+        """
+        is_pattern = ('*' in word or '~' in word) and _is_term_pattern(word)
+        if (not is_pattern and len(layers) == 1 and not layers[0].deleted
+                and isinstance(layers[0].words_ids, (dict, Vocabulary))):
+            return layers[0].words_ids.get(word, [])
+        key = ('postings', word)
+        postings = self.cache.get(key)
+        if postings is None:
+            if generation is None:
+                generation = self.cache.generation
+            if is_pattern:
+                posting_lists = [self._live_postings(term, layers) for term in self._expand(word, layers)]
+                postings = [doc_id for doc_id, _ in groupby(heapq.merge(*posting_lists))]
+            elif len(layers) == 1 and not layers[0].deleted:
+                postings = layers[0].words_ids.get(word, [])
+            else:
+                postings = self._live_postings(word, layers)
+            self.cache.put(key, postings, _cached_size(postings), generation)
+        return postings
+
+    def _dictionaries(self, layers: Tuple[Segment, ...]) -> List[TermDictionary]:
+        """
+        Returns the term dictionaries of the segments, dictionaries of merged segments are dropped.
+        """
+        dictionaries = {}
+        for layer in layers:
+            entry = self._term_dictionaries.get(id(layer.words_ids))
+            if entry is None or entry[0] is not layer.words_ids:
+                entry = (layer.words_ids, TermDictionary(layer.words_ids))
+            dictionaries[id(layer.words_ids)] = entry
+        self._term_dictionaries = dictionaries
+        return [dictionary for _, dictionary in dictionaries.values()]
+
+    def _expand(self, pattern: str, layers: Tuple[Segment, ...]) -> List[str]:
+        if not _is_term_pattern(pattern):
+            raise ValueError(f"unsupported pattern {pattern!r}, use prefix*, *suffix, prefix*suffix, word~ or word~2")
+        prefix, suffix, word, distance = TERM_PATTERN.fullmatch(pattern).groups()
+        terms = set()
+        for dictionary in self._dictionaries(layers):
+            if word is not None:
+                terms.update(dictionary.fuzzy(word, int(distance or 1)))
+            elif prefix:
+                terms.update(term for term in dictionary.prefix(prefix)
+                             if term.endswith(suffix) and len(term) >= len(prefix) + len(suffix))
+            else:
+                terms.update(dictionary.suffix(suffix))
+        return sorted(terms)
+
+    def expand(self, pattern: str) -> List[str]:
+        """
+        Returns the terms matching the pattern: prefix* and *suffix, prefix*suffix, or word~ and word~2
+        for the terms within the edit distance of 1 or 2 from the word.
+        :param pattern: pattern of terms
+        :return: List[str] of matching terms in ascending order
+        """
+        return self._expand(pattern, self._snapshot())
+
+    def term_positions(self, word: str) -> Dict[int, List[int]]:
+        """
+        Returns positions of the word by documents, requires an index built with positions.
+        """
+        if not self.with_positions:
+            raise ValueError("phrase queries require an index built with positions")
+        return self._live_payloads(word, self._snapshot(), 'positions')
+
+    def query(self, words: List[str]) -> List[int]:
+        """
+        Returns the list of relevant documents for the given query.
+        Takes the posting list of each word in the query (or an empty list if the word is not in the index)
+        and intersects the sorted lists starting from the shortest one.
+        Answers are cached by the sorted distinct words of the query.
+        """
+        key = ('query', tuple(sorted(set(words))))
+        doc_ids = self.cache.get(key)
+        if doc_ids is None:
+            generation = self.cache.generation
+            layers = self._snapshot()
+            doc_ids = tuple(iter_intersection([self._postings(word, layers, generation) for word in key[1]]))
+            self.cache.put(key, doc_ids, _cached_size(doc_ids), generation)
+        return list(doc_ids)
+
+    def iter_query(self, words: List[str]) -> Iterator[int]:
+        """
+        Lazily yields the relevant documents for the given query, a cached answer is yielded without copying.
+        Answers computed lazily are not cached, the caller may stop before the end.
+        """
+        doc_ids = self.cache.get(('query', tuple(sorted(set(words)))))
+        if doc_ids is not None:
+            return iter(doc_ids)
+        return iter_intersection([self.postings(word) for word in set(words)])
+
+    def query_batch(self, queries: List[List[str]]) -> List[List[int]]:
+        """
+        Returns the lists of relevant documents for every query of the batch in the order of the queries.
+        Words are collected from all queries first, so the posting list of a word shared by many queries
+        is fetched and decoded once for the whole batch.
+        """
+        generation = self.cache.generation
+        layers = self._snapshot()
+        words = {word for query in queries for word in query}
+        posting_lists = {word: self._postings(word, layers, generation) for word in words}
+        answers = {}
+        for query in queries:
+            key = tuple(sorted(set(query)))
+            if key not in answers:
+                answers[key] = list(iter_intersection([posting_lists[word] for word in key]))
+        return [list(answers[tuple(sorted(set(query)))]) for query in queries]
+
+    def _ranked_terms(self, words: List[str], weight: float = 1.0) -> list:
+        """
+        Returns the score upper bound, the weighted idf, the posting list, the frequencies by documents,
+        the lengths of documents and their average length of every word found in the index.
+        """
+        if not self.with_frequencies:
+            raise ValueError("ranked retrieval requires an index built with frequencies")
+        generation = self.cache.generation
+        layers = self._snapshot()
+        doc_lengths = self.doc_lengths
+        documents = len(doc_lengths)
+        if not documents:
+            return []
+        average_length = doc_lengths.average()
+        terms = []
+        for word in dict.fromkeys(words):
+            postings, frequencies, max_frequency = self._ranked_postings(word, layers, generation)
+            if not postings:
+                continue
+            idf = weight * math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            # the score grows with the frequency and is the largest for the shortest documents
+            upper_bound = idf * (BM25_K1 + 1) * max_frequency / (max_frequency + BM25_K1 * (1 - BM25_B))
+            terms.append((upper_bound, idf, postings, frequencies, doc_lengths, average_length))
+        return terms
+
+    def _ranked_postings(self, word: str, layers: Tuple[Segment, ...], generation: int) -> tuple:
+        """
+        Returns the live posting list of the word, its frequencies by documents and the largest frequency,
+        which is read from the segments instead of the frequencies. The three are cached together.
+        """
+        key = ('ranked', word)
+        entry = self.cache.get(key)
+        if entry is None:
+            postings = self._live_postings(word, layers)
+            frequencies = self._live_payloads(word, layers, 'frequencies') if postings else {}
+            max_frequency = 0
+            for layer in layers if postings else ():
+                if isinstance(layer.words_ids, SegmentReader):
+                    max_frequency = max(max_frequency, layer.words_ids.max_frequency(word))
+                else:
+                    max_frequency = max(max_frequency, max(layer.frequencies.get(word, {}).values(), default=0))
+            entry = (postings, frequencies, max_frequency)
+            self.cache.put(key, entry, _cached_size(postings) + len(frequencies) * FREQUENCY_MEMORY_ESTIMATE,
+                           generation)
+        return entry
+
+    def query_ranked(self, words: List[str], k: int = DEFAULT_TOP_K,
+                     boosts: Dict[str, float] = None) -> List[Tuple[int, float]]:
+        """
+        Returns the k documents with the best BM25 score for any of the words, the best first.
+        Documents are evaluated in the order of identifiers with the MaxScore strategy: terms whose
+        summed score upper bounds cannot lift a document into the current top k are not iterated,
+        they are only looked up for documents found in the other posting lists.
+        :param words: query terms
+        :param k: number of documents to return
+        :param boosts: weights of fields, the BM25 score of the words in every field times its weight
+        is added to the score of the document
+        :return: List[Tuple[int, float]] of document identifiers with their scores
+        """
+        if not self.with_frequencies:
+            raise ValueError("ranked retrieval requires an index built with frequencies")
+        if k <= 0:
+            return []
+        terms = self._ranked_terms(words)
+        for field, boost in (boosts or {}).items():
+            terms += self.field(field)._ranked_terms(words, boost)
+        terms.sort(key=itemgetter(0))
+        bounds = list(accumulate(term[0] for term in terms))
+        iterators = [iter(term[2]) for term in terms]
+        current = [next(iterator) for iterator in iterators]
+
+        def score(term: int, doc_id: int) -> float:
+            _, idf, _, frequencies, doc_lengths, average_length = terms[term]
+            frequency = frequencies.get(doc_id, 0)
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths.get(doc_id, average_length) / average_length)
+            return idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+        top = []
+        threshold = 0.0
+        # terms before the first essential one can not make a document enter the top on their own
+        essential = 0
+        while True:
+            candidates = [doc_id for doc_id in current[essential:] if doc_id is not None]
+            if not candidates:
+                break
+            doc_id = min(candidates)
+            total = 0.0
+            for term in range(essential, len(terms)):
+                if current[term] == doc_id:
+                    total += score(term, doc_id)
+                    current[term] = next(iterators[term], None)
+            for term in range(essential - 1, -1, -1):
+                if total + bounds[term] <= threshold:
+                    break
+                total += score(term, doc_id)
+            if len(top) < k:
+                heapq.heappush(top, (total, -doc_id))
+            elif total > top[0][0]:
+                heapq.heapreplace(top, (total, -doc_id))
+            if len(top) == k:
+                threshold = top[0][0]
+                while essential < len(terms) and bounds[essential] <= threshold:
+                    essential += 1
+        return [(-negative_doc_id, total) for total, negative_doc_id in sorted(top, reverse=True)]
+
+    def search(self, expression: str, tokenizer: 'Tokenizer' = None) -> Iterator[int]:
+        """
+        Lazily yields documents matching the expression of the query language in ascending order, e.g.
+        'python AND (code OR "source code") AND NOT snake'. Phrases require an index built with positions.
+        :param expression: query
+        :param tokenizer: Tokenizer normalizing words of the query, the default one drops the stop words
+        :return: Iterator[int]
+        """
+        query = QueryParser(tokenizer).parse(expression)
+        if query is None:
+            return iter(())
+        return iter_cursor(query.cursor(self))
+
+    def field(self, name: str) -> 'InvertedIndex':
+        """
+        Returns the index of the field, queries to it only touch the posting lists of the field.
+        :param name: name of the field, title or body
+        :return: InvertedIndex of the field
+        """
+        try:
+            return self.fields[name]
+        except KeyError:
+            raise ValueError(f"the index has no {name} field, build it with --fields {name}") from None
+
+    def add_documents(self, documents: Dict[int, str], tokenizer: 'Tokenizer' = None) -> None:
+        """
+        Indexes the documents into a new delta segment. Documents with identifiers which are already
+        in the index replace the previous versions. Once there are more than max_delta_segments
+        segments, they are merged in the background. The documents are split into fields the way
+        the field indexes were built and added to them as well.
+        :param documents: dict with documents
+        :param tokenizer: Tokenizer splitting documents into terms
+        :return: None
+        """
+        self.delete_documents(documents)
+        delta = build_inverted_index(documents, tokenizer, self.with_frequencies, self.with_positions)
+        with self._lock:
+            self.segments += (Segment(delta.words_ids, delta.frequencies, delta.positions,
+                                      documents=frozenset(documents)),)
+            self.doc_lengths.update(delta.doc_lengths)
+            merge_needed = len(self.segments) > self.max_delta_segments
+        self.cache.clear()
+        for name, field_index in self.fields.items():
+            title_from = field_index.metadata.get('title_from', 'sentence')
+            field_index.add_documents(dict(iter_field(documents.items(), name, title_from)), tokenizer)
+        if merge_needed:
+            self.merge_in_background()
+
+    def delete_documents(self, doc_ids: Iterable[int]) -> None:
+        """
+        Marks the documents as deleted in every segment and field, their postings are dropped by the next merge.
+        :param doc_ids: identifiers of the documents
+        :return: None
+        """
+        if self.fields:
+            doc_ids = list(doc_ids)
+            for field in self.fields.values():
+                field.delete_documents(doc_ids)
+        with self._lock:
+            # documents of the main posting lists are not known, every deletion is recorded there
+            tombstones = [(self.deleted, None), *((segment.deleted, segment.documents) for segment in self.segments)]
+            for doc_id in doc_ids:
+                for deleted, documents in tombstones:
+                    if documents is None or doc_id in documents:
+                        deleted.add(doc_id)
+                self.doc_lengths.pop(doc_id, None)
+                if self._pending_deletes is not None:
+                    self._pending_deletes.append(doc_id)
+        self.cache.clear()
+
+    def merge(self) -> None:
+        """
+        Compacts the delta segments and the tombstones into the main posting lists.
+        Queries and updates are served while the merge runs, deletions made meanwhile are kept as tombstones.
+        Main posting lists kept in memory are merged in memory. Memory-mapped ones are merged with the deltas
+        into a new segment file next to them, which is memory-mapped in their place, so the merged index
+        keeps taking memory only for the posting lists queries decode.
+        :return: None
+        """
+        with self._merge_lock:
+            layers = self._snapshot()
+            if len(layers) == 1 and not layers[0].deleted:
+                return
+            with self._lock:
+                self._pending_deletes = []
+            if isinstance(layers[0].words_ids, (dict, Vocabulary)):
+                merged = self._merge_in_memory(layers)
+            else:
+                merged = self._merge_to_segment(layers)
+            with self._lock:
+                self.words_ids, self.frequencies, self.positions = merged
+                self.deleted = Tombstones(self._pending_deletes)
+                self.segments = self.segments[len(layers) - 1:]
+                self._pending_deletes = None
+
+    def _merge_in_memory(self, layers: Tuple[Segment, ...]) -> Tuple[dict, dict, dict]:
+        merged = dict(self._iter_live_postings(layers))
+        merged_payloads = {'frequencies': {}, 'positions': {}}
+        for payload, enabled in (('frequencies', self.with_frequencies), ('positions', self.with_positions)):
+            if not enabled:
+                continue
+            for word, postings in merged.items():
+                payloads = self._live_payloads(word, layers, payload)
+                merged_payloads[payload][word] = {doc_id: payloads[doc_id] for doc_id in postings}
+        return merged, merged_payloads['frequencies'], merged_payloads['positions']
+
+    def _merge_to_segment(self, layers: Tuple[Segment, ...]) -> Tuple[Mapping, Mapping, Mapping]:
+        filepath = getattr(layers[0].words_ids, 'filepath', None)
+        directory = os.path.dirname(os.path.abspath(filepath)) if filepath is not None else None
+        descriptor, merged_path = tempfile.mkstemp(prefix='merged-', suffix='.segment', dir=directory)
+        os.close(descriptor)
+        try:
+            self._write_segment(layers, merged_path)
+            reader = SegmentReader(merged_path)
+        finally:
+            # the mapping stays readable after the file is removed, where removing it is not allowed it is left
+            try:
+                os.remove(merged_path)
+            except OSError:
+                pass
+        return (reader,
+                SegmentPayloads(reader, reader.frequencies) if reader.has_frequencies else {},
+                SegmentPayloads(reader, reader.positions) if reader.has_positions else {})
+
+    def merge_in_background(self) -> threading.Thread:
+        """
+        Runs merge in a daemon thread.
+        :return: the started thread
+        """
+        thread = threading.Thread(target=self.merge, daemon=True)
+        thread.start()
+        return thread
+
+    def compact(self, skip_interval: int = DEFAULT_SKIP_INTERVAL) -> None:
+        """
+        Replaces posting lists with CompressedPostings, which take a few bytes per posting instead of a list slot
+        and an integer object. Queries decode only the blocks of the longer lists their cursors seek into.
+        Posting lists of dense terms are replaced with RoaringPostings instead.
+        Only indexes built in memory by the library need it: loaded indexes, the ones the CLI queries and serves,
+        keep posting lists encoded in the memory-mapped segment and decode the ones queries touch.
+        :param skip_interval: number of postings between skip pointers
+        :return: None
+        """
+        self.words_ids = {word: self._compact_postings(doc_ids, skip_interval)
+                          for word, doc_ids in self.words_ids.items()}
+
+    @staticmethod
+    def _compact_postings(doc_ids, skip_interval: int):
+        if isinstance(doc_ids, (CompressedPostings, RoaringPostings)):
+            return doc_ids
+        if is_dense(doc_ids):
+            return RoaringPostings.from_sorted(doc_ids)
+        return CompressedPostings(doc_ids, skip_interval)
+
+    def dump(self, filepath: str) -> None:
+        """
+        Allow us to write inverted indexes documents to temporary directory or local storage.
+        The index is written as a binary segment to a temporary file which then replaces the target,
+        so an index that is memory-mapped from the same path stays readable.
+        :param filepath: path to file with documents
+        :return: None
+        """
+        temporary_path = filepath + '.tmp'
+        self._write_segment(self._snapshot(), temporary_path)
+        os.replace(temporary_path, filepath)
+        for field, field_index in self.fields.items():
+            field_index.dump(field_path(filepath, field))
+        if _metrics is not None:
+            _metrics.count('bytes_written', os.path.getsize(filepath))
+
+    def _write_segment(self, layers: Tuple[Segment, ...], filepath: str) -> None:
+        """
+        Writes the live posting lists of the segments with their payloads to a binary segment.
+        """
+        with _stage('dump'), SegmentWriter(filepath, self.with_frequencies, self.with_positions) as writer:
+            for word, postings in self._iter_live_postings(layers):
+                frequencies = positions = None
+                if self.with_frequencies:
+                    payloads = self._live_payloads(word, layers, 'frequencies')
+                    frequencies = [payloads[doc_id] for doc_id in postings]
+                if self.with_positions:
+                    payloads = self._live_payloads(word, layers, 'positions')
+                    positions = [payloads[doc_id] for doc_id in postings]
+                writer.add(word, postings, frequencies, positions)
+            writer.set_document_lengths(self.doc_lengths)
+            writer.set_metadata(self.metadata)
+
+    @classmethod
+    def load(cls, filepath: str):
+        """
+        Allow us to upload inverted indexes from either temporary directory or local storage.
+        Binary segments and indexes dumped as json by the previous versions are memory-mapped,
+        posting lists are decoded when a query looks them up and kept in the cache of the index.
+        :param filepath: path to file with documents
+        :return: InvertedIndex
+        """
+        with open(filepath, 'rb') as file:
+            magic = file.read(len(SEGMENT_MAGIC))
+        if magic == SHARD_MANIFEST_MAGIC:
+            raise ValueError(f"{filepath} is a sharded index, open it with ShardedIndex.load or open_index")
+        if magic == SEGMENT_MAGIC:
+            reader = SegmentReader(filepath)
+            inverted_index = cls(reader,
+                                 SegmentPayloads(reader, reader.frequencies) if reader.has_frequencies else None,
+                                 reader.document_lengths(),
+                                 SegmentPayloads(reader, reader.positions) if reader.has_positions else None)
+            inverted_index.metadata = reader.metadata
+        else:
+            inverted_index = cls(JsonPostings(filepath))
+        for field in FIELDS:
+            if os.path.exists(field_path(filepath, field)):
+                inverted_index.fields[field] = cls.load(field_path(filepath, field))
+        return inverted_index
+
+
+def field_path(index: str, field: str) -> str:
+    """
+    Returns the path of the index of the field written next to the index.
+    """
+    return f'{index}.field-{field}'
+
+
+def split_title(content: str, title_from: str = 'sentence') -> Tuple[str, str]:
+    """
+    Splits the document into the title and the body.
+    :param content: text of the document
+    :param title_from: 'sentence' takes the first sentence as the title, a document without the end
+    of a sentence is all title; 'column' takes the text before the first tab, the rest is the body
+    :return: Tuple[str, str] of the title and the body
+    """
+    if title_from == 'column':
+        title, _, body = content.partition('\t')
+        return title, body
+    match = FIRST_SENTENCE_PATTERN.match(content)
+    if match is None:
+        return content, ''
+    return match.group(), content[match.end():]
+
+
+def iter_field(documents: Iterable[Tuple[int, str]], field: str,
+               title_from: str = 'sentence') -> Iterator[Tuple[int, str]]:
+    """
+    Lazily yields (doc_id, text of the field) pairs of the documents, a document without the field yields ''.
+    """
+    for doc_id, content in documents:
+        if not isinstance(content, str):
+            content = str(content, 'utf-8')
+        title, body = split_title(content, title_from)
+        yield doc_id, title if field == 'title' else body
+
+
+def iter_documents(filepath: str, start: int = 0, end: int = None,
+                   lowercase: bool = True) -> Iterator[Tuple[int, str]]:
+    """
+    Streams documents from either temporary directory or local storage one line at a time
+    :param filepath: path to file with documents
+    :param start: byte offset of the first line to read
+    :param end: byte offset to stop reading at, the end of file by default
+    :param lowercase: lowercase the documents
+    :return: Iterator[Tuple[int, str]]
+    """
+    with open(filepath, 'rb') as dataset:
+        dataset.seek(start)
+        position = start
+        for line in dataset:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            doc_id, content = line.decode('utf8').rstrip('\r\n').split('\t', 1)
+            yield int(doc_id), content.lower() if lowercase else content
+
+
+def split_dataset(filepath: str, parts: int) -> List[Tuple[int, int]]:
+    """
+    Splits the file with documents into byte ranges of roughly equal size which start and end on line boundaries.
+    :param filepath: path to file with documents
+    :param parts: desired number of ranges
+    :return: List[Tuple[int, int]] of non-empty (start, end) ranges
+    """
+    size = os.path.getsize(filepath)
+    boundaries = [0]
+    with open(filepath, 'rb') as dataset:
+        for part in range(1, parts):
+            target = max(size * part // parts, boundaries[-1])
+            if target == 0:
+                continue
+            # move to the beginning of the line following the byte before the target
+            dataset.seek(target - 1)
+            dataset.readline()
+            boundaries.append(min(dataset.tell(), size))
+    boundaries.append(size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:]) if start < end]
+
+
+class Dataset(Mapping):
+    """
+    Read-only mapping of document identifiers to documents backed by the memory-mapped file with documents.
+    A single pass over the mapping records the byte offset of every line and its identifier in arrays,
+    documents are handed out as memoryview slices of the mapping, so they are not copied until tokenized.
+    Pages of the mapping belong to the page cache and are shared by every process mapping the same file,
+    a pickled Dataset maps the file again in the worker instead of copying the documents.
+    """
+    def __init__(self, filepath: str, start: int = 0, end: int = None):
+        self.filepath = filepath
+        self.start = start
+        self.end = end
+        with open(filepath, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._view = memoryview(self._mmap)
+        end = size if end is None else min(end, size)
+        # offsets of the lines followed by the end of the last one
+        self._offsets = array('Q')
+        self._doc_ids = array('Q')
+        ordered = True
+        position = start
+        while position < end:
+            newline = self._mmap.find(b'\n', position, end)
+            newline = end if newline < 0 else newline
+            tab = self._mmap.find(b'\t', position, newline)
+            if tab < 0:
+                raise ValueError(f'{filepath}: the line at byte {position} has no tab after the document identifier')
+            doc_id = int(self._mmap[position:tab])
+            if ordered and self._doc_ids and doc_id <= self._doc_ids[-1]:
+                ordered = False
+            self._offsets.append(position)
+            self._doc_ids.append(doc_id)
+            position = newline + 1
+        self._offsets.append(min(position, end))
+        if ordered:
+            self._sorted_ids, self._order = self._doc_ids, None
+        else:
+            self._sorted_ids, self._order = self._sort()
+
+    def __reduce__(self):
+        return Dataset, (self.filepath, self.start, self.end)
+
+    def _sort(self) -> Tuple[array, array]:
+        """
+        Returns identifiers in ascending order with the numbers of their lines, the last line wins for duplicates.
+        """
+        doc_ids = self._doc_ids
+        sorted_ids, order = array('Q'), array('Q')
+        for number in sorted(range(len(doc_ids)), key=doc_ids.__getitem__):
+            if sorted_ids and sorted_ids[-1] == doc_ids[number]:
+                order[-1] = number
+            else:
+                sorted_ids.append(doc_ids[number])
+                order.append(number)
+        return sorted_ids, order
+
+    def content(self, number: int) -> memoryview:
+        """
+        Returns the document of the line with the number, without the identifier and the line break.
+        """
+        start, end = self._offsets[number], self._offsets[number + 1]
+        start = self._mmap.find(b'\t', start, end) + 1
+        while end > start and self._mmap[end - 1] in b'\r\n':
+            end -= 1
+        return self._view[start:end]
+
+    def iter_lines(self) -> Iterator[Tuple[int, memoryview]]:
+        """
+        Lazily yields (doc_id, content) pairs in order of the lines of the file.
+        :return: Iterator[Tuple[int, memoryview]]
+        """
+        for number, doc_id in enumerate(self._doc_ids):
+            yield doc_id, self.content(number)
+
+    def __getitem__(self, doc_id: int) -> memoryview:
+        position = bisect_left(self._sorted_ids, doc_id)
+        if position == len(self._sorted_ids) or self._sorted_ids[position] != doc_id:
+            raise KeyError(doc_id)
+        return self.content(position if self._order is None else self._order[position])
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._sorted_ids)
+
+    def __len__(self) -> int:
+        return len(self._sorted_ids)
+
+
+def load_documents(filepath: str) -> Dict[int, str]:
+    """
+    Allow us to upload documents from either tempopary directory or local storage
+    :param filepath: path to file with documents
+    :return: Dict[int, str]
+    """
+    return dict(iter_documents(filepath))
+
+
+@lru_cache(maxsize=None)
+def load_stop_words(filepath: str = PATH_TO_STOP_WORDS) -> FrozenSet[str]:
+    """
+    Loads stop words once per process, subsequent calls return the same frozenset
+    :param filepath: path to file with a stop word per line
+    :return: FrozenSet[str]
+    """
+    with open(filepath, 'r', encoding='utf-8') as file_stop:
+        return frozenset(stop_word.strip().lower() for stop_word in file_stop)
+
+
+class TermFilter:
+    """
+    Prepared filter of tokens: lowercases every token and drops empty tokens and stop words in the same pass.
+    Stop words are kept in a frozenset, so every check is a single hash lookup.
+    """
+    def __init__(self, stop_words: Iterable[str] = None):
+        self.stop_words = load_stop_words() if stop_words is None else frozenset(stop_words)
+
+    def __call__(self, tokens: Iterable[str]) -> Iterator[str]:
+        stop_words = self.stop_words
+        for token in tokens:
+            term = token.lower()
+            if term and term not in stop_words:
+                yield term
+
+
+class Tokenizer:
+    """
+    Tokenizer pipeline: lowercase, split with the precompiled pattern, drop stop words,
+    optionally stem and deduplicate. The pattern, the term filter and the stemmer are pluggable.
+    """
+    def __init__(self, term_filter: TermFilter = None, stemmer: Callable[[str], str] = None,
+                 pattern: Pattern = TOKEN_PATTERN):
+        self.term_filter = term_filter if term_filter is not None else TermFilter()
+        self.stemmer = stemmer
+        self.pattern = pattern
+
+    def tokens(self, content: str) -> Iterator[str]:
+        """
+        Lazily yields normalized terms of the content in order of occurrence, duplicates included.
+        :param content: text of the document
+        :return: Iterator[str]
+        """
+        terms = self.term_filter(match.group() for match in self.pattern.finditer(content))
+        if self.stemmer is None:
+            return terms
+        return map(self.stemmer, terms)
+
+    def positions(self, content: str) -> Dict[str, List[int]]:
+        """
+        Returns positions of normalized terms in the content. Positions count every token,
+        stop words included, so the distance between terms is the same as in the text.
+        :param content: text of the document
+        :return: Dict[str, List[int]]
+        """
+        stop_words = self.term_filter.stop_words
+        stemmer = self.stemmer
+        positions = {}
+        for position, match in enumerate(self.pattern.finditer(content)):
+            term = match.group().lower()
+            if term in stop_words:
+                continue
+            if stemmer is not None:
+                term = stemmer(term)
+            if term in positions:
+                positions[term].append(position)
+            else:
+                positions[term] = [position]
+        return positions
+
+    def terms(self, content: str) -> Set[str]:
+        """
+        Returns distinct normalized terms of the content.
+        Splitting, deduplication and stop words removal all run inside findall and set operations.
+        :param content: text of the document
+        :return: Set[str]
+        """
+        terms = set(self.pattern.findall(content.lower()))
+        terms -= self.term_filter.stop_words
+        if self.stemmer is not None:
+            terms = {self.stemmer(term) for term in terms}
+        return terms
+
+    def counted_terms(self, content: str) -> Tuple[Set[str], int]:
+        """
+        Returns distinct normalized terms of the content with the number of its tokens, stop words excluded,
+        both taken from the same findall.
+        :param content: text of the document
+        :return: Tuple[Set[str], int]
+        """
+        words = self.pattern.findall(content.lower())
+        stop_words = self.term_filter.stop_words
+        terms = set(words)
+        terms -= stop_words
+        if self.stemmer is not None:
+            terms = {self.stemmer(term) for term in terms}
+        return terms, len(words) - sum(map(stop_words.__contains__, words))
+
+
+class AndCursor:
+    """
+    Cursor over documents found by every included cursor and by none of the excluded ones.
+    The cursors leapfrog: each seeks to the candidate proposed by the previous one until they agree.
+    """
+    __slots__ = ('_included', '_excluded')
+
+    def __init__(self, included: list, excluded: list = ()):
+        self._included = included
+        self._excluded = excluded
+
+    def seek(self, target: int) -> Optional[int]:
+        candidate = target
+        while True:
+            for cursor in self._included:
+                doc_id = cursor.seek(candidate)
+                if doc_id is None:
+                    return None
+                if doc_id != candidate:
+                    candidate = doc_id
+                    break
+            else:
+                if any(cursor.seek(candidate) == candidate for cursor in self._excluded):
+                    candidate += 1
+                    continue
+                return candidate
+
+
+class OrCursor:
+    """
+    Cursor over documents found by any of the cursors.
+    """
+    __slots__ = ('_cursors',)
+
+    def __init__(self, cursors: list):
+        self._cursors = cursors
+
+    def seek(self, target: int) -> Optional[int]:
+        found = [doc_id for doc_id in (cursor.seek(target) for cursor in self._cursors) if doc_id is not None]
+        return min(found) if found else None
+
+
+class PhraseCursor:
+    """
+    Cursor over documents where the terms occur at the given offsets from each other.
+    Documents with all the terms are found by AndCursor, then their positions are checked.
+    """
+    __slots__ = ('_offsets', '_documents', '_positions')
+
+    def __init__(self, index: InvertedIndex, terms: List[Tuple[int, str]]):
+        self._offsets = [offset for offset, _ in terms]
+        self._documents = AndCursor([make_cursor(index.postings(word)) for _, word in terms])
+        self._positions = [index.term_positions(word) for _, word in terms]
+
+    def _matches(self, doc_id: int) -> bool:
+        first_offset, *offsets = self._offsets
+        first_positions, *positions = self._positions
+        positions = [set(term_positions[doc_id]) for term_positions in positions]
+        for position in first_positions[doc_id]:
+            start = position - first_offset
+            if all(start + offset in term_positions for offset, term_positions in zip(offsets, positions)):
+                return True
+        return False
+
+    def seek(self, target: int) -> Optional[int]:
+        while True:
+            doc_id = self._documents.seek(target)
+            if doc_id is None or self._matches(doc_id):
+                return doc_id
+            target = doc_id + 1
+
+
+class TermQuery:
+    """
+    Documents containing the term.
+    """
+    def __init__(self, word: str):
+        self.word = word
+
+    def cursor(self, index: InvertedIndex):
+        return make_cursor(index.postings(self.word))
+
+
+class PhraseQuery:
+    """
+    Documents containing the terms at the given offsets from each other, requires positional postings.
+    """
+    def __init__(self, terms: List[Tuple[int, str]]):
+        self.terms = terms
+
+    def cursor(self, index: InvertedIndex):
+        return PhraseCursor(index, self.terms)
+
+
+class NotQuery:
+    """
+    Documents without the matches of the subquery, allowed only as a part of AND.
+    """
+    def __init__(self, query):
+        self.query = query
+
+    def cursor(self, index: InvertedIndex):
+        raise ValueError("NOT must be combined with a positive term, e.g. python AND NOT snake")
+
+
+class AndQuery:
+    """
+    Documents matching every subquery.
+    """
+    def __init__(self, queries: list):
+        self.queries = queries
+
+    def cursor(self, index: InvertedIndex):
+        included = [query.cursor(index) for query in self.queries if not isinstance(query, NotQuery)]
+        if not included:
+            raise ValueError("NOT must be combined with a positive term, e.g. python AND NOT snake")
+        excluded = [query.query.cursor(index) for query in self.queries if isinstance(query, NotQuery)]
+        return AndCursor(included, excluded)
+
+
+class OrQuery:
+    """
+    Documents matching any of the subqueries.
+    """
+    def __init__(self, queries: list):
+        self.queries = queries
+
+    def cursor(self, index: InvertedIndex):
+        return OrCursor([query.cursor(index) for query in self.queries])
+
+
+class QueryParser:
+    """
+    Parser of the query language: terms, quoted phrases, AND, OR, NOT and parentheses.
+    AND binds tighter than OR, terms next to each other are joined with AND.
+    Words are normalized with the tokenizer of the index, stop words are ignored.
+    Words with * or ~ are patterns of terms, see InvertedIndex.expand.
+    """
+    keywords = ('AND', 'OR', 'NOT')
+
+    def __init__(self, tokenizer: 'Tokenizer' = None):
+        self.tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+        self._tokens = []
+        self._position = 0
+
+    def parse(self, text: str):
+        """
+        Parses the query into a tree of TermQuery, PhraseQuery, AndQuery, OrQuery and NotQuery.
+        :param text: query
+        :return: the root of the tree, None if the query has no terms except stop words
+        """
+        self._tokens = QUERY_TOKEN_PATTERN.findall(text)
+        self._position = 0
+        query = self._parse_or()
+        if self._position < len(self._tokens):
+            raise ValueError(f"unexpected {self._tokens[self._position]!r} in query {text!r}")
+        return query
+
+    def _peek(self) -> Optional[str]:
+        return self._tokens[self._position] if self._position < len(self._tokens) else None
+
+    def _parse_or(self):
+        queries = [self._parse_and()]
+        while self._peek() == 'OR':
+            self._position += 1
+            queries.append(self._parse_and())
+        queries = [query for query in queries if query is not None]
+        if len(queries) <= 1:
+            return queries[0] if queries else None
+        return OrQuery(queries)
+
+    def _parse_and(self):
+        queries = [self._parse_unary()]
+        while self._peek() not in (None, 'OR', ')'):
+            if self._peek() == 'AND':
+                self._position += 1
+            queries.append(self._parse_unary())
+        queries = [query for query in queries if query is not None]
+        if len(queries) <= 1 and not any(isinstance(query, NotQuery) for query in queries):
+            return queries[0] if queries else None
+        return AndQuery(queries)
+
+    def _parse_unary(self):
+        if self._peek() == 'NOT':
+            self._position += 1
+            query = self._parse_unary()
+            return NotQuery(query) if query is not None else None
+        return self._parse_primary()
+
+    def _parse_primary(self):
+        token = self._peek()
+        if token is None or token in self.keywords or token == ')':
+            raise ValueError(f"a term is expected instead of {token or 'the end of query'!r}")
+        self._position += 1
+        if not token.startswith('"') and ('*' in token or '~' in token):
+            return TermQuery(token.lower())
+        if token == '(':
+            query = self._parse_or()
+            if self._peek() != ')':
+                raise ValueError("missing closing parenthesis")
+            self._position += 1
+            return query
+        terms = sorted((position, word) for word, positions in self.tokenizer.positions(token.strip('"')).items()
+                       for position in positions)
+        if not terms:
+            return None
+        if len(terms) == 1:
+            return TermQuery(terms[0][1])
+        if token.startswith('"'):
+            return PhraseQuery(terms)
+        return AndQuery([TermQuery(word) for _, word in terms])
+
+
+def _tokenize_document(content: str, tokenizer: Tokenizer, with_frequencies: bool, with_positions: bool):
+    """
+    Returns positions by terms of the document if positions are kept, counts of terms if frequencies are kept,
+    the set of distinct terms otherwise.
+    """
+    if with_positions:
+        return tokenizer.positions(content)
+    if with_frequencies:
+        return Counter(tokenizer.tokens(content))
+    return tokenizer.terms(content)
+
+
+def _tokenize_counted(content: str, tokenizer: Tokenizer, with_frequencies: bool,
+                      with_positions: bool) -> Tuple[object, int]:
+    """
+    Returns what _tokenize_document returns together with the number of tokens of the document, stop words excluded.
+    """
+    if with_positions:
+        tokens = tokenizer.positions(content)
+        return tokens, sum(len(positions) for positions in tokens.values())
+    if with_frequencies:
+        tokens = Counter(tokenizer.tokens(content))
+        return tokens, sum(tokens.values())
+    return tokenizer.counted_terms(content)
+
+
+def _add_document(inverted: InvertedIndex, doc_id: int, tokens) -> int:
+    """
+    Adds the document identifier to the posting list of every term returned by _tokenize_document.
+    :return: number of the added postings
+    """
+    vocabulary = inverted.words_ids
+    ids = vocabulary.ids
+    postings = vocabulary.postings
+    if not inverted.with_frequencies and not inverted.with_positions:
+        for word in tokens:
+            term_id = ids.get(word)
+            if term_id is None:
+                term_id = vocabulary.add(word)
+            postings[term_id].append(doc_id)
+        return len(tokens)
+    if inverted.with_positions:
+        term_positions = tokens
+        counts = {word: len(positions) for word, positions in term_positions.items()}
+    else:
+        counts = tokens
+    if inverted.with_frequencies:
+        inverted.doc_lengths[doc_id] = sum(counts.values())
+    frequency_lists = vocabulary.frequency_lists
+    position_lists = vocabulary.position_lists
+    for word, count in counts.items():
+        term_id = ids.get(word)
+        if term_id is None:
+            term_id = vocabulary.add(word)
+        postings[term_id].append(doc_id)
+        if frequency_lists is not None:
+            frequency_lists[term_id][doc_id] = count
+        if position_lists is not None:
+            position_lists[term_id][doc_id] = term_positions[word]
+    return len(counts)
+
+
+def _index_document(inverted: InvertedIndex, doc_id: int, content: str, tokenizer: Tokenizer) -> int:
+    """
+    Adds the document identifier to the posting list of every distinct term of the document.
+    Bytes-like content, e.g. a memoryview of Dataset, is decoded here and dropped with the document.
+    :return: number of the added postings
+    """
+    if not isinstance(content, str):
+        content = str(content, 'utf-8')
+    metrics = _metrics
+    if metrics is None:
+        return _add_document(inverted, doc_id, _tokenize_document(content, tokenizer, inverted.with_frequencies,
+                                                                  inverted.with_positions))
+    started = time.perf_counter()
+    tokens, token_count = _tokenize_counted(content, tokenizer, inverted.with_frequencies, inverted.with_positions)
+    tokenized = time.perf_counter()
+    postings = _add_document(inverted, doc_id, tokens)
+    _record_document(metrics, started, tokenized, token_count, postings)
+    return postings
+
+
+def _record_document(metrics: Metrics, started: float, tokenized: float, tokens: int, postings: int) -> None:
+    metrics.add_time('tokenize', tokenized - started)
+    metrics.add_time('index', time.perf_counter() - tokenized)
+    metrics.count('documents')
+    metrics.count('tokens', tokens)
+    metrics.count('postings', postings)
+
+
+def _new_index(with_frequencies: bool, with_positions: bool) -> InvertedIndex:
+    vocabulary = Vocabulary(with_frequencies, with_positions)
+    return InvertedIndex(vocabulary, vocabulary.frequencies, {}, vocabulary.positions)
+
+
+def build_inverted_index(documents: Mapping, tokenizer: Tokenizer = None,
+                         with_frequencies: bool = False, with_positions: bool = False) -> InvertedIndex:
+    """
+    Builder of inverted indexes based on documents
+    :param documents: mapping of identifiers to documents, e.g. dict or Dataset
+    :param tokenizer: Tokenizer splitting documents into terms, the default one drops the stop words
+    :param with_frequencies: keep term frequencies and document lengths for ranked retrieval
+    :param with_positions: keep positions of terms in documents for phrase queries
+    :return: InvertedIndex class.
+    For each document in the input dictionary, the function tokenizes the content of the document into terms.
+    Then removes duplicates from the list of terms and adds the document identifier to the posting list for each term.
+    """
+    inverted = _new_index(with_frequencies, with_positions)
+    tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+    # documents are indexed in ascending order, so the posting lists are sorted as they grow
+    for doc_id, content in sorted(documents.items()):
+        _index_document(inverted, doc_id, content, tokenizer)
+    return inverted
+
+
+def merge_segments(segment_paths: List[str], output: str, metadata: Dict[str, str] = None,
+                   excluded: List[Set[int]] = None) -> None:
+    """
+    Merges binary segments into a single segment with k-way merge of the sorted term dictionaries.
+    Posting lists of the same term are merged as well, so segments may hold interleaving document identifiers.
+    :param segment_paths: paths to segments to merge
+    :param output: path to save the merged segment
+    :param metadata: metadata of the index written with the merged segment
+    :param excluded: identifiers of documents dropped from every segment, aligned with segment_paths
+    :return: None
+    """
+    readers = [SegmentReader(path) for path in segment_paths]
+    with_frequencies = all(reader.has_frequencies for reader in readers)
+    with_positions = all(reader.has_positions for reader in readers)
+    excluded = excluded if excluded is not None else [set()] * len(readers)
+    entries = heapq.merge(*(_drop_documents(reader.entries(), doc_ids) if doc_ids else reader.entries()
+                            for reader, doc_ids in zip(readers, excluded)),
+                          key=lambda entry: entry[0].encode('utf-8'))
+    temporary_path = output + '.tmp'
+    with _stage('merge'), SegmentWriter(temporary_path, with_frequencies, with_positions) as writer:
+        for word, group in groupby(entries, key=itemgetter(0)):
+            group = list(group)
+            if len(group) == 1:
+                _, postings, frequencies, positions = group[0]
+            elif not with_frequencies and not with_positions:
+                writer.add(word, heapq.merge(*(entry[1] for entry in group)))
+                continue
+            else:
+                merged = list(heapq.merge(*(zip(postings, frequencies or repeat(None), positions or repeat(None))
+                                            for _, postings, frequencies, positions in group), key=itemgetter(0)))
+                postings, frequencies, positions = (list(column) for column in zip(*merged))
+            writer.add(word, postings, frequencies if with_frequencies else None,
+                       positions if with_positions else None)
+        if with_frequencies:
+            doc_lengths = {}
+            for reader, doc_ids in zip(readers, excluded):
+                doc_lengths.update((doc_id, length) for doc_id, length in reader.document_lengths().items()
+                                   if doc_id not in doc_ids)
+            writer.set_document_lengths(doc_lengths)
+        if metadata:
+            writer.set_metadata(metadata)
+    os.replace(temporary_path, output)
+    if _metrics is not None:
+        _metrics.count('bytes_written', os.path.getsize(output))
+
+
+def _drop_documents(entries: Iterator[tuple], doc_ids: Set[int]) -> Iterator[tuple]:
+    """
+    Drops the documents from the entries of a segment, terms left without documents are dropped as well.
+    """
+    for entry in entries:
+        word, postings, frequencies, positions = entry
+        if doc_ids.isdisjoint(postings):
+            yield entry
+            continue
+        kept = [posting for posting in zip(postings, frequencies or repeat(None), positions or repeat(None))
+                if posting[0] not in doc_ids]
+        if kept:
+            postings, kept_frequencies, kept_positions = (list(column) for column in zip(*kept))
+            yield (word, postings, kept_frequencies if frequencies is not None else None,
+                   kept_positions if positions is not None else None)
+
+
+class _RunAccumulator:
+    """
+    Posting accumulator of the builds in sorted runs. Postings are accumulated until their estimated size
+    exceeds the memory budget, then the run is handed to the writer thread, which writes it next to the output
+    while the next run is accumulated. At most one run is being written at a time, so at most two runs are in memory.
+    """
+    def __init__(self, output: str, memory_budget: int, with_frequencies: bool, with_positions: bool,
+                 metadata: Dict[str, str] = None):
+        self.output = output
+        self.metadata = metadata if metadata is not None else {}
+        self.memory_budget = memory_budget
+        self.with_frequencies = with_frequencies
+        self.with_positions = with_positions
+        self.posting_memory = (POSTING_MEMORY_ESTIMATE + (FREQUENCY_MEMORY_ESTIMATE if with_frequencies else 0)
+                               + (POSITIONS_MEMORY_ESTIMATE if with_positions else 0))
+        self.run_directory = tempfile.mkdtemp(prefix='runs-', dir=os.path.dirname(os.path.abspath(output)))
+        self.run_paths: List[str] = []
+        self.inverted = _new_index(with_frequencies, with_positions)
+        self.used_memory = 0
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._written: Optional[Future] = None
+
+    def index(self, doc_id: int, content: str, tokenizer: Tokenizer) -> None:
+        """
+        Tokenizes the document and adds it to the current run.
+        """
+        terms_before = len(self.inverted.words_ids)
+        self._account(_index_document(self.inverted, doc_id, content, tokenizer), terms_before)
+
+    def add(self, doc_id: int, tokens, token_count: Optional[int] = None) -> None:
         """
-        Printer of encoder.
+        Adds the document tokenized by _tokenize_document to the current run.
+        The number of tokens of the document, if counted by the tokenizer, goes to the metrics.
         """
-        print(self._encoding)
+        terms_before = len(self.inverted.words_ids)
+        postings = _add_document(self.inverted, doc_id, tokens)
+        if _metrics is not None:
+            _metrics.count('documents')
+            _metrics.count('postings', postings)
+            if token_count is not None:
+                _metrics.count('tokens', token_count)
+        self._account(postings, terms_before)
 
+    def _account(self, postings: int, terms_before: int) -> None:
+        self.used_memory += (postings * self.posting_memory
+                             + (len(self.inverted.words_ids) - terms_before) * TERM_MEMORY_ESTIMATE)
+        if self.used_memory >= self.memory_budget:
+            self._flush()
 
-class InvertedIndex:
+    def _flush(self) -> None:
+        if self._written is not None:
+            self._written.result()
+        self.run_paths.append(os.path.join(self.run_directory, f'run-{len(self.run_paths)}'))
+        self._written = self._writer.submit(self.inverted.dump, self.run_paths[-1])
+        self.inverted = _new_index(self.with_frequencies, self.with_positions)
+        self.used_memory = 0
+
+    def finish(self) -> None:
+        """
+        Writes the index to the output: the postings directly if no run was written, the merged runs otherwise.
+        """
+        if not self.run_paths:
+            self.inverted.metadata = self.metadata
+            self.inverted.dump(self.output)
+            return
+        if self.inverted.words_ids:
+            self._flush()
+        self._written.result()
+        merge_segments(self.run_paths, self.output, self.metadata)
+
+    def close(self) -> None:
+        self._writer.shutdown(wait=True)
+        shutil.rmtree(self.run_directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def build_inverted_index_streaming(documents: Iterable[Tuple[int, str]], output: str,
+                                   memory_budget: int = DEFAULT_MEMORY_BUDGET, tokenizer: Tokenizer = None,
+                                   with_frequencies: bool = False, with_positions: bool = False,
+                                   metadata: Dict[str, str] = None) -> None:
     """
-    The inverted index is a dictionary where the keys are the terms and the values are the lists of document
-    identifiers.
+    Builder of inverted indexes which does not keep the documents or the whole index in memory.
+    Postings are accumulated until their estimated size exceeds the memory budget, then they are
+    flushed to a sorted run file next to the output and the runs are merged into the final index.
+    Runs are written by a thread while the next documents are indexed.
+    :param documents: iterable of (doc_id, content) pairs, e.g. iter_documents
+    :param output: path to save inverted index
+    :param memory_budget: approximate number of bytes the accumulated postings may take
+    :param tokenizer: Tokenizer splitting documents into terms, the default one drops the stop words
+    :param with_frequencies: keep term frequencies and document lengths for ranked retrieval
+    :param with_positions: keep positions of terms in documents for phrase queries
+    :param metadata: metadata of the index written with it, e.g. how the documents of a field index were split
+    :return: None
+    """
+    tokenizer = tokenizer if tokenizer is not None else Tokenizer()
+    with _RunAccumulator(output, memory_budget, with_frequencies, with_positions, metadata) as accumulator:
+        for doc_id, content in documents:
+            accumulator.index(doc_id, content, tokenizer)
+        accumulator.finish()
+
+
+_pipeline_tokenizer: Optional[Tokenizer] = None
+
+
+def _init_pipeline_worker() -> None:
+    """
+    Creates the tokenizer once per worker process of the pipelined build.
+    """
+    global _pipeline_tokenizer
+    _pipeline_tokenizer = Tokenizer()
+
+
+def _tokenize_batch(batch: List[Tuple[int, bytes]], with_frequencies: bool, with_positions: bool,
+                    count_tokens: bool = False) -> List[Tuple[int, object, Optional[int]]]:
+    """
+    Tokenizes the (doc_id, content) pairs of the dataset, runs in a worker process of the pipelined build.
+    Distinct terms are sent back joined into a single string, which pickles several times faster than a set.
+    Numbers of tokens are only counted for the metrics, None is sent back otherwise.
     """
-    def __init__(self, words_ids: Dict[str, List[int]] = None):
-        if words_ids:
-            self.words_ids = words_ids
+    tokenizer = _pipeline_tokenizer if _pipeline_tokenizer is not None else Tokenizer()
+    documents = []
+    for doc_id, content in batch:
+        content = content.decode('utf8')
+        if count_tokens:
+            tokens, token_count = _tokenize_counted(content, tokenizer, with_frequencies, with_positions)
         else:
-            self.words_ids = dict()
+            tokens, token_count = _tokenize_document(content, tokenizer, with_frequencies, with_positions), None
+        documents.append((doc_id, tokens if with_frequencies or with_positions else '\n'.join(tokens),
+                          token_count))
+    return documents
 
-    def query(self, words: List[str]) -> List[int]:
-        """
-        Returns the list of relevant documents for the given query.
-        Creates a set for each word in the query, containing the relevant documents for that word
-        (or an empty set if the word is not in the index).
-        Then finds the intersection of all these sets.
-        """
-        documents = [set(self.words_ids.get(word, [])) for word in words]
-        result = set.intersection(*documents)
-        return list(result)
 
-    def dump(self, filepath: str) -> None:
+def _accumulate_batch(accumulator: _RunAccumulator, documents: List[Tuple[int, object, Optional[int]]]) -> None:
+    for doc_id, tokens, token_count in documents:
+        if isinstance(tokens, str):
+            tokens = tokens.split('\n') if tokens else ()
+        accumulator.add(doc_id, tokens, token_count)
+
+
+def _put(channel: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+    Puts the item to the bounded queue, waiting while it is full, unless the pipeline is stopped.
+    :return: False if the pipeline was stopped
+    """
+    while not stop.is_set():
+        try:
+            channel.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _read_batches(dataset: str, batches: queue.Queue, stop: threading.Event, batch_size: int,
+                  document_store: Optional[str]) -> None:
+    """
+    Reader stage of the pipelined build: reads (doc_id, content) pairs of the dataset in batches and puts them
+    to the queue, then None, or the exception which stopped the reading. Documents are also added to the store
+    if it is set. Documents come in ascending order of identifiers and the last line of an identifier wins,
+    as in Dataset, so the accumulated posting lists are sorted and the index equals the one of the other builds.
+    """
+    try:
+        writer = DocumentStoreWriter(document_store) if document_store is not None else None
+        try:
+            batch = []
+            for doc_id, content in Dataset(dataset).items():
+                content = bytes(content)
+                batch.append((doc_id, content))
+                if writer is not None:
+                    writer.add(doc_id, content.decode('utf8'))
+                if len(batch) == batch_size:
+                    if not _put(batches, batch, stop):
+                        return
+                    batch = []
+            if batch and not _put(batches, batch, stop):
+                return
+        finally:
+            if writer is not None:
+                writer.close()
+    except Exception as error:
+        _put(batches, error, stop)
+        return
+    _put(batches, None, stop)
+
+
+def build_inverted_index_pipelined(dataset: str, output: str, workers: int = 1,
+                                   memory_budget: int = DEFAULT_MEMORY_BUDGET, with_frequencies: bool = False,
+                                   with_positions: bool = False, document_store: str = None,
+                                   batch_size: int = PIPELINE_BATCH_SIZE,
+                                   queue_size: int = PIPELINE_QUEUE_SIZE) -> None:
+    """
+    Builder of inverted indexes whose stages run at the same time: a reader thread reads batches of documents,
+    a pool of processes tokenizes them, the accumulator adds the postings in the order of the batches and
+    the writer thread writes full runs while later input is still being read. Queues between the stages
+    are bounded, so a slow stage makes the earlier ones wait instead of piling up batches in memory.
+    :param dataset: path to file with documents
+    :param output: path to save inverted index
+    :param workers: number of tokenizer processes
+    :param memory_budget: approximate number of bytes the accumulated postings may take
+    :param with_frequencies: keep term frequencies and document lengths for ranked retrieval
+    :param with_positions: keep positions of terms in documents for phrase queries
+    :param document_store: if set, path to write the document store to while reading the dataset
+    :param batch_size: number of documents tokenized by a worker at once
+    :param queue_size: number of batches waiting to be tokenized and being tokenized
+    :return: None
+    """
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_batches, args=(dataset, batches, stop, batch_size, document_store),
+                              daemon=True)
+    with _RunAccumulator(output, memory_budget, with_frequencies, with_positions) as accumulator, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_pipeline_worker) as executor:
+        pending = deque()
+        reader.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                pending.append(executor.submit(_tokenize_batch, batch, with_frequencies, with_positions,
+                                               _metrics is not None))
+                # the oldest batch is accumulated first, so postings are added in ascending order of identifiers
+                while len(pending) >= queue_size or (pending and pending[0].done()):
+                    _accumulate_batch(accumulator, pending.popleft().result())
+            while pending:
+                _accumulate_batch(accumulator, pending.popleft().result())
+        finally:
+            stop.set()
+            reader.join()
+        accumulator.finish()
+
+
+def _build_shard(dataset: str, start: int, end: int, output: str, memory_budget: int,
+                 with_frequencies: bool, with_positions: bool) -> Tuple[str, array]:
+    """
+    Builds the segment of the documents in the byte range of the dataset, runs in a worker process.
+    Documents are indexed in ascending order of identifiers, the last line of an identifier wins as in Dataset.
+    :return: path of the segment and the ascending identifiers of its documents
+    """
+    documents = Dataset(dataset, start, end)
+    build_inverted_index_streaming(documents.items(), output, memory_budget,
+                                   with_frequencies=with_frequencies, with_positions=with_positions)
+    return output, array('Q', documents)
+
+
+def _superseded_documents(range_doc_ids: List[array]) -> List[Set[int]]:
+    """
+    Returns the identifiers of every byte range which are also in a later range, whose lines win.
+    """
+    superseded = []
+    later = set()
+    for doc_ids in reversed(range_doc_ids):
+        superseded.append(later.intersection(doc_ids))
+        later.update(doc_ids)
+    return superseded[::-1]
+
+
+def build_inverted_index_parallel(dataset: str, output: str, workers: int,
+                                  memory_budget: int = DEFAULT_MEMORY_BUDGET, with_frequencies: bool = False,
+                                  with_positions: bool = False, document_store: str = None) -> None:
+    """
+    Builder of inverted indexes which splits the dataset into byte ranges on line boundaries,
+    builds a partial index of every range in a pool of processes and merges their posting lists.
+    :param dataset: path to file with documents
+    :param output: path to save inverted index
+    :param workers: number of worker processes
+    :param memory_budget: memory budget of every worker
+    :param with_frequencies: keep term frequencies and document lengths for ranked retrieval
+    :param with_positions: keep positions of terms in documents for phrase queries
+    :param document_store: if set, path to write the document store to while the workers build the index
+    :return: None
+    """
+    shard_directory = tempfile.mkdtemp(prefix='shards-', dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        ranges = split_dataset(dataset, workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_build_shard, dataset, start, end,
+                                os.path.join(shard_directory, f'shard-{number}'), memory_budget, with_frequencies,
+                                with_positions)
+                for number, (start, end) in enumerate(ranges)
+            ]
+            if document_store is not None:
+                with DocumentStoreWriter(document_store) as writer:
+                    for doc_id, content in Dataset(dataset).iter_lines():
+                        writer.add(doc_id, str(content, 'utf-8'))
+            shards = [future.result() for future in futures]
+        merge_segments([path for path, _ in shards], output,
+                       excluded=_superseded_documents([doc_ids for _, doc_ids in shards]))
+    finally:
+        shutil.rmtree(shard_directory, ignore_errors=True)
+
+
+def shard_path(output: str, shard: int) -> str:
+    """
+    Returns the path of the shard of the sharded index.
+    """
+    return f'{output}.shard-{shard}'
+
+
+def write_shard_manifest(output: str, shard_paths: List[str]) -> None:
+    """
+    Writes the manifest of the sharded index, shards are listed relative to the manifest.
+    """
+    manifest = {'shards': [os.path.relpath(path, os.path.dirname(os.path.abspath(output))) for path in shard_paths]}
+    with open(output + '.tmp', 'wb') as file:
+        file.write(SHARD_MANIFEST_MAGIC + json.dumps(manifest).encode('utf-8'))
+    os.replace(output + '.tmp', output)
+
+
+def read_shard_manifest(filepath: str) -> Optional[List[str]]:
+    """
+    Returns the paths of the shards listed by the manifest, None if the file is not a manifest of a sharded index.
+    """
+    with open(filepath, 'rb') as file:
+        if file.read(len(SHARD_MANIFEST_MAGIC)) != SHARD_MANIFEST_MAGIC:
+            return None
+        manifest = json.loads(file.read().decode('utf-8'))
+    directory = os.path.dirname(os.path.abspath(filepath))
+    return [os.path.join(directory, path) for path in manifest['shards']]
+
+
+def _build_partition(dataset: str, shard: int, shards: int, output: str, memory_budget: Optional[int],
+                     ranked: bool, positions: bool) -> str:
+    """
+    Builds the shard of the documents whose identifiers fall into it, runs in a worker process.
+    Every worker maps the same dataset, so the documents are neither copied nor read more than once from disk.
+    Documents come in ascending order of identifiers and the last line of an identifier wins, as in Dataset.
+    """
+    documents = ((doc_id, content) for doc_id, content in Dataset(dataset).items() if doc_id % shards == shard)
+    _build_index(documents, output, memory_budget, ranked, positions)
+    return output
+
+
+def build_sharded_index(dataset: str, output: str, shards: int, workers: int = 1, memory_budget: int = None,
+                        with_frequencies: bool = False, with_positions: bool = False,
+                        document_store: str = None) -> None:
+    """
+    Builder of the sharded index: documents are partitioned into shards by their identifiers,
+    every shard is an index of its own and the manifest listing the shards is written to the output.
+    :param dataset: path to file with documents
+    :param output: path to save the manifest, shards are saved next to it
+    :param shards: number of shards
+    :param workers: number of processes building the shards
+    :param memory_budget: if set, shards are built with sorted runs of at most memory_budget bytes
+    :param with_frequencies: keep term frequencies and document lengths for ranked retrieval
+    :param with_positions: keep positions of terms in documents for phrase queries
+    :param document_store: if set, path to write the document store of all shards to
+    :return: None
+    """
+    if document_store is not None:
+        with DocumentStoreWriter(document_store) as writer:
+            for doc_id, content in Dataset(dataset).iter_lines():
+                writer.add(doc_id, str(content, 'utf-8'))
+    shard_paths = [shard_path(output, shard) for shard in range(shards)]
+    arguments = [(dataset, shard, shards, path, memory_budget, with_frequencies, with_positions)
+                 for shard, path in enumerate(shard_paths)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(_build_partition, *zip(*arguments)))
+    else:
+        for shard_arguments in arguments:
+            _build_partition(*shard_arguments)
+    write_shard_manifest(output, shard_paths)
+
+
+_shard_index: Optional[InvertedIndex] = None
+
+
+def _load_shard(filepath: str) -> None:
+    """
+    Loads the shard once per worker process of ProcessTransport.
+    """
+    global _shard_index
+    _shard_index = InvertedIndex.load(filepath)
+
+
+def _call_shard(method: str, *args):
+    """
+    Calls the method of the shard loaded by the worker process.
+    """
+    return _call_index(_shard_index, method, args)
+
+
+def _call_index(inverted_index: InvertedIndex, method: str, args: tuple):
+    if method not in ShardedIndex.shard_methods:
+        raise ValueError(f"{method!r} can not be called on shards")
+    result = getattr(inverted_index, method)(*args)
+    return result if isinstance(result, list) else list(result)
+
+
+class ProcessTransport:
+    """
+    Transport running every shard in a worker process of its own, the shard is loaded once when the process starts.
+    """
+    def __init__(self, shard_paths: List[str]):
+        self._executors = [ProcessPoolExecutor(max_workers=1, initializer=_load_shard, initargs=(path,))
+                           for path in shard_paths]
+
+    def submit(self, shard: int, method: str, *args) -> Future:
+        return self._executors[shard].submit(_call_shard, method, *args)
+
+    def close(self) -> None:
+        for executor in self._executors:
+            executor.shutdown()
+
+
+class LocalTransport:
+    """
+    Stand-in transport loading every shard into the current process and answering calls right away.
+    Other transports, e.g. to shards on other machines, provide the same submit and close.
+    """
+    def __init__(self, shard_paths: List[str]):
+        self._shards = [InvertedIndex.load(path) for path in shard_paths]
+
+    def submit(self, shard: int, method: str, *args) -> Future:
+        future = Future()
+        try:
+            future.set_result(_call_index(self._shards[shard], method, args))
+        except Exception as error:  # pylint: disable=broad-except
+            future.set_exception(error)
+        return future
+
+    def close(self) -> None:
+        pass
+
+
+class ShardedIndex:
+    """
+    Index of documents partitioned into shards. Every query is scattered to all shards through the transport
+    and the ascending answers of the shards, which never share documents, are merged.
+    """
+    shard_methods = ('query', 'query_batch', 'search')
+
+    def __init__(self, shard_paths: List[str], transport: Callable = ProcessTransport):
+        self.shard_paths = shard_paths
+        self.transport = transport(shard_paths)
+
+    @classmethod
+    def load(cls, filepath: str, transport: Callable = ProcessTransport) -> 'ShardedIndex':
         """
-        Allow us to write inverted indexes documents to temporary directory or local storage
-        :param filepath: path to file with documents
-        :return: None
+        Opens the shards listed by the manifest of the sharded index.
+        :param filepath: path to the manifest
+        :param transport: class of the transport to the shards
+        :return: ShardedIndex
         """
-        with open(filepath, 'w') as file:
-            json.dump(self.words_ids, file)
+        shard_paths = read_shard_manifest(filepath)
+        if shard_paths is None:
+            raise ValueError(f"{filepath} is not a sharded index")
+        return cls(shard_paths, transport)
 
-    @classmethod
-    def load(cls, filepath: str):
+    def _scatter(self, method: str, *args) -> list:
+        futures = [self.transport.submit(shard, method, *args) for shard in range(len(self.shard_paths))]
+        return [future.result() for future in futures]
+
+    async def _scatter_async(self, method: str, *args) -> list:
+        futures = [asyncio.wrap_future(self.transport.submit(shard, method, *args))
+                   for shard in range(len(self.shard_paths))]
+        return await asyncio.gather(*futures)
+
+    def query(self, words: List[str]) -> List[int]:
+        return list(self.iter_query(words))
+
+    async def query_async(self, words: List[str]) -> List[int]:
         """
-        Allow us to upload inverted indexes from either temporary directory or local storage
-        :param filepath: path to file with documents
-        :return: InvertedIndex
+        Answers the query without blocking the running event loop while the shards are queried.
+        :param words: words of the query
+        :return: ascending indexes of the documents containing all words
         """
-        with open(filepath) as file:
-            index = json.load(file)
-        return cls(index)
+        return list(heapq.merge(*await self._scatter_async('query', words)))
 
+    def iter_query(self, words: List[str]) -> Iterator[int]:
+        return heapq.merge(*self._scatter('query', words))
 
-def load_documents(filepath: str) -> Dict[int, str]:
+    def query_batch(self, queries: List[List[str]]) -> List[List[int]]:
+        answers_of_shards = self._scatter('query_batch', queries)
+        return [list(heapq.merge(*answers)) for answers in zip(*answers_of_shards)]
+
+    def search(self, expression: str) -> Iterator[int]:
+        return heapq.merge(*self._scatter('search', expression))
+
+    def query_ranked(self, words: List[str], k: int = DEFAULT_TOP_K,
+                     boosts: Dict[str, float] = None) -> List[Tuple[int, float]]:
+        raise ValueError("ranked retrieval needs statistics of the whole collection, "
+                         "it is not supported by sharded indexes")
+
+    def field(self, name: str):
+        raise ValueError("field indexes are not supported by sharded indexes")
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_index(filepath: str):
     """
-    Allow us to upload documents from either tempopary directory or local storage
-    :param filepath: path to file with documents
-    :return: Dict[int, str]
+    Opens the index, either InvertedIndex or ShardedIndex with a worker process per shard.
     """
-    with open(filepath, 'r', encoding='utf8') as dataset:
-        documents = {}
-        for line in dataset:
-            doc_id, content = line.rstrip('\n').lower().split('\t', 1)
-            documents[int(doc_id)] = content
-    return documents
+    if read_shard_manifest(filepath) is not None:
+        return ShardedIndex.load(filepath)
+    return InvertedIndex.load(filepath)
 
 
-def build_inverted_index(documents: Dict[int, str]) -> InvertedIndex:
+@contextmanager
+def _collect_metrics(stats_format: Optional[str]):
     """
-    Builder of inverted indexes based on documents
-    :param documents: dict with documents
-    :return: InvertedIndex class.
-    For each document in the input dictionary, the function tokenizes the content of the document into terms.
-    Then removes duplicates from the list of terms and adds the document identifier to the posting list for each term.
+    Collects metrics of the with block and prints them to stderr as json or Prometheus text,
+    does nothing if the format is None.
     """
-    inverted = InvertedIndex()
-    # load stop_words file and process it
-    with open(PATH_TO_STOP_WORDS, 'r', encoding='utf-8') as file_stop:
-        stop_words = [stop_words.strip().lower() for stop_words in file_stop]
-    for doc_id, content in documents.items():
-        terms = re.split(r"\W+", content)
-        filtered_terms = list(dict.fromkeys(terms))
-        # remove stop words from terms
-        for word in filtered_terms:
-            if word not in stop_words:
-                inverted.words_ids.setdefault(word, []).append(doc_id)
-    return inverted
+    if stats_format is None:
+        yield
+        return
+    metrics = enable_metrics()
+    try:
+        yield
+    finally:
+        disable_metrics()
+        if stats_format == 'prometheus':
+            sys.stderr.write(metrics.to_prometheus())
+        else:
+            sys.stderr.write(json.dumps(metrics.to_dict(), indent=2) + '\n')
 
 
 def callback_build(arguments) -> None:
     """
     Process build runner.
     """
-    return process_build(arguments.dataset, arguments.output)
+    with _collect_metrics(arguments.stats):
+        return process_build(arguments.dataset, arguments.output, arguments.memory_budget, arguments.workers,
+                             arguments.ranked, arguments.positions, arguments.documents, arguments.shards,
+                             arguments.fields, arguments.title_from, arguments.pipeline)
 
 
-def process_build(dataset, output) -> None:
+def process_build(dataset, output, memory_budget=None, workers=1, ranked=False, positions=False,
+                  documents=False, shards=1, fields=(), title_from='sentence', pipeline=False) -> None:
     """
     Function is responsible for running of a pipeline to load documents,
     build and save inverted index
     :param arguments: key/value pairs of arguments from 'build' subparser
+    :param memory_budget: if set, documents are streamed and the index is built
+    with sorted runs of at most memory_budget bytes
+    :param workers: number of processes building parts of the index
+    :param ranked: keep term frequencies and document lengths for ranked queries
+    :param positions: keep positions of terms for phrase queries
+    :param documents: keep the documents in a compressed store next to the index for snippets
+    :param shards: if more than one, documents are partitioned into this many shards queried in parallel
+    :param fields: names of fields, title or body, indexed on their own next to the index
+    :param title_from: where the title is: the first 'sentence' or the first tab separated 'column'
+    :param pipeline: read, tokenize with workers processes, accumulate and write runs at the same time
     :return: None.
     """
-    documents: Dict[int, str] = load_documents(dataset)
-    inverted_index = build_inverted_index(documents)
+    if fields and shards > 1:
+        raise ValueError("field indexes are not supported by sharded indexes")
+    if pipeline and shards > 1:
+        raise ValueError("the pipelined build does not partition documents into shards")
+    for field in FIELDS:
+        # an index of the field left by a previous build would be loaded with the new index
+        if field not in fields and os.path.exists(field_path(output, field)):
+            os.remove(field_path(output, field))
+    if not documents and os.path.exists(document_store_path(output)):
+        # so would the document store, and snippets would come from the previous documents
+        os.remove(document_store_path(output))
+    with _stage('build'):
+        _build_main_index(dataset, output, memory_budget, workers, ranked, positions, documents, shards, pipeline)
+        if fields:
+            mapped_dataset = Dataset(dataset)
+        for field in fields:
+            # texts of the field are decoded one document at a time in ascending order of identifiers
+            build_inverted_index_streaming(iter_field(mapped_dataset.items(), field, title_from),
+                                           field_path(output, field), memory_budget or DEFAULT_MEMORY_BUDGET,
+                                           with_frequencies=ranked, with_positions=positions,
+                                           metadata={'field': field, 'title_from': title_from})
+
+
+def _build_main_index(dataset: str, output: str, memory_budget: Optional[int], workers: int, ranked: bool,
+                      positions: bool, documents: bool, shards: int, pipeline: bool) -> None:
+    """
+    Builds the index of whole documents with the builder chosen by the arguments of process_build.
+    """
+    if shards > 1:
+        build_sharded_index(dataset, output, shards, workers, memory_budget, ranked, positions,
+                            document_store_path(output) if documents else None)
+        return
+    if pipeline:
+        build_inverted_index_pipelined(dataset, output, workers, memory_budget or DEFAULT_MEMORY_BUDGET, ranked,
+                                       positions, document_store_path(output) if documents else None)
+        return
+    if workers > 1:
+        build_inverted_index_parallel(dataset, output, workers, memory_budget or DEFAULT_MEMORY_BUDGET,
+                                      ranked, positions, document_store_path(output) if documents else None)
+        return
+    with _stage('load_documents'):
+        mapped_dataset = Dataset(dataset)
+    if not documents:
+        _build_index(mapped_dataset, output, memory_budget, ranked, positions)
+        return
+    with DocumentStoreWriter(document_store_path(output)) as writer:
+        stored_documents = _stored_documents(mapped_dataset.items(), writer)
+        _build_index(stored_documents, output, memory_budget, ranked, positions)
+
+
+def _build_index(documents: Iterable[Tuple[int, str]], output: str, memory_budget: Optional[int],
+                 ranked: bool, positions: bool) -> None:
+    """
+    Builds the index in memory or, with the memory budget, in sorted runs and saves it.
+    A mapping of documents such as Dataset is indexed as it is, without copying it into a dict.
+    """
+    if memory_budget is not None:
+        if isinstance(documents, Mapping):
+            documents = documents.items()
+        build_inverted_index_streaming(documents, output, memory_budget,
+                                       with_frequencies=ranked, with_positions=positions)
+        return
+    if not isinstance(documents, Mapping):
+        documents = dict(documents)
+    inverted_index = build_inverted_index(documents, with_frequencies=ranked, with_positions=positions)
     inverted_index.dump(output)
 
 
+_batch_index: Optional[InvertedIndex] = None
+
+
+def _load_batch_index(index: str) -> None:
+    """
+    Loads the inverted index once per worker process of the batch query pool.
+    """
+    global _batch_index
+    _batch_index = InvertedIndex.load(index)
+
+
+def _query_batch_chunk(queries: List[List[str]]) -> List[List[int]]:
+    """
+    Answers a chunk of the batch in a worker process of the batch query pool.
+    """
+    return _batch_index.query_batch(queries)
+
+
+def query_batch_parallel(index: str, queries: List[List[str]], workers: int) -> Iterator[List[int]]:
+    """
+    Answers the batch of queries in a pool of processes. Every worker loads the index once and
+    answers a contiguous chunk of the batch, sharing posting lists of the words within its chunk.
+    :param index: path to the inverted index
+    :param queries: queries of whitespace separated words
+    :param workers: number of worker processes
+    :return: Iterator[List[int]] of relevant documents in the order of the queries
+    """
+    chunk_size = -(-len(queries) // workers)
+    chunks = [queries[start:start + chunk_size] for start in range(0, len(queries), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_load_batch_index, initargs=(index,)) as executor:
+        for results in executor.map(_query_batch_chunk, chunks):
+            yield from results
+
+
+class ResultWriter:
+    """
+    Writer of answers to queries to a binary stream, the buffered binary stdout by default.
+    Document identifiers are formatted and written in chunks, so broad answers are never joined into one string.
+    :param limit: if set, at most this many documents of every answer are written
+    :param count_only: write the number of documents instead of the documents
+    """
+    def __init__(self, stream=None, limit: int = None, count_only: bool = False,
+                 chunk_size: int = OUTPUT_CHUNK_SIZE):
+        if stream is None:
+            sys.stdout.flush()
+            stream = sys.stdout.buffer
+        self._stream = stream
+        self.limit = limit
+        self.count_only = count_only
+        self._chunk_size = chunk_size
+
+    def write_line(self, text: str) -> None:
+        self._stream.write(text.encode('utf-8') + b'\n')
+
+    def write_doc_ids(self, doc_ids: Iterable[int]) -> int:
+        """
+        Writes the line of comma separated document identifiers or their number.
+        :param doc_ids: document identifiers, consumed lazily
+        :return: number of written documents
+        """
+        doc_ids = iter(doc_ids)
+        if self.limit is not None:
+            doc_ids = islice(doc_ids, self.limit)
+        if self.count_only:
+            count = sum(1 for _ in doc_ids)
+            self._stream.write(b'%d\n' % count)
+            return count
+        count = 0
+        while True:
+            chunk = list(islice(doc_ids, self._chunk_size))
+            if not chunk:
+                break
+            self._stream.write((',' if count else '').encode('ascii') + ','.join(map(str, chunk)).encode('ascii'))
+            count += len(chunk)
+        self._stream.write(b'\n')
+        return count
+
+    def flush(self) -> None:
+        self._stream.flush()
+
+
 def callback_query(arguments) -> None:
     """
     Callback query runner.
     """
-    process_query(arguments.query, arguments.index)
+    try:
+        with _collect_metrics(arguments.stats):
+            process_query(arguments.query, arguments.index, arguments.top_k, arguments.boolean, arguments.batch,
+                          arguments.workers, arguments.snippets, arguments.limit, arguments.count_only,
+                          arguments.field, dict(arguments.boost or ()))
+    except BrokenPipeError:
+        # the reader of the output has gone, e.g. head, stop writing without a traceback at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
 
 
-def process_query(queries, index) -> None:
+def process_query(queries, index, top_k=None, boolean=False, batch=False, workers=1, snippets=False,
+                  limit=None, count_only=False, field=None, boosts=None) -> None:
     """
     Function is responsible for loading inverted indexes
     and printing document indexes for keywords from arguments.query
     :param arguments: key/value pairs of arguments from 'query' subparser
+    :param top_k: if set, prints the top_k best ranked documents containing any of the keywords
+    :param boolean: queries are expressions of the query language with AND, OR, NOT, parentheses and phrases
+    :param batch: read all queries first and fetch the posting list of every word once for the whole batch
+    :param workers: number of processes answering the batch
+    :param snippets: print every document on its own line with a snippet from the document store of the index
+    :param limit: if set, prints at most this many documents of every answer
+    :param count_only: prints the number of documents instead of the documents
+    :param field: if set, queries only search the index of this field, title or body
+    :param boosts: weights of fields whose BM25 scores are added to the scores of ranked queries
+    :return: None.
+    """
+    output = ResultWriter(limit=limit, count_only=count_only)
+    if boosts and top_k is None:
+        raise ValueError("field boosts apply to ranked queries, use them with --top-k")
+    if batch:
+        if top_k is not None or boolean or snippets:
+            raise ValueError("batch mode answers queries of words without --top-k, --boolean and --snippets")
+        if field is not None:
+            if not os.path.exists(field_path(index, field)):
+                raise ValueError(f"the index has no {field} field, build it with --fields {field}")
+            index = field_path(index, field)
+        with _stage('query'):
+            process_query_batch(queries, index, workers, output)
+            output.flush()
+        return
+    inverted_index = open_index(index)
+    try:
+        searched_index = inverted_index.field(field) if field is not None else inverted_index
+        document_store = DocumentStore(document_store_path(index)) if snippets else None
+        for query in queries:
+            metrics = _metrics
+            if metrics is not None:
+                started = time.perf_counter()
+            output.write_line(query[0])
+            if boolean:
+                expression = query if isinstance(query, str) else ' '.join(query)
+                doc_ids = searched_index.search(expression.strip())
+                query = [word for word in TOKEN_PATTERN.findall(expression) if word not in QueryParser.keywords]
+            else:
+                if isinstance(query, str):
+                    query = query.strip().split()
+                if top_k is not None:
+                    doc_ids = [doc_id for doc_id, _ in searched_index.query_ranked(query, top_k, boosts)]
+                else:
+                    doc_ids = searched_index.iter_query(query)
+
+            if document_store is not None and not count_only:
+                for doc_id in islice(doc_ids, limit):
+                    output.write_line(f"{doc_id}\t{document_store.snippet(doc_id, query) or ''}")
+            else:
+                output.write_doc_ids(doc_ids)
+            if metrics is not None:
+                latency = time.perf_counter() - started
+                metrics.add_time('query', latency)
+                metrics.observe('query_seconds', latency)
+                metrics.count('queries')
+    finally:
+        if isinstance(inverted_index, ShardedIndex):
+            inverted_index.close()
+        elif _metrics is not None:
+            _metrics.record_cache(inverted_index.cache.stats())
+    output.flush()
+
+
+def process_query_batch(queries, index, workers=1, output: ResultWriter = None) -> None:
+    """
+    Reads all queries, answers them as a batch and prints the answers in the order of the queries.
+    :param queries: queries of words or lines of the query file
+    :param index: path to the inverted index
+    :param workers: number of processes answering the batch, shards of a sharded index are answered
+    by a process each instead
+    :param output: ResultWriter of the answers, the buffered binary stdout by default
     :return: None.
     """
-    inverted_index = InvertedIndex.load(index)
+    if output is None:
+        output = ResultWriter()
+    headers, batch = [], []
     for query in queries:
-        print(query[0])
-        if isinstance(query, str):
-            query = query.strip().split()
+        headers.append(query[0])
+        batch.append(query.strip().split() if isinstance(query, str) else query)
+    shard_paths = read_shard_manifest(index)
+    if shard_paths is not None:
+        with ShardedIndex(shard_paths) as sharded_index:
+            results = sharded_index.query_batch(batch)
+    elif workers > 1 and batch:
+        results = query_batch_parallel(index, batch, workers)
+    else:
+        results = InvertedIndex.load(index).query_batch(batch)
+    for header, doc_ids in zip(headers, results):
+        output.write_line(header)
+        output.write_doc_ids(doc_ids)
+    output.flush()
+    if _metrics is not None:
+        _metrics.count('queries', len(batch))
+
+
+async def _answer_queries(inverted_index, reader: asyncio.StreamReader,
+                          writer: asyncio.StreamWriter) -> None:
+    """
+    Answers queries of a single client: every line is a query of whitespace separated words,
+    every answer is a line of comma separated document indexes, or a line starting with error: if the query failed.
+    Sharded indexes are awaited, so one client waiting for the shards does not stall the others.
+    """
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                query = line.decode('utf-8').strip().split()
+                if isinstance(inverted_index, ShardedIndex):
+                    answer = await inverted_index.query_async(query)
+                else:
+                    answer = inverted_index.query(query)
+                reply = ','.join(str(value) for value in answer)
+            except Exception as error:  # pylint: disable=broad-except
+                reply = f"error: {error}".replace('\n', ' ')
+            writer.write(reply.encode('utf-8') + b'\n')
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_query_server(inverted_index: InvertedIndex, host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Starts the server answering queries to the loaded inverted index.
+    :param inverted_index: InvertedIndex loaded once for all clients
+    :param host: interface to listen on
+    :param port: port to listen on, 0 picks a free port
+    :return: asyncio server
+    """
+    return await asyncio.start_server(partial(_answer_queries, inverted_index), host, port)
+
+
+def callback_serve(arguments) -> None:
+    """
+    Callback serve runner.
+    """
+    process_serve(arguments.index, arguments.host, arguments.port, arguments.cache_size)
+
+
+def process_serve(index, host, port, cache_size=DEFAULT_CACHE_SIZE) -> None:
+    """
+    Function is responsible for loading inverted indexes once and answering
+    queries of concurrent clients until interrupted
+    :param index: path to inverted index
+    :param host: interface to listen on
+    :param port: port to listen on
+    :param cache_size: size of the cache of posting lists and answers in bytes
+    :return: None.
+    """
+    inverted_index = open_index(index)
+    if isinstance(inverted_index, InvertedIndex):
+        inverted_index.cache = ByteLRUCache(cache_size)
+
+    async def serve():
+        server = await start_query_server(inverted_index, host, port)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if isinstance(inverted_index, ShardedIndex):
+            inverted_index.close()
+
+
+def parse_boost(value: str) -> Tuple[str, float]:
+    """
+    Parses FIELD=WEIGHT of the --boost argument.
+    """
+    field, _, weight = value.partition('=')
+    if field not in FIELDS:
+        raise ArgumentTypeError(f"unknown field {field!r}, choose from {', '.join(FIELDS)}")
+    try:
+        boost = float(weight)
+    except ValueError:
+        raise ArgumentTypeError(f"weight of {field} must be a number, got {weight!r}") from None
+    if boost <= 0:
+        raise ArgumentTypeError(f"weight of {field} must be positive")
+    return field, boost
+
 
-        doc_indexes = ','.join(str(value) for value in inverted_index.query(query))
-        print(doc_indexes)
+def parse_limit(value: str) -> int:
+    """
+    Parses the number of documents of the --limit argument.
+    """
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"limit must be an integer, got {value!r}") from None
+    if limit < 0:
+        raise ArgumentTypeError("limit must not be negative")
+    return limit
 
 
 def setup_subparsers(parser) -> None:
@@ -187,6 +3904,69 @@ def setup_subparsers(parser) -> None:
         help='You should specify path to save inverted index. '
              'The default: %(default)s',
     )
+    build_parser.add_argument(
+        '--memory-budget',
+        type=lambda megabytes: int(float(megabytes) * 1024 * 1024),
+        default=None,
+        help='stream documents and build the index in sorted runs '
+             'of at most this many megabytes of postings',
+    )
+    build_parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of processes building parts of the index. '
+             'The default: %(default)s',
+    )
+    build_parser.add_argument(
+        '--ranked',
+        action='store_true',
+        help='keep term frequencies and document lengths for ranked queries',
+    )
+    build_parser.add_argument(
+        '--positions',
+        action='store_true',
+        help='keep positions of terms in documents for phrase queries',
+    )
+    build_parser.add_argument(
+        '--documents',
+        action='store_true',
+        help='keep the documents in a compressed store next to the index for snippets',
+    )
+    build_parser.add_argument(
+        '--shards',
+        type=int,
+        default=1,
+        help='partition documents into this many shards, every shard is queried by a process of its own. '
+             'The output is the manifest of the shards. The default: %(default)s',
+    )
+    build_parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='read, tokenize in --workers processes, accumulate postings and write runs at the same time',
+    )
+    build_parser.add_argument(
+        '--fields',
+        nargs='+',
+        choices=FIELDS,
+        default=(),
+        help='also index these fields of documents on their own, for queries restricted to or boosting a field',
+    )
+    build_parser.add_argument(
+        '--title-from',
+        choices=TITLE_SOURCES,
+        default='sentence',
+        help='the title is the first sentence of a document or the first tab separated column. '
+             'The default: %(default)s',
+    )
+    build_parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='json',
+        choices=('json', 'prometheus'),
+        default=None,
+        help='print timers and counters of the build to stderr as json (the default) or Prometheus text',
+    )
     build_parser.set_defaults(callback=callback_build)
 
     query_parser = subparser.add_parser(
@@ -212,8 +3992,98 @@ def setup_subparsers(parser) -> None:
         # default=TextIOWrapper(sys.stdin.buffer, encoding='utf-8'),
         help="query file to get queries for inverted index",
     )
+    query_parser.add_argument(
+        '--top-k', dest='top_k',
+        type=int,
+        default=None,
+        help='print the best ranked documents containing any of the words '
+             'instead of all documents containing every word',
+    )
+    query_parser.add_argument(
+        '--boolean',
+        action='store_true',
+        help='queries use AND, OR, NOT, parentheses and "quoted phrases"',
+    )
+    query_parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='read all queries first and fetch the posting list of every word once',
+    )
+    query_parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='number of processes answering queries in batch mode. '
+             'The default: %(default)s',
+    )
+    query_parser.add_argument(
+        '--snippets',
+        action='store_true',
+        help='print every document with a snippet, the index must be built with --documents',
+    )
+    query_parser.add_argument(
+        '--field',
+        choices=FIELDS,
+        default=None,
+        help='search only the index of the field, the index must be built with --fields',
+    )
+    query_parser.add_argument(
+        '--boost',
+        type=parse_boost,
+        action='append',
+        metavar='FIELD=WEIGHT',
+        help='add the score of the words in the field times the weight to ranked queries, e.g. title=2',
+    )
+    query_parser.add_argument(
+        '--limit',
+        type=parse_limit,
+        default=None,
+        help='print at most this many documents of every answer',
+    )
+    query_parser.add_argument(
+        '--count-only',
+        action='store_true',
+        help='print the number of documents of every answer instead of the documents',
+    )
+    query_parser.add_argument(
+        '--stats',
+        nargs='?',
+        const='json',
+        choices=('json', 'prometheus'),
+        default=None,
+        help='print timers and counters of the queries to stderr as json (the default) or Prometheus text',
+    )
     query_parser.set_defaults(callback=callback_query)
 
+    serve_parser = subparser.add_parser(
+        "serve",
+        help="This parser is need to load inverted index once and answer queries over a socket"
+    )
+    serve_parser.add_argument(
+        '--index',
+        default=DEFAULT_PATH_TO_STORE_INVERTED_INDEX,
+        help='specify the path where inverted indexes are. '
+             'The default: %(default)s',
+    )
+    serve_parser.add_argument(
+        '--host',
+        default=DEFAULT_SERVE_HOST,
+        help='interface to listen on. The default: %(default)s',
+    )
+    serve_parser.add_argument(
+        '--port',
+        type=int,
+        default=DEFAULT_SERVE_PORT,
+        help='port to listen on. The default: %(default)s',
+    )
+    serve_parser.add_argument(
+        '--cache-size',
+        type=lambda megabytes: int(float(megabytes) * 1024 * 1024),
+        default=DEFAULT_CACHE_SIZE,
+        help='megabytes of decoded posting lists and answers kept in memory, 0 disables the cache',
+    )
+    serve_parser.set_defaults(callback=callback_serve)
+
 
 def main():
     """
@@ -1,4 +1,8 @@
+import asyncio
+import json
+import math
 import os
+import pickle
 import sys
 from io import TextIOWrapper, BytesIO
 from argparse import Namespace
@@ -14,8 +18,53 @@ from final_task import (
     main,
     DEFAULT_PATH_TO_STORE_INVERTED_INDEX,
     EncodedFileType,
+    InvertedIndex,
+    build_inverted_index,
+    build_inverted_index_streaming,
+    iter_documents,
+    split_dataset,
+    iter_intersection,
+    PostingCursor,
+    CompressedPostings,
+    start_query_server,
+    load_stop_words,
+    TermFilter,
+    Tokenizer,
+    load_documents,
+    SegmentReader,
+    Tombstones,
+    encode_postings,
+    decode_postings,
+    QueryParser,
+    ByteLRUCache,
+    DocumentStore,
+    DocumentStoreWriter,
+    document_store_path,
+    DEFAULT_SNIPPET_WIDTH,
+    ResultWriter,
+    ShardedIndex,
+    LocalTransport,
+    ProcessTransport,
+    encode_front_coded,
+    decode_front_coded,
+    TermDictionary,
+    RoaringPostings,
+    is_dense,
+    merge_segments,
+    Dataset,
+    Vocabulary,
+    Metrics,
+    split_title,
+    field_path,
+    build_inverted_index_pipelined,
+    disable_metrics,
+    enable_metrics,
+    open_index,
+    DocumentLengths,
 )
 
+from benchmark import benchmark_index
+
 
 PATH_TO_JSON_INDEX = 'inverted.index'
 PATH_TO_SIMPLE_QUERIES = 'simple_queries.txt'
@@ -55,3 +104,983 @@ def test_std_argv_input_query(capsys):
 
     for value in [6021, 2581, 5783, 7575, 8864, 4266, 6698, 5295, 6834, 9010]:
         assert str(value) in out
+
+
+def test_postings_codec_round_trip():
+    doc_ids = [0, 1, 127, 128, 300, 16384, 2 ** 40]
+
+    assert decode_postings(encode_postings(doc_ids)) == doc_ids
+
+
+def test_dump_and_load_binary_segment(tmp_path):
+    index_path = str(tmp_path / 'inverted.index')
+    words_ids = {'python': [7, 3, 1000], 'code': [3], 'ünïcode': [5, 6]}
+    InvertedIndex(words_ids).dump(index_path)
+
+    inverted_index = InvertedIndex.load(index_path)
+
+    assert isinstance(inverted_index.words_ids, SegmentReader)
+    assert dict(inverted_index.words_ids.items()) == {'code': [3], 'python': [3, 7, 1000], 'ünïcode': [5, 6]}
+    assert 'missing' not in inverted_index.words_ids
+    assert sorted(inverted_index.query(['python', 'code'])) == [3]
+
+
+def test_load_json_index_of_previous_versions(tmp_path):
+    index_path = tmp_path / 'inverted.index'
+    index_path.write_text(json.dumps({'python': [1, 2], 'code': [2]}))
+
+    inverted_index = InvertedIndex.load(str(index_path))
+
+    assert inverted_index.query(['python', 'code']) == [2]
+
+
+def test_streaming_build_matches_in_memory_build(tmp_path):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text(
+        '3\tPython code\n1\tThe python language\n2\tCode review of the language\n', encoding='utf8'
+    )
+    index_path = str(tmp_path / 'inverted.index')
+
+    build_inverted_index_streaming(iter_documents(str(dataset_path)), index_path, memory_budget=1)
+
+    expected = build_inverted_index(load_documents(str(dataset_path))).words_ids
+    built = dict(InvertedIndex.load(index_path).words_ids.items())
+    assert built == {word: sorted(doc_ids) for word, doc_ids in expected.items()}
+    assert sorted(os.listdir(tmp_path)) == ['dataset', 'inverted.index'], (
+        'run files are not removed'
+    )
+
+
+def test_split_dataset_on_line_boundaries(tmp_path):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_bytes(b''.join(f'{doc_id}\tdocument number {doc_id}\n'.encode() for doc_id in range(50)))
+
+    ranges = split_dataset(str(dataset_path), 4)
+
+    assert ranges[0][0] == 0 and ranges[-1][1] == dataset_path.stat().st_size
+    doc_ids = [doc_id for start, end in ranges for doc_id, _ in iter_documents(str(dataset_path), start, end)]
+    assert doc_ids == list(range(50))
+
+
+def test_parallel_build_matches_single_process_build(tmp_path):
+    parallel_path = str(tmp_path / 'parallel.index')
+    single_path = str(tmp_path / 'single.index')
+
+    process_build(dataset=PATH_TO_DATASET, output=parallel_path, workers=3)
+    process_build(dataset=PATH_TO_DATASET, output=single_path)
+
+    with open(parallel_path, 'rb') as parallel, open(single_path, 'rb') as single:
+        assert parallel.read() == single.read()
+
+
+@pytest.mark.parametrize(
+    'posting_lists, expected',
+    [
+        pytest.param([[1, 5, 9], [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10]], [1, 5, 9], id='rare and common'),
+        pytest.param([list(range(0, 1000, 3)), list(range(0, 1000, 5)), [15, 16, 600]], [15, 600], id='three lists'),
+        pytest.param([[1, 2], []], [], id='empty list'),
+        pytest.param([[4, 8]], [4, 8], id='single list'),
+        pytest.param([], [], id='no lists'),
+    ],
+)
+def test_iter_intersection(posting_lists, expected):
+    assert list(iter_intersection(posting_lists)) == expected
+
+
+def test_posting_cursor_seek_is_forward_only():
+    cursor = PostingCursor(list(range(0, 100, 2)))
+
+    assert cursor.seek(7) == 8
+    assert cursor.seek(3) == 8
+    assert cursor.seek(98) == 98
+    assert cursor.seek(99) is None
+
+
+@pytest.mark.parametrize('skip_interval', [1, 4, 64])
+def test_compressed_postings_cursor(skip_interval):
+    doc_ids = list(range(3, 3000, 7))
+    postings = CompressedPostings(doc_ids, skip_interval)
+    cursor = postings.cursor()
+
+    assert len(postings) == len(doc_ids) and list(postings) == doc_ids
+    assert cursor.seek(0) == 3
+    assert cursor.seek(501) == 507
+    assert cursor.seek(507) == 507
+    assert cursor.seek(2998) == 2999
+    assert cursor.seek(3000) is None
+
+
+def test_compressed_postings_with_64_bit_ids():
+    doc_ids = [5, 2 ** 32 - 1, 2 ** 33, 2 ** 40 + 7]
+    postings = CompressedPostings(doc_ids, skip_interval=1)
+
+    assert list(postings) == doc_ids
+    assert postings.cursor().seek(2 ** 32) == 2 ** 33
+
+
+def test_compacted_index_answers_queries():
+    words_ids = {'python': list(range(0, 10000, 3)), 'code': list(range(0, 10000, 5)), 'rare': [15, 16, 9990]}
+    inverted_index = InvertedIndex(dict(words_ids))
+
+    inverted_index.compact(skip_interval=16)
+
+    assert all(isinstance(doc_ids, CompressedPostings) for doc_ids in inverted_index.words_ids.values())
+    assert inverted_index.query(['python', 'code', 'rare']) == [15, 9990]
+    assert inverted_index.query(['python', 'code']) == list(range(0, 10000, 15))
+
+
+def test_query_server_answers_concurrent_clients():
+    inverted_index = InvertedIndex({'python': [1, 2, 5], 'code': [2, 5, 7]})
+
+    async def ask(port, lines):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        answers = []
+        for line in lines:
+            writer.write(line.encode('utf-8') + b'\n')
+            await writer.drain()
+            answers.append((await reader.readline()).decode('utf-8').rstrip('\n'))
+        writer.close()
+        return answers
+
+    async def scenario():
+        server = await start_query_server(inverted_index, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            return await asyncio.gather(ask(port, ['python code', 'missing']), ask(port, ['code']))
+
+    assert asyncio.run(scenario()) == [['2,5', ''], ['2,5,7']]
+
+
+def test_query_server_replies_with_error_and_keeps_connection():
+    class FailingIndex:
+        def query(self, words):
+            if words == ['fail']:
+                raise ValueError('broken query')
+            return [1, 2]
+
+    async def scenario():
+        server = await start_query_server(FailingIndex(), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            answers = []
+            for line in [b'fail\n', b'\xff\n', b'python\n']:
+                writer.write(line)
+                await writer.drain()
+                answers.append((await reader.readline()).decode('utf-8').rstrip('\n'))
+            writer.close()
+            return answers
+
+    answers = asyncio.run(scenario())
+    assert answers[0] == 'error: broken query'
+    assert answers[1].startswith('error: ')
+    assert answers[2] == '1,2'
+
+
+def test_stop_words_are_loaded_once():
+    stop_words = load_stop_words()
+
+    assert isinstance(stop_words, frozenset) and 'the' in stop_words
+    assert load_stop_words() is stop_words
+
+
+def test_term_filter_normalizes_and_drops_stop_words():
+    term_filter = TermFilter(['the', 'of'])
+
+    assert list(term_filter(['The', 'Python', '', 'OF', 'code'])) == ['python', 'code']
+
+
+def test_tokenizer_pipeline():
+    tokenizer = Tokenizer(TermFilter(['the', 'of']), stemmer=lambda term: term.rstrip('s'))
+
+    assert list(tokenizer.tokens('The codes of Python, the code')) == ['code', 'python', 'code']
+    assert tokenizer.terms('The codes of Python, the code') == {'code', 'python'}
+
+
+def test_add_and_delete_documents_without_rebuild(tmp_path):
+    inverted_index = build_inverted_index({1: 'python code', 2: 'python snake', 3: 'code review'})
+
+    inverted_index.add_documents({4: 'python code golf', 2: 'snake only'})
+    inverted_index.delete_documents([1])
+
+    assert inverted_index.query(['python', 'code']) == [4]
+    assert inverted_index.query(['python']) == [4]
+    assert inverted_index.query(['snake']) == [2]
+
+    index_path = str(tmp_path / 'inverted.index')
+    inverted_index.dump(index_path)
+    assert InvertedIndex.load(index_path).query(['code']) == [3, 4]
+
+    inverted_index.merge_in_background().join()
+    assert not inverted_index.segments and not inverted_index.deleted
+    assert inverted_index.words_ids['python'] == [4]
+    assert inverted_index.query(['code']) == [3, 4]
+
+
+def test_delta_segments_are_merged_automatically():
+    inverted_index = InvertedIndex()
+    inverted_index.max_delta_segments = 2
+
+    with patch.object(inverted_index, 'merge_in_background', side_effect=inverted_index.merge) as merge:
+        for doc_id in range(1, 6):
+            inverted_index.add_documents({doc_id: 'python'})
+
+    assert merge.call_count == 1
+    assert len(inverted_index.segments) == 2
+    assert inverted_index.query(['python']) == [1, 2, 3, 4, 5]
+
+
+def test_merge_of_loaded_index_keeps_segment_memory_mapped(tmp_path):
+    index_path = str(tmp_path / 'inverted.index')
+    build_inverted_index({1: 'python code', 2: 'python snake', 3: 'code review'}, with_frequencies=True).dump(index_path)
+    inverted_index = InvertedIndex.load(index_path)
+
+    inverted_index.add_documents({4: 'python code golf'})
+    inverted_index.delete_documents([2])
+    inverted_index.merge()
+
+    assert isinstance(inverted_index.words_ids, SegmentReader)
+    assert not inverted_index.segments and not inverted_index.deleted
+    assert inverted_index.query(['python']) == [1, 4]
+    assert inverted_index.frequencies['code'] == {1: 1, 3: 1, 4: 1}
+    assert sorted(os.listdir(tmp_path)) == ['inverted.index'], 'merged segment file is left behind'
+
+
+def test_tombstones_are_sparse_and_kept_by_segments_of_the_documents():
+    tombstones = Tombstones([2 ** 36, 5])
+    assert 2 ** 36 in tombstones and 6 not in tombstones and len(tombstones) == 2
+
+    inverted_index = build_inverted_index({1: 'python'})
+    inverted_index.add_documents({2: 'python'})
+    inverted_index.add_documents({3: 'python'})
+    inverted_index.delete_documents([3, 2 ** 40])
+
+    assert [len(segment.deleted) for segment in inverted_index.segments] == [0, 1]
+    assert inverted_index.query(['python']) == [1, 2]
+
+
+def bm25_scores(documents, words):
+    tokenizer = Tokenizer()
+    tokens = {doc_id: list(tokenizer.tokens(content)) for doc_id, content in documents.items()}
+    average_length = sum(map(len, tokens.values())) / len(tokens)
+    scores = {}
+    for word in set(words):
+        matching = [doc_id for doc_id in tokens if word in tokens[doc_id]]
+        idf = math.log(1 + (len(tokens) - len(matching) + 0.5) / (len(matching) + 0.5))
+        for doc_id in matching:
+            frequency = tokens[doc_id].count(word)
+            norm = 1.2 * (1 - 0.75 + 0.75 * len(tokens[doc_id]) / average_length)
+            scores[doc_id] = scores.get(doc_id, 0) + idf * frequency * 2.2 / (frequency + norm)
+    return scores
+
+
+def test_query_ranked_returns_best_bm25_documents(tmp_path):
+    documents = dict(list(load_documents(PATH_TO_DATASET).items())[:500])
+    words = ['alpha', 'river', 'w7', 'w150']
+    expected = sorted(bm25_scores(documents, words).items(), key=lambda item: (-item[1], item[0]))[:10]
+    index_path = str(tmp_path / 'inverted.index')
+    build_inverted_index(documents, with_frequencies=True).dump(index_path)
+
+    ranked = InvertedIndex.load(index_path).query_ranked(words, 10)
+
+    assert [doc_id for doc_id, _ in ranked] == [doc_id for doc_id, _ in expected]
+    assert [score for _, score in ranked] == pytest.approx([score for _, score in expected])
+
+
+def test_ranked_index_survives_streaming_build_and_updates(tmp_path):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text('1\tpython python code\n2\tpython snake\n3\tcode review code code\n', encoding='utf8')
+    index_path = str(tmp_path / 'inverted.index')
+    process_build(dataset=str(dataset_path), output=index_path, memory_budget=1, ranked=True)
+
+    inverted_index = InvertedIndex.load(index_path)
+    assert inverted_index.doc_lengths == {1: 3, 2: 2, 3: 4}
+    assert inverted_index.frequencies['code'] == {1: 1, 3: 3}
+
+    inverted_index.add_documents({4: 'code code code code code'})
+    inverted_index.delete_documents([3])
+    assert [doc_id for doc_id, _ in inverted_index.query_ranked(['code'], 2)] == [4, 1]
+    inverted_index.merge()
+    assert inverted_index.frequencies['code'] == {1: 1, 4: 5}
+
+
+def test_ranked_statistics_are_kept_up_to_date_without_scans(tmp_path):
+    index_path = str(tmp_path / 'inverted.index')
+    build_inverted_index({1: 'python python code', 2: 'python snake', 3: 'code review code code'},
+                         with_frequencies=True).dump(index_path)
+    reader = SegmentReader(index_path)
+    assert [reader.max_frequency(word) for word in ['python', 'code', 'snake', 'missing']] == [2, 3, 1, 0]
+
+    inverted_index = InvertedIndex.load(index_path)
+    doc_lengths = inverted_index.doc_lengths
+    assert isinstance(doc_lengths, DocumentLengths) and (doc_lengths.total, len(doc_lengths)) == (9, 3)
+
+    inverted_index.add_documents({4: 'code code code code code', 2: 'python'})
+    inverted_index.delete_documents([3, 5])
+    assert dict(doc_lengths) == {1: 3, 2: 1, 4: 5}
+    assert (doc_lengths.total, len(doc_lengths)) == (9, 3)
+    inverted_index.merge()
+    assert (doc_lengths.total, len(doc_lengths)) == (9, 3)
+    del doc_lengths[2]
+    doc_lengths[3] = 7
+    assert doc_lengths.total == sum(doc_lengths.values()) == 15 and len(doc_lengths) == 3
+
+    expected = inverted_index.query_ranked(['code', 'python'], 2)
+    hits = inverted_index.cache.stats()['hits']
+    assert inverted_index.query_ranked(['code', 'python'], 2) == expected
+    assert inverted_index.cache.stats()['hits'] == hits + 2
+
+
+PHRASE_DOCUMENTS = {
+    1: 'python source code review',
+    2: 'the source of the python code',
+    3: 'snake code in the source',
+    4: 'python snake',
+}
+
+
+@pytest.mark.parametrize(
+    'expression, expected', [
+        ('python code', [1, 2]),
+        ('python AND code', [1, 2]),
+        ('python OR snake', [1, 2, 3, 4]),
+        ('python AND NOT snake', [1, 2]),
+        ('code AND NOT (python OR review)', [3]),
+        ('"source code"', [1]),
+        ('"source of the python"', [2]),
+        ('"code source"', []),
+        ('"python source" OR "snake code"', [1, 3]),
+        ('the', []),
+    ],
+)
+def test_search_boolean_and_phrase_queries(tmp_path, expression, expected):
+    index_path = str(tmp_path / 'inverted.index')
+    build_inverted_index(PHRASE_DOCUMENTS, with_positions=True).dump(index_path)
+
+    assert list(build_inverted_index(PHRASE_DOCUMENTS, with_positions=True).search(expression)) == expected
+    assert list(InvertedIndex.load(index_path).search(expression)) == expected
+
+
+@pytest.mark.parametrize('expression', ['NOT python', 'python OR NOT snake', '(python', 'python AND', ')'])
+def test_search_rejects_invalid_queries(expression):
+    with pytest.raises(ValueError):
+        list(build_inverted_index(PHRASE_DOCUMENTS, with_positions=True).search(expression))
+
+
+def test_query_parser_builds_tree():
+    query = QueryParser().parse('Python OR (code AND NOT "the snake")')
+
+    assert type(query).__name__ == 'OrQuery'
+    assert query.queries[0].word == 'python'
+    assert [type(subquery).__name__ for subquery in query.queries[1].queries] == ['TermQuery', 'NotQuery']
+
+
+def test_positions_survive_streaming_build_and_updates(tmp_path):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text(''.join(f'{doc_id}\t{content}\n' for doc_id, content in PHRASE_DOCUMENTS.items()),
+                            encoding='utf8')
+    index_path = str(tmp_path / 'inverted.index')
+    process_build(dataset=str(dataset_path), output=index_path, memory_budget=1, positions=True)
+
+    inverted_index = InvertedIndex.load(index_path)
+    assert inverted_index.term_positions('source') == {1: [1], 2: [1], 3: [4]}
+    inverted_index.add_documents({5: 'open source code'})
+    inverted_index.delete_documents([1])
+    assert list(inverted_index.search('"source code"')) == [5]
+    inverted_index.merge()
+    assert list(inverted_index.search('"source code"')) == [5]
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_batch_queries_match_single_queries(capsys, workers):
+    with open(PATH_TO_SIMPLE_QUERIES) as queries_file:
+        queries = queries_file.readlines() + ['python code\n', 'alpha w7 river\n', '\n']
+    process_query(queries=queries, index=PATH_TO_JSON_INDEX)
+    expected = capsys.readouterr().out
+
+    process_query(queries=queries, index=PATH_TO_JSON_INDEX, batch=True, workers=workers)
+
+    assert capsys.readouterr().out == expected
+
+
+def test_query_batch_shares_posting_lists():
+    inverted_index = build_inverted_index(PHRASE_DOCUMENTS)
+    with patch.object(inverted_index, '_postings', wraps=inverted_index._postings) as postings:
+        answers = inverted_index.query_batch([['python', 'code'], ['code'], ['python', 'snake'], ['unknown']])
+
+    assert answers == [[1, 2], [1, 2, 3], [4], []]
+    assert sorted(call.args[0] for call in postings.call_args_list) == ['code', 'python', 'snake', 'unknown']
+
+
+def test_byte_lru_cache_evicts_least_recently_used():
+    cache = ByteLRUCache(max_bytes=100)
+    cache.put('a', [1], 40, cache.generation)
+    cache.put('b', [2], 40, cache.generation)
+    assert cache.get('a') == [1]
+    cache.put('c', [3], 40, cache.generation)
+
+    assert cache.get('b') is None
+    assert cache.get('c') == [3]
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'evictions': 1, 'entries': 2, 'bytes': 80}
+
+    stale_generation = cache.generation
+    cache.clear()
+    cache.put('d', [4], 10, stale_generation)
+    assert cache.get('d') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_query_cache_is_invalidated_by_updates(tmp_path):
+    index_path = str(tmp_path / 'inverted.index')
+    build_inverted_index(PHRASE_DOCUMENTS).dump(index_path)
+    inverted_index = InvertedIndex.load(index_path)
+
+    assert inverted_index.query(['python', 'code']) == [1, 2]
+    assert inverted_index.query(['code', 'python', 'code']) == [1, 2]
+    assert inverted_index.cache.stats()['hits'] == 1
+
+    inverted_index.add_documents({5: 'python code'})
+    assert inverted_index.query(['python', 'code']) == [1, 2, 5]
+    inverted_index.delete_documents([1])
+    assert inverted_index.query(['python', 'code']) == [2, 5]
+    assert inverted_index.postings('python') == [2, 4, 5]
+
+
+def test_document_store_returns_documents_in_any_order(tmp_path):
+    store_path = str(tmp_path / 'inverted.index.docs')
+    documents = {doc_id: f'Document {doc_id} ' + 'text ' * (doc_id % 7) for doc_id in range(500, 0, -3)}
+    documents[2] = ''
+    with DocumentStoreWriter(store_path, block_size=256) as writer:
+        for doc_id, content in documents.items():
+            writer.add(doc_id, content)
+
+    document_store = DocumentStore(store_path)
+
+    assert dict(document_store) == documents
+    assert list(document_store) == sorted(documents)
+    assert 3 not in document_store
+    assert document_store.snippet(3, ['text']) is None
+
+
+def test_query_prints_snippets_from_document_store(tmp_path, capsys):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text('1\tPython is a language. ' + 'Filler words. ' * 20 + 'Source Code here.\n'
+                            '2\tThe snake\n', encoding='utf8')
+    index_path = str(tmp_path / 'inverted.index')
+    process_build(dataset=str(dataset_path), output=index_path, memory_budget=1, documents=True)
+
+    assert dict(DocumentStore(document_store_path(index_path)))[2] == 'The snake'
+    process_query(queries=[['code']], index=index_path, snippets=True)
+
+    out = capsys.readouterr().out.splitlines()
+    assert out[1].startswith('1\t...')
+    assert 'Source Code here.' in out[1]
+    assert len(out[1].split('\t')[1]) <= DEFAULT_SNIPPET_WIDTH + 3
+
+    process_build(dataset=str(dataset_path), output=index_path)
+    assert not os.path.exists(document_store_path(index_path)), 'stale document store is not removed'
+
+
+def test_result_writer_streams_chunks():
+    stream = BytesIO()
+    output = ResultWriter(stream, chunk_size=3)
+
+    assert output.write_doc_ids(iter(range(1, 8))) == 7
+    assert output.write_doc_ids([]) == 0
+    assert stream.getvalue() == b'1,2,3,4,5,6,7\n\n'
+
+
+@pytest.mark.parametrize(
+    'options, expected', [
+        ({}, ['python', '1,2,4', 'code', '1,2,3']),
+        ({'limit': 2}, ['python', '1,2', 'code', '1,2']),
+        ({'count_only': True}, ['python', '3', 'code', '3']),
+        ({'limit': 1, 'count_only': True, 'boolean': True}, ['python', '1', 'code', '1']),
+        ({'limit': 2, 'batch': True}, ['python', '1,2', 'code', '1,2']),
+    ],
+)
+def test_process_query_limit_and_count_only(tmp_path, capsys, options, expected):
+    index_path = str(tmp_path / 'inverted.index')
+    build_inverted_index(PHRASE_DOCUMENTS).dump(index_path)
+
+    process_query(queries=[['python'], ['code']], index=index_path, **options)
+
+    assert capsys.readouterr().out.splitlines() == expected
+
+
+def test_query_cli_rejects_negative_limit(tmp_path, capsys):
+    index_path = str(tmp_path / 'inverted.index')
+    build_inverted_index(PHRASE_DOCUMENTS).dump(index_path)
+
+    with patch.object(sys, 'argv', ['prog', 'query', '--index', index_path, '-q', 'python', '--limit', '-1']):
+        with pytest.raises(SystemExit):
+            main()
+    out, err = capsys.readouterr()
+    assert out == '' and 'limit must not be negative' in err
+
+
+@pytest.mark.parametrize('transport', [LocalTransport, ProcessTransport])
+def test_sharded_index_matches_single_index(tmp_path, transport):
+    dataset_path = tmp_path / 'dataset'
+    with open(PATH_TO_DATASET, encoding='utf8') as dataset:
+        dataset_path.write_text(''.join(line for _, line in zip(range(1000), dataset)), encoding='utf8')
+    single_path = str(tmp_path / 'single.index')
+    sharded_path = str(tmp_path / 'sharded.index')
+    process_build(dataset=str(dataset_path), output=single_path, positions=True)
+    process_build(dataset=str(dataset_path), output=sharded_path, positions=True, shards=3, workers=2)
+    single_index = InvertedIndex.load(single_path)
+    queries = [['python', 'code'], ['alpha'], ['alpha', 'river', 'w7'], ['unknown']]
+
+    with ShardedIndex.load(sharded_path, transport) as sharded_index:
+        assert len(sharded_index.shard_paths) == 3
+        for query in queries:
+            assert sharded_index.query(query) == single_index.query(query)
+        assert sharded_index.query_batch(queries) == single_index.query_batch(queries)
+        expression = '"alpha river" OR (w7 AND NOT alpha)'
+        assert list(sharded_index.search(expression)) == list(single_index.search(expression))
+        with pytest.raises(ValueError):
+            sharded_index.query_ranked(['alpha'])
+
+
+def test_query_server_awaits_sharded_index(tmp_path):
+    sharded_path = str(tmp_path / 'sharded.index')
+    process_build(dataset=PATH_TO_DATASET, output=sharded_path, shards=2)
+
+    async def scenario(sharded_index):
+        server = await start_query_server(sharded_index, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'python code\n')
+            await writer.drain()
+            answer = (await reader.readline()).decode('utf-8').rstrip('\n')
+            writer.close()
+            return answer
+
+    with ShardedIndex.load(sharded_path, ProcessTransport) as sharded_index:
+        expected = ','.join(str(value) for value in sharded_index.query(['python', 'code']))
+        assert asyncio.run(sharded_index.query_async(['python', 'code'])) == sharded_index.query(['python', 'code'])
+        assert asyncio.run(scenario(sharded_index)) == expected
+
+
+def test_process_query_opens_sharded_index(tmp_path, capsys):
+    index_path = str(tmp_path / 'inverted.index')
+    process_build(dataset=PATH_TO_DATASET, output=index_path, shards=2)
+    with pytest.raises(ValueError):
+        InvertedIndex.load(index_path)
+
+    process_query(queries=[['python', 'code']], index=index_path)
+
+    out = capsys.readouterr().out
+    for value in [6021, 2581, 5783, 7575, 8864, 4266, 6698, 5295, 6834, 9010]:
+        assert str(value) in out
+
+
+def test_front_coded_dictionary_lookups(tmp_path):
+    terms = sorted({f'w{number}' for number in range(0, 3000, 7)} | {'', 'é', 'éa', 'z' * 300},
+                   key=lambda term: term.encode('utf-8'))
+    encoded_terms = [term.encode('utf-8') for term in terms]
+    assert decode_front_coded(encode_front_coded(encoded_terms)) == encoded_terms
+    words_ids = {term: [number + 1] for number, term in enumerate(terms) if term}
+    index_path = str(tmp_path / 'inverted.index')
+    InvertedIndex(words_ids).dump(index_path)
+
+    reader = SegmentReader(index_path)
+
+    assert list(reader) == [term for term in terms if term]
+    assert all(reader[term] == doc_ids for term, doc_ids in words_ids.items())
+    for absent in ['', 'a', 'w1', 'w2999', 'w9999', 'é0', 'zz']:
+        assert absent not in reader
+
+
+def test_json_index_is_parsed_lazily(tmp_path):
+    index_path = tmp_path / 'inverted.index'
+    words_ids = {'python': [3, 1, 2], 'code': [], 'quo"te\\\\': [5, 4], 'приве́т': [7]}
+    index_path.write_text(json.dumps(words_ids, indent=1), encoding='utf-8')
+
+    inverted_index = InvertedIndex.load(str(index_path))
+
+    assert set(inverted_index.words_ids) == set(words_ids)
+    assert {term: inverted_index.postings(term) for term in words_ids} == {
+        term: sorted(doc_ids) for term, doc_ids in words_ids.items()}
+    assert inverted_index.query(['python', 'unknown']) == []
+
+
+def levenshtein(first, second):
+    row = list(range(len(second) + 1))
+    for number, character in enumerate(first, 1):
+        previous, row = row, [number]
+        for column, other in enumerate(second, 1):
+            row.append(min(row[-1] + 1, previous[column] + 1, previous[column - 1] + (character != other)))
+    return row[-1]
+
+
+@pytest.mark.parametrize('segment', [False, True])
+def test_term_dictionary_prefix_suffix_and_fuzzy(tmp_path, segment):
+    terms = ['code', 'coder', 'coding', 'cod', 'decode', 'python', 'pythons', 'pyton', 'ring', 'sing', 'singing',
+             'c', 'z', 'ᴄode']
+    words_ids = {term: [number] for number, term in enumerate(terms)}
+    if segment:
+        index_path = str(tmp_path / 'inverted.index')
+        InvertedIndex(words_ids).dump(index_path)
+        words_ids = SegmentReader(index_path)
+
+    dictionary = TermDictionary(words_ids)
+
+    assert list(dictionary.prefix('cod')) == ['cod', 'code', 'coder', 'coding']
+    assert sorted(dictionary.suffix('ing')) == ['coding', 'ring', 'sing', 'singing']
+    for word in ['python', 'code', 'x', 'singin', 'ᴄod']:
+        for max_distance in [1, 2]:
+            assert list(dictionary.fuzzy(word, max_distance)) == sorted(
+                term for term in terms if levenshtein(word, term) <= max_distance)
+
+
+def test_pattern_queries_merge_postings():
+    inverted_index = build_inverted_index(PHRASE_DOCUMENTS)
+    inverted_index.add_documents({5: 'pythonic recoding'})
+    inverted_index.delete_documents([4])
+
+    assert inverted_index.expand('pyth*') == ['python', 'pythonic']
+    assert inverted_index.expand('*ode') == ['code']
+    assert inverted_index.expand('*coding') == ['recoding']
+    assert inverted_index.expand('s*e') == ['snake', 'source']
+    assert inverted_index.expand('pyhton~2') == ['python']
+    assert inverted_index.query(['pyth*']) == [1, 2, 5]
+    assert inverted_index.query(['pyth*', 'cod*']) == [1, 2]
+    assert inverted_index.query(['snkae~2']) == [3]
+    assert list(inverted_index.search('sorce~ AND NOT pyth*')) == [3]
+    for word in ['*', '~', 'a*b*c', 'pyhton~3']:
+        assert inverted_index.query([word]) == []
+        with pytest.raises(ValueError):
+            inverted_index.expand(word)
+
+
+def roaring_sample(step, start=0, stop=200000):
+    # dense chunks where step is small, sparse chunks and gaps between them elsewhere
+    doc_ids = list(range(start, stop, step))
+    return [doc_id for doc_id in doc_ids if not 70000 <= doc_id < 140000 or doc_id % 97 == 0]
+
+
+@pytest.mark.parametrize('step', [1, 3, 11, 40])
+def test_roaring_postings_round_trip_and_cursor(step):
+    doc_ids = roaring_sample(step)
+    postings = RoaringPostings.from_sorted(doc_ids)
+
+    assert is_dense(doc_ids) == (step < 16)
+    assert len(postings) == len(doc_ids)
+    assert list(postings) == doc_ids
+    assert list(RoaringPostings.from_bytes(postings.to_bytes())) == doc_ids
+    cursor = postings.cursor()
+    expected = PostingCursor(doc_ids)
+    for target in [0, 5, 65535, 65536, 70001, 139999, 150000, 199999, 200000]:
+        assert cursor.seek(target) == expected.seek(target)
+
+
+def test_roaring_intersection_matches_sorted_lists():
+    posting_lists = [roaring_sample(2), roaring_sample(3, start=1), roaring_sample(1, stop=150000), roaring_sample(7)]
+    expected = sorted(set.intersection(*map(set, posting_lists)))
+
+    bitmaps = [RoaringPostings.from_sorted(doc_ids) for doc_ids in posting_lists]
+
+    assert list(RoaringPostings.intersection(bitmaps[:3])) == sorted(set.intersection(*map(set, posting_lists[:3])))
+    assert list(iter_intersection(bitmaps)) == expected
+    assert list(iter_intersection([bitmaps[0], posting_lists[1], bitmaps[2], posting_lists[3]])) == expected
+
+
+def test_dense_terms_are_stored_as_roaring_postings(tmp_path):
+    words_ids = {'dense': roaring_sample(2), 'denser': roaring_sample(1), 'sparse': roaring_sample(50)}
+    index_path = str(tmp_path / 'inverted.index')
+    merged_path = str(tmp_path / 'merged.index')
+    InvertedIndex(words_ids).dump(index_path)
+    for half, (start, stop) in enumerate([(0, 100000), (100000, 200000)]):
+        InvertedIndex({word: [doc_id for doc_id in doc_ids if start <= doc_id < stop]
+                       for word, doc_ids in words_ids.items()}).dump(f'{merged_path}.{half}')
+    merge_segments([f'{merged_path}.0', f'{merged_path}.1'], merged_path)
+
+    for path in [index_path, merged_path]:
+        inverted_index = InvertedIndex.load(path)
+        assert isinstance(inverted_index.postings('dense'), RoaringPostings)
+        assert isinstance(inverted_index.postings('sparse'), list)
+        assert inverted_index.query(['dense', 'denser', 'sparse']) == sorted(
+            set(words_ids['dense']) & set(words_ids['sparse']))
+
+    compacted = InvertedIndex(dict(words_ids))
+    compacted.compact()
+    assert isinstance(compacted.words_ids['denser'], RoaringPostings)
+    assert compacted.query(['dense', 'denser']) == words_ids['dense']
+
+
+def test_dataset_maps_documents_without_copying(tmp_path):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_bytes('3\tPython code\r\n1\tThe python language\n2\tCafé\n1\tLast one wins'.encode('utf8'))
+
+    dataset = Dataset(str(dataset_path))
+
+    assert list(dataset) == [1, 2, 3] and len(dataset) == 3
+    assert isinstance(dataset[3], memoryview)
+    assert bytes(dataset[3]) == b'Python code'
+    assert str(dataset[2], 'utf-8') == 'Café'
+    assert bytes(dataset[1]) == b'Last one wins'
+    assert 4 not in dataset
+    assert [(doc_id, bytes(content)) for doc_id, content in dataset.iter_lines()][:2] == [
+        (3, b'Python code'), (1, b'The python language')
+    ]
+
+
+def test_dataset_ranges_and_pickling(tmp_path):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_bytes(b''.join(f'{doc_id}\tdocument number {doc_id}\n'.encode() for doc_id in range(50)))
+
+    ranges = split_dataset(str(dataset_path), 3)
+    doc_ids = [doc_id for start, end in ranges for doc_id, _ in Dataset(str(dataset_path), start, end).iter_lines()]
+    copy = pickle.loads(pickle.dumps(Dataset(str(dataset_path), *ranges[1])))
+
+    assert doc_ids == list(range(50))
+    assert list(copy) == list(Dataset(str(dataset_path), *ranges[1]))
+    dataset_path.write_bytes(b'1\tfine\nno tab here\n')
+    with pytest.raises(ValueError):
+        Dataset(str(dataset_path))
+
+
+def test_build_from_dataset_matches_loaded_documents():
+    assert build_inverted_index(Dataset(PATH_TO_DATASET)).words_ids == (
+        build_inverted_index(load_documents(PATH_TO_DATASET)).words_ids
+    )
+
+
+def test_build_interns_terms_into_dense_ids():
+    inverted_index = build_inverted_index({2: 'python code', 1: 'python python snake'}, with_frequencies=True)
+    vocabulary = inverted_index.words_ids
+
+    assert isinstance(vocabulary, Vocabulary)
+    assert vocabulary.terms == ['python', 'snake', 'code']
+    assert [vocabulary.term_id(term) for term in ('python', 'snake', 'code', 'java')] == [0, 1, 2, None]
+    assert vocabulary.postings[0] == vocabulary['python'] == [1, 2]
+    assert inverted_index.frequencies['python'] == {1: 2, 2: 1}
+    assert inverted_index.frequencies.get('java') is None
+    assert dict(vocabulary) == {'python': [1, 2], 'snake': [1], 'code': [2]}
+
+
+def test_metrics_histograms_and_prometheus_text():
+    metrics = Metrics(buckets=(0.01, 0.1))
+    for latency in (0.005, 0.01, 0.05, 2.0):
+        metrics.observe('query_seconds', latency)
+    metrics.add_time('build', 2.0)
+    metrics.count('documents', 10)
+    metrics.record_cache({'hits': 3, 'misses': 1, 'evictions': 0, 'entries': 1, 'bytes': 64})
+
+    report = metrics.to_dict()
+
+    assert report['histograms']['query_seconds']['buckets'] == {'0.01': 2, '0.1': 3, '+Inf': 4}
+    assert report['rates'] == {'documents_per_second': 5.0}
+    assert report['gauges']['cache_hit_rate'] == 0.75
+    text = metrics.to_prometheus()
+    assert 'inverted_index_query_seconds_bucket{le="+Inf"} 4\n' in text
+    assert 'inverted_index_documents_total 10\n' in text
+    assert 'inverted_index_stage_seconds_total{stage="build"} 2.0\n' in text
+
+
+def test_stats_flag_prints_metrics_to_stderr(tmp_path, capsys):
+    index_path = str(tmp_path / 'inverted.index')
+    with patch.object(sys, 'argv', ['prog', 'build', '-d', PATH_TO_DATASET, '-o', index_path, '--stats']):
+        main()
+    build_report = json.loads(capsys.readouterr().err)
+
+    with patch.object(sys, 'argv', ['prog', 'query', '--index', index_path, '-q', 'python', 'code',
+                                    '--stats', 'prometheus']):
+        main()
+    out, err = capsys.readouterr()
+
+    assert build_report['counters']['documents'] == 10000
+    assert build_report['counters']['bytes_written'] == os.path.getsize(index_path)
+    assert {'load_documents', 'tokenize', 'index', 'dump', 'build'} <= set(build_report['stages_seconds'])
+    assert out.startswith('python\n')
+    assert 'inverted_index_queries_total 1\n' in err
+    assert 'inverted_index_query_seconds_count 1\n' in err
+
+
+FIELD_DOCUMENTS = (
+    '1\tPython snakes. Snakes of the jungle and the desert.\n'
+    '2\tJungle book! A book about python code and a jungle.\n'
+    '3\tDesert code\n'
+)
+
+
+def test_split_title():
+    assert split_title('Python snakes. Snakes of the jungle.') == ('Python snakes.', ' Snakes of the jungle.')
+    assert split_title('Version 3.10 is out') == ('Version 3.10 is out', '')
+    assert split_title('Title\tthe body. More.', title_from='column') == ('Title', 'the body. More.')
+
+
+def test_field_indexes_restrict_and_boost_queries(tmp_path):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text(FIELD_DOCUMENTS, encoding='utf8')
+    index_path = str(tmp_path / 'inverted.index')
+
+    process_build(dataset=str(dataset_path), output=index_path, ranked=True, fields=['title', 'body'])
+    inverted_index = InvertedIndex.load(index_path)
+
+    assert sorted(inverted_index.fields) == ['body', 'title']
+    assert inverted_index.query(['jungle']) == [1, 2]
+    assert inverted_index.field('title').query(['jungle']) == [2]
+    assert inverted_index.field('body').query(['python']) == [2]
+    assert inverted_index.field('title').query(['desert']) == [3]
+    plain_top = inverted_index.query_ranked(['python'], k=2)
+    boosted_top = inverted_index.query_ranked(['python'], k=2, boosts={'title': 5.0})
+    assert [doc_id for doc_id, _ in boosted_top] == [1, 2]
+    assert dict(boosted_top)[1] > dict(plain_top)[1] and dict(boosted_top)[2] == dict(plain_top)[2]
+
+    inverted_index.delete_documents([2])
+    assert inverted_index.field('title').query(['jungle']) == []
+
+    process_build(dataset=str(dataset_path), output=index_path)
+    assert not os.path.exists(field_path(index_path, 'title')), 'stale field index is not removed'
+    with pytest.raises(ValueError):
+        InvertedIndex.load(index_path).field('title')
+
+
+@pytest.mark.parametrize('title_from, added', [
+    ('sentence', 'Jungle title. More body about python.'),
+    ('column', 'Jungle title\tMore body about python.'),
+])
+def test_added_documents_are_split_into_fields(tmp_path, title_from, added):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text(FIELD_DOCUMENTS, encoding='utf8')
+    index_path = str(tmp_path / 'inverted.index')
+    process_build(dataset=str(dataset_path), output=index_path, ranked=True, fields=['title', 'body'],
+                  title_from=title_from)
+    inverted_index = InvertedIndex.load(index_path)
+    assert inverted_index.field('title').metadata == {'field': 'title', 'title_from': title_from}
+
+    inverted_index.add_documents({4: added, 1: 'Desert snakes. Nothing else.'})
+    updated_path = tmp_path / 'updated'
+    updated_path.write_text(FIELD_DOCUMENTS + '4\t' + added + '\n1\tDesert snakes. Nothing else.\n', encoding='utf8')
+    rebuilt_path = str(tmp_path / 'rebuilt.index')
+    process_build(dataset=str(updated_path), output=rebuilt_path, ranked=True, fields=['title', 'body'],
+                  title_from=title_from)
+    rebuilt = InvertedIndex.load(rebuilt_path)
+
+    assert inverted_index.field('title').query(['jungle']) == [2, 4]
+    for field in ['title', 'body']:
+        for word in ['jungle', 'python', 'desert', 'snakes', 'body', 'book']:
+            assert inverted_index.field(field).query([word]) == rebuilt.field(field).query([word]), (field, word)
+    inverted_index.dump(index_path)
+    reloaded = InvertedIndex.load(index_path)
+    assert reloaded.field('title').query(['jungle']) == [2, 4]
+    assert reloaded.field('title').metadata['title_from'] == title_from
+
+
+def test_query_cli_field_and_boost(tmp_path, capsys):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text(FIELD_DOCUMENTS, encoding='utf8')
+    index_path = str(tmp_path / 'inverted.index')
+    process_build(dataset=str(dataset_path), output=index_path, ranked=True, fields=['title'])
+
+    with patch.object(sys, 'argv', ['prog', 'query', '--index', index_path, '-q', 'jungle', '--field', 'title']):
+        main()
+    with patch.object(sys, 'argv', ['prog', 'query', '--index', index_path, '-q', 'jungle', '--field', 'title',
+                                    '--batch']):
+        main()
+    with patch.object(sys, 'argv', ['prog', 'query', '--index', index_path, '-q', 'python', '--top-k', '1',
+                                    '--boost', 'title=5']):
+        main()
+
+    assert capsys.readouterr().out == 'jungle\n2\njungle\n2\npython\n1\n'
+    for batch in [False, True]:
+        with pytest.raises(ValueError, match='has no body field'):
+            process_query(queries=[['jungle']], index=index_path, field='body', batch=batch)
+
+
+def test_pipelined_build_matches_single_process_build(tmp_path):
+    pipelined_path = str(tmp_path / 'pipelined.index')
+    single_path = str(tmp_path / 'single.index')
+    subset_path = tmp_path / 'subset'
+    with open(PATH_TO_DATASET, 'rb') as dataset:
+        subset_path.write_bytes(b''.join(line for _, line in zip(range(1000), dataset)))
+    runs_path = str(tmp_path / 'runs.index')
+
+    process_build(dataset=str(subset_path), output=pipelined_path, workers=2, ranked=True, positions=True,
+                  pipeline=True)
+    process_build(dataset=str(subset_path), output=single_path, ranked=True, positions=True)
+    # a tiny budget and small queues force many runs written while the next batches are tokenized
+    build_inverted_index_pipelined(str(subset_path), runs_path, workers=2, memory_budget=16 * 1024,
+                                   batch_size=16, queue_size=2)
+
+    with open(pipelined_path, 'rb') as pipelined, open(single_path, 'rb') as single:
+        assert pipelined.read() == single.read()
+    built = {word: list(doc_ids) for word, doc_ids in InvertedIndex.load(runs_path).words_ids.items()}
+    assert built == dict(build_inverted_index(load_documents(str(subset_path))).words_ids)
+    assert sorted(os.listdir(tmp_path)) == ['pipelined.index', 'runs.index', 'single.index', 'subset']
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'ranked': True}, {'positions': True}, {'memory_budget': 1024},
+    {'pipeline': True, 'workers': 2}, {'pipeline': True, 'workers': 2, 'ranked': True},
+])
+def test_build_metrics_count_tokens_without_stop_words(tmp_path, options):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text('1\tThe python code of the snake\n2\tPython and more python\n3\tthe\n', encoding='utf8')
+
+    metrics = enable_metrics()
+    try:
+        process_build(dataset=str(dataset_path), output=str(tmp_path / 'inverted.index'), **options)
+    finally:
+        disable_metrics()
+
+    assert metrics.counters['documents'] == 3
+    assert metrics.counters['tokens'] == 5
+    assert 'tokens_per_second' in metrics.rates()
+
+
+def test_tokenizer_counts_tokens_with_terms():
+    tokenizer = Tokenizer(TermFilter(['the', 'of']), stemmer=lambda term: term.rstrip('s'))
+
+    assert tokenizer.counted_terms('The codes of Python, the code') == ({'code', 'python'}, 3)
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'memory_budget': 1024}, {'workers': 2}, {'workers': 2, 'ranked': True, 'positions': True},
+    {'pipeline': True}, {'pipeline': True, 'workers': 2, 'ranked': True, 'positions': True},
+    {'shards': 2}, {'shards': 2, 'memory_budget': 1024},
+])
+def test_build_keeps_last_line_of_duplicate_identifier(tmp_path, options):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_text('3\tpython\n1\tpython code\n2\tpython\n1\tpython snake\n', encoding='utf8')
+    index_path = str(tmp_path / 'inverted.index')
+
+    process_build(dataset=str(dataset_path), output=index_path, documents=True, **options)
+    assert DocumentStore(document_store_path(index_path))[1] == 'python snake'
+
+    inverted_index = open_index(index_path)
+    try:
+        assert inverted_index.query(['python']) == [1, 2, 3]
+        assert inverted_index.query(['code']) == []
+        assert inverted_index.query(['snake']) == [1]
+    finally:
+        if isinstance(inverted_index, ShardedIndex):
+            inverted_index.close()
+
+
+def test_pipelined_build_reports_bad_lines(tmp_path):
+    dataset_path = tmp_path / 'dataset'
+    dataset_path.write_bytes(b'1\tpython code\nno tab here\n2\tsnake\n')
+
+    with pytest.raises(ValueError):
+        build_inverted_index_pipelined(str(dataset_path), str(tmp_path / 'inverted.index'), batch_size=1)
+    assert os.listdir(tmp_path) == ['dataset']
+
+
+@pytest.mark.parametrize('cache_size', [0, 1024 * 1024])
+def test_benchmark_index_report(cache_size):
+    report = benchmark_index(documents=50, vocabulary=200, document_length=20, queries=30, query_length=2,
+                             exponent=1.0, seed=1, cache_size=cache_size)
+
+    assert report['parameters']['cache_size'] == cache_size
+    assert {'load_documents', 'build_inverted_index', 'dump', 'load', 'query', 'query_warm'} <= set(report['phases'])
+    assert report['phases']['query']['p50_seconds'] <= report['phases']['query']['max_seconds']
+    assert report['index_bytes'] > 0
+    json.dumps(report)
+    if cache_size:
+        assert report['cache']['hits'] >= 30, 'the warm run is answered from the cache'
+    else:
+        assert report['cache']['hits'] == 0 and report['cache']['entries'] == 0